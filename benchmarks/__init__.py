@@ -0,0 +1,5 @@
+"""
+Offline benchmarks for the OCR pipelines, text grouping and serialization
+
+Run with `python -m benchmarks.run_benchmarks --help`.
+"""
@@ -0,0 +1,226 @@
+"""
+Benchmark OCR pipelines, text grouping and serialization on synthetic data
+
+All inputs are generated deterministically, so results of different runs (e.g.
+before and after an upgrade or config change) can be compared:
+
+    python -m benchmarks.run_benchmarks --suites grouping serialization -o before.json
+    python -m benchmarks.run_benchmarks --suites grouping serialization -o after.json --compare before.json
+"""
+import argparse
+from io import BytesIO
+import json
+import logging
+import platform
+import random
+import time
+
+import numpy as np
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from common.helper_functions import make_jsonifiable
+from common.serialization import dumps, compact_boxes
+from common.synthetic_images import text_image
+from ocr_detection.text_grouping import group_words, group_lines
+
+SUITES = ('grouping', 'serialization', 'pipelines', 'end_to_end')
+MODELS = ('paddle_ocr', 'keras_ocr')
+
+# Number of words in synthetic prediction lists
+BOX_COUNTS = (10, 100, 1000, 5000)
+# (width, height, lines, words per line) of synthetic images
+IMAGE_SIZES = ((320, 240, 2, 3), (1280, 720, 8, 6), (1080, 2400, 40, 5), (3840, 2160, 20, 12))
+
+
+def parse_args():
+    """
+    Parse command line arguments
+    """
+    cli = argparse.ArgumentParser()
+    cli.add_argument("--suites", "-s", nargs="+", default=['grouping', 'serialization'], choices=SUITES, help="Benchmarks to run.")
+    cli.add_argument("--models", "-m", nargs="+", default=list(MODELS), choices=MODELS, help="Models for the pipelines and end_to_end suites.")
+    cli.add_argument("--repeat", "-r", default=5, type=int, help="Timed repetitions per case.")
+    cli.add_argument("--output", "-o", default="", help="Write results as JSON to this file.")
+    cli.add_argument("--compare", "-c", default="", help="Earlier results file to compare against.")
+    cli.add_argument("--threshold", "-t", default=0.1, type=float, help="Relative slowdown of the median reported as a regression.")
+
+    return cli.parse_args()
+
+
+def measure(function, repeat, warmup=1):
+    """
+    Time repeated calls of a function
+
+    :return dict:  Latency statistics in seconds
+    """
+    for _ in range(warmup):
+        function()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    timings = np.array(timings)
+    return {'repeat': repeat,
+            'mean': float(timings.mean()),
+            'min': float(timings.min()),
+            'p50': float(np.percentile(timings, 50)),
+            'p90': float(np.percentile(timings, 90)),
+            'p99': float(np.percentile(timings, 99))}
+
+
+def synthetic_words(count, seed=0):
+    """
+    Word boxes laid out in lines and paragraphs, like keras-ocr predictions
+
+    :return list:  (word, box of shape (4, 2)) tuples in random order
+    """
+    generator = random.Random(seed)
+    words = []
+    x, y = 10.0, 10.0
+    for index in range(count):
+        height = generator.uniform(14, 18)
+        width = generator.uniform(20, 80)
+        box = np.array([[x, y], [x + width, y], [x + width, y + height], [x, y + height]], dtype=np.float32)
+        words.append(('word%i' % index, box))
+        x += width + generator.uniform(4, 8)
+        if x > 1200:
+            # New line, with an occasional paragraph break
+            x = 10.0
+            y += height * (generator.choice([1.3, 1.3, 1.3, 3.0]))
+    generator.shuffle(words)
+    return words
+
+
+def synthetic_lines(count, seed=0):
+    """
+    Line boxes like PaddleOCR predictions
+
+    :return list:  PaddleOCR output for one image
+    """
+    return [[[box.tolist(), (word, 0.95)] for word, box in synthetic_words(count, seed)]]
+
+
+def grouping_suite(args):
+    results = []
+    for count in BOX_COUNTS:
+        words = synthetic_words(count)
+        boxes = np.array([box for _, box in words])
+        results.append({'suite': 'grouping', 'case': 'group_words', 'size': count,
+                        **measure(lambda: group_words(boxes), args.repeat)})
+        results.append({'suite': 'grouping', 'case': 'group_lines', 'size': count,
+                        **measure(lambda: group_lines(boxes), args.repeat)})
+    return results
+
+
+def serialization_suite(args):
+    results = []
+    for count in BOX_COUNTS:
+        words = synthetic_words(count)
+        result = {'simplified_text': {'raw_text': ' '.join(word for word, _ in words)}, 'raw_output': words}
+        results.append({'suite': 'serialization', 'case': 'make_jsonifiable', 'size': count,
+                        **measure(lambda: make_jsonifiable(result), args.repeat)})
+        results.append({'suite': 'serialization', 'case': 'dumps', 'size': count,
+                        **measure(lambda: dumps(result), args.repeat)})
+        results.append({'suite': 'serialization', 'case': 'compact_boxes', 'size': count,
+                        **measure(lambda: compact_boxes([word for word, _ in words],
+                                                        [box for _, box in words]), args.repeat)})
+    return results
+
+
+def synthetic_upload(width, height, lines, words_per_line, seed=0):
+    """
+    A synthetic text image as an uploaded PNG file
+    """
+    image, _ = text_image(width, height, lines, words_per_line, seed=seed)
+    buffer = BytesIO()
+    Image.fromarray(image).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def pipelines_suite(args):
+    from ocr_detection.image_handler import ImageTextDetector
+
+    detector = ImageTextDetector(logger=logging.getLogger('benchmark'))
+    results = []
+    for model_type in args.models:
+        model = detector.get_model(model_type)
+        for width, height, lines, words_per_line in IMAGE_SIZES:
+            upload = synthetic_upload(width, height, lines, words_per_line)
+            image, _ = model.preprocess_image(FileStorage(stream=BytesIO(upload), filename='synthetic.png'))
+            stats = measure(lambda: model.predict([image]), args.repeat)
+            results.append({'suite': 'pipelines', 'case': model_type, 'size': '%ix%i' % (width, height),
+                            'images_per_second': 1 / stats['mean'], **stats})
+    return results
+
+
+def end_to_end_suite(args):
+    from ocr_detection.image_handler import ImageTextDetector
+
+    # No cache, so every repetition runs the model
+    detector = ImageTextDetector(logger=logging.getLogger('benchmark'))
+    results = []
+    for model_type in args.models:
+        for width, height, lines, words_per_line in IMAGE_SIZES:
+            upload = synthetic_upload(width, height, lines, words_per_line)
+
+            def process():
+                image_file = FileStorage(stream=BytesIO(upload), filename='synthetic.png')
+                detector.process_image(image_file, model_type, use_cache=False)
+
+            stats = measure(process, args.repeat)
+            results.append({'suite': 'end_to_end', 'case': model_type, 'size': '%ix%i' % (width, height),
+                            'images_per_second': 1 / stats['mean'], **stats})
+    return results
+
+
+def compare(results, previous, threshold):
+    """
+    Relative change in median latency per case compared to earlier results
+    """
+    earlier = {(result['suite'], result['case'], str(result['size'])): result for result in previous['results']}
+    comparison = []
+    for result in results:
+        before = earlier.get((result['suite'], result['case'], str(result['size'])))
+        if before is None or not before['p50']:
+            continue
+        change = (result['p50'] - before['p50']) / before['p50']
+        comparison.append({'suite': result['suite'], 'case': result['case'], 'size': result['size'],
+                           'p50_before': before['p50'], 'p50_after': result['p50'], 'change': change,
+                           'regression': change > threshold})
+    return comparison
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    suites = {'grouping': grouping_suite, 'serialization': serialization_suite,
+              'pipelines': pipelines_suite, 'end_to_end': end_to_end_suite}
+
+    results = []
+    for suite in args.suites:
+        print(f"Running {suite} benchmarks...")
+        results.extend(suites[suite](args))
+
+    report = {'created': time.time(),
+              'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                          'processor': platform.processor(), 'numpy': np.__version__},
+              'results': results}
+
+    for result in results:
+        print(f"{result['suite']:<14} {result['case']:<18} {str(result['size']):<10} "
+              f"p50 {result['p50'] * 1000:10.3f} ms  p90 {result['p90'] * 1000:10.3f} ms")
+
+    if args.compare:
+        with open(args.compare) as infile:
+            report['comparison'] = compare(results, json.load(infile), args.threshold)
+        for row in report['comparison']:
+            flag = "REGRESSION" if row['regression'] else ""
+            print(f"{row['suite']:<14} {row['case']:<18} {str(row['size']):<10} {row['change']:+8.1%} {flag}")
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+
+    if any(row['regression'] for row in report.get('comparison', [])):
+        exit(1)
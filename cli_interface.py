@@ -1,10 +1,22 @@
 import argparse
+from glob import glob
+from multiprocessing import Pool
 from pathlib import Path
-from PIL import Image, UnidentifiedImageError
 import logging
 import json
 
+from common import columnar_output, serialization
+from common.url_fetching import UrlFetcher, is_url
 from ocr_detection.image_handler import ImageTextDetector
+from ocr_detection.metrics import Metrics
+from ocr_detection.text_prefilter import TextPrefilter
+
+# Extensions picked up when a directory is given as input
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif'}
+
+# Detector and downloader of each worker process
+worker_detector = None
+worker_fetcher = None
 
 
 def parse_args():
@@ -14,11 +26,147 @@ def parse_args():
     cli = argparse.ArgumentParser()
     cli.add_argument("--model", "-m", default="", help="OCR model.")
     cli.add_argument("--output_dir", "-o", default="", help="Directory to store JSON results.")
-    cli.add_argument("--images", "-i", nargs="+", type=str, help="Filepaths to image(s) from which to extract text.")
+    cli.add_argument("--images", "-i", nargs="+", type=str, help="Filepaths, directories, glob patterns (e.g. 'data/**/*.jpg') or URLs of image(s) from which to extract text.")
+    cli.add_argument("--jsonl", "-j", default="", help="Append all results to this JSONL file instead of one JSON file per image.")
+    cli.add_argument("--table", "-t", default="", help="Write all results to this Parquet (.parquet) or Arrow IPC (.arrow) file instead of one JSON file per image; requires pyarrow.")
+    cli.add_argument("--row_group_size", default=10000, type=int, help="Results buffered in memory and written at once to a --table file.")
+    cli.add_argument("--workers", "-w", default=1, type=int, help="Number of processes, each with its own model.")
+    cli.add_argument("--batch_size", "-b", default=8, type=int, help="Number of images sent through the model at once.")
+    cli.add_argument("--resume", "-r", action="store_true", help="Skip images that already have results.")
+    cli.add_argument("--lang", default=None, help="Language of the text for paddle_ocr (e.g. en, german, fr, japan, ch).")
+    cli.add_argument("--fetch_workers", default=8, type=int, help="Number of simultaneous downloads of images given by URL, per worker.")
+    cli.add_argument("--max_side", default=None, type=int, help="Downscale images so their longest side is at most this many pixels.")
+    cli.add_argument("--tile_size", default=None, type=int, help="Split larger images (e.g. long screenshots) into overlapping tiles of this size.")
+    cli.add_argument("--max_frames", default=None, type=int, help="Sample up to this many distinct frames of animated GIFs instead of only the first.")
+    cli.add_argument("--mode", default=ImageTextDetector.FULL, choices=(ImageTextDetector.FULL, ImageTextDetector.DETECT), help="'detect' only returns text boxes, skipping text recognition.")
+    cli.add_argument("--text_prefilter", default=None, choices=TextPrefilter.METHODS, help="Skip the model for images a quick check on a thumbnail finds no text in.")
+    cli.add_argument("--metrics", default="", help="Write stage latency metrics as JSON to this file ('-' to print).")
+    cli.add_argument("--output_level", default=serialization.FULL, choices=serialization.OUTPUT_LEVELS, help="Detail of stored results.")
 
     return cli.parse_args()
 
 
+def find_images(inputs):
+    """
+    Expand directories and glob patterns into image paths, in order and
+    without duplicates; URLs are kept as they are
+    """
+    images = []
+    for entry in inputs:
+        path = Path(entry)
+        if is_url(entry):
+            images.append(entry)
+        elif path.is_dir():
+            images.extend(sorted(child for child in path.iterdir() if child.suffix.lower() in IMAGE_EXTENSIONS))
+        elif any(char in entry for char in '*?['):
+            images.extend(Path(match) for match in sorted(glob(entry, recursive=True)))
+        else:
+            images.append(path)
+    return list(dict.fromkeys(images))
+
+
+def source_key(image):
+    """
+    Key of an input image in results and for --resume: its URL, or its path as
+    found, so images with the same name in different directories are told apart
+    """
+    return image if is_url(image) else str(image)
+
+
+def result_key(result):
+    """
+    Key of the image a result is for; see `source_key`
+    """
+    return result.get('url') or result.get('path') or result.get('filename')
+
+
+def json_output_path(output_dir, result):
+    """
+    JSON file of a result; those of local images keep the directories of the
+    image path, so they do not overwrite each other
+    """
+    if result.get('path'):
+        path = Path(result['path'])
+        parts = ['_' if part == '..' else part for part in path.parts if part != path.anchor]
+        return output_dir.joinpath(*parts).with_suffix(".json")
+    return output_dir.joinpath(Path(result["filename"]).with_suffix(".json").name)
+
+
+def finished_images(output_dir, jsonl_path, table_path=None):
+    """
+    Keys (see `source_key`) of images that already have results, or without
+    a JSONL or table file, the JSON files already written
+    """
+    if table_path:
+        return columnar_output.finished_images(table_path, logger=logging)
+    if jsonl_path:
+        if not jsonl_path.exists():
+            return set()
+        finished = set()
+        with open(jsonl_path) as infile:
+            for line in infile:
+                try:
+                    finished.add(result_key(json.loads(line)))
+                except (ValueError, AttributeError):
+                    # Likely a partially written final line
+                    continue
+        return finished
+    return set(output_dir.rglob('*.json'))
+
+
+def init_worker(batch_size, fetch_workers, text_prefilter=None):
+    """
+    Create one detector and downloader per process; models are loaded on first use
+    """
+    global worker_detector, worker_fetcher
+    prefilter = TextPrefilter(logger=logging, method=text_prefilter) if text_prefilter else None
+    worker_detector = ImageTextDetector(logger=logging, batch_size=batch_size, text_prefilter=prefilter)
+    # URLs on the command line come from whoever runs it, so local hosts are allowed
+    worker_fetcher = UrlFetcher(logger=logging, workers=fetch_workers, allow_private=True)
+
+
+def process_batch(task):
+    """
+    Run a batch of local images or URLs through the worker's detector
+
+    :return tuple:  Results and the metrics collected for this batch
+    """
+    model, images, options = task
+    if images and is_url(images[0]):
+        results = [result for batch in worker_fetcher.process_urls(worker_detector, images, model, **options)
+                   for result in batch]
+    else:
+        results = worker_detector.process_images([str(image) for image in images], model, local=True, **options)
+        for image, result in zip(images, results):
+            result['path'] = source_key(image)
+    metrics = worker_detector.metrics.to_dict()
+    worker_detector.metrics.reset()
+    return results, metrics
+
+
+def write_results(batch_results, output_level, output_dir, jsonl_file=None, table_writer=None):
+    """
+    Write results to the columnar file or JSONL file if given, otherwise one
+    JSON file per image
+    """
+    if table_writer:
+        table_writer.write([serialization.prepare_result(prediction, output_level, logger=logging)
+                            for prediction in batch_results])
+        return
+    for prediction in batch_results:
+        prediction = serialization.prepare_result(prediction, output_level, logger=logging)
+        if jsonl_file:
+            jsonl_file.write(serialization.dumps(prediction) + "\n")
+        elif output_dir:
+            output_path = json_output_path(output_dir, prediction)
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(output_path, "w") as out_file:
+                out_file.write(serialization.dumps(prediction))
+    if jsonl_file:
+        # Make sure finished results survive an interrupted run
+        jsonl_file.flush()
+
+
 if __name__ == "__main__":
     args = parse_args()
 
@@ -31,39 +179,87 @@ if __name__ == "__main__":
         exit(1)
 
     output_dir = Path(args.output_dir)
+    jsonl_path = Path(args.jsonl) if args.jsonl else None
+    table_path = Path(args.table) if args.table else None
+    if table_path:
+        if table_path.suffix.lower() not in columnar_output.FORMATS:
+            print(f"--table must end in {', '.join(columnar_output.FORMATS)}.")
+            exit(1)
+        try:
+            columnar_output.import_pyarrow()
+        except ValueError as e:
+            print(e)
+            exit(1)
+    images = find_images(args.images)
+
+    if args.resume:
+        finished = finished_images(output_dir, jsonl_path, table_path)
+        total = len(images)
+        if jsonl_path or table_path:
+            images = [image for image in images if source_key(image) not in finished]
+        else:
+            images = [image for image in images
+                      if json_output_path(output_dir, {'filename': UrlFetcher.url_filename(image)} if is_url(image)
+                                          else {'path': source_key(image)}) not in finished]
+        print(f"Skipping {total - len(images)} images with existing results.")
+
+    # Check if images exist; decoding errors are reported by the models
+    results = []
+    to_process = []
+    urls = []
+    for image_path in images:
+        if is_url(image_path):
+            urls.append(image_path)
+        elif image_path.is_file():
+            to_process.append(image_path)
+        else:
+            print(f"Image does not exist: {image_path}")
+            results.append({
+                "filename": image_path.name,
+                "path": source_key(image_path),
+                'model_type': args.model,
+                "success": False,
+                "error": "Image does not exist"
+            })
+
+    batch_size = max(1, args.batch_size)
+    options = {"max_side": args.max_side, "lang": args.lang, "max_frames": args.max_frames, "mode": args.mode, "tile_size": args.tile_size}
+    tasks = [(args.model, to_process[start:start + batch_size], options) for start in range(0, len(to_process), batch_size)]
+    url_tasks = [(args.model, urls[start:start + batch_size], options) for start in range(0, len(urls), batch_size)]
+    print(f"Processing {len(to_process)} images and {len(urls)} URLs in {len(tasks) + len(url_tasks)} batches with {args.workers} worker(s).")
+
+    metrics = Metrics()
+    jsonl_file = open(jsonl_path, "a") if jsonl_path else None
+    # A resumed run adds a numbered part next to the earlier file
+    table_writer = columnar_output.ColumnarWriter(columnar_output.next_part_path(table_path),
+                                                  row_group_size=args.row_group_size,
+                                                  logger=logging) if table_path else None
     try:
-        detector = ImageTextDetector(logger=logging)
-    except ValueError as e:
-        print(e)
-        exit(1)
+        write_results(results, args.output_level, output_dir, jsonl_file, table_writer)
 
-    for image in args.images:
-        # Check if image exists and can be opened
-        image_path = Path(image)
-        error = None
-        if not image_path.exists():
-            print(f"Image does not exist: {image}")
-            error = "Image does not exist"
+        if args.workers > 1:
+            with Pool(args.workers, initializer=init_worker, initargs=(batch_size, args.fetch_workers, args.text_prefilter)) as pool:
+                for batch_results, batch_metrics in pool.imap_unordered(process_batch, tasks + url_tasks):
+                    write_results(batch_results, args.output_level, output_dir, jsonl_file, table_writer)
+                    metrics.merge(batch_metrics)
         else:
-            try:
-                with Image.open(image):
-                    pass
-            except Exception as e:
-                print(f"Error opening image: {image}")
-                error = str(e)
-        if error:
-            if output_dir:
-                with open(output_dir.joinpath(image_path.with_suffix(".json").name), "w") as out_file:
-                    out_file.write(json.dumps({
-                        "filename": image_path.name,
-                        'model_type': args.model,
-                        "success": False,
-                        "error": error
-                    }))
-            continue
-
-        # Process image
-        prediction = detector.process_image(image, args.model, local=True)
-        if output_dir:
-            with open(output_dir.joinpath(image_path.with_suffix(".json").name), "w") as out_file:
-                out_file.write(json.dumps(prediction))
+            init_worker(batch_size, args.fetch_workers, args.text_prefilter)
+            for task in tasks:
+                batch_results, batch_metrics = process_batch(task)
+                write_results(batch_results, args.output_level, output_dir, jsonl_file, table_writer)
+                metrics.merge(batch_metrics)
+            # One stream of downloads, so the next batch downloads while the current one is processed
+            for batch_results in worker_fetcher.process_urls(worker_detector, urls, args.model, **options):
+                write_results(batch_results, args.output_level, output_dir, jsonl_file, table_writer)
+            metrics.merge(worker_detector.metrics.to_dict())
+    finally:
+        if jsonl_file:
+            jsonl_file.close()
+        if table_writer:
+            table_writer.close()
+
+    if args.metrics == "-":
+        print(json.dumps(metrics.to_dict(), indent=2))
+    elif args.metrics:
+        with open(args.metrics, "w") as out_file:
+            json.dump(metrics.to_dict(), out_file, indent=2)
@@ -0,0 +1,59 @@
+"""
+Matching of client IP addresses against configured addresses and ranges
+"""
+import ipaddress
+import logging
+
+
+class AddressSet:
+    """
+    Set of IP addresses and CIDR ranges (e.g. 172.17.0.0/16)
+
+    Networks are stored by IP version and prefix length, so a lookup costs one
+    set membership check per distinct prefix length rather than one comparison
+    per entry.
+
+    A set is true if any entries were configured, even if none of them could
+    be parsed: a whitelist of only invalid entries matches no one instead of
+    allowing everyone.
+    """
+    def __init__(self, entries=None, logger=None, name='IP list'):
+        log = logger or logging.getLogger(__name__)
+        # {version: {prefixlen: {network address as int}}}
+        self.networks = {4: {}, 6: {}}
+        self.configured = bool(entries)
+        for entry in entries or []:
+            try:
+                network = ipaddress.ip_network(str(entry).strip(), strict=False)
+            except ValueError:
+                log.warning('Ignoring invalid IP address or range in config: %s' % entry)
+                continue
+            self.networks[network.version].setdefault(network.prefixlen, set()).add(int(network.network_address))
+        if self.configured and not (any(self.networks[4]) or any(self.networks[6])):
+            log.error('None of the entries of %s are valid IP addresses or ranges; it matches no address' % name)
+
+        # Masks to apply per prefix length, most specific first
+        self.masks = {version: [(prefixlen, self._mask(version, prefixlen))
+                                for prefixlen in sorted(prefixes, reverse=True)]
+                      for version, prefixes in self.networks.items()}
+
+    @staticmethod
+    def _mask(version, prefixlen):
+        bits = 32 if version == 4 else 128
+        return ((1 << prefixlen) - 1) << (bits - prefixlen)
+
+    def __contains__(self, address):
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        # IPv4 clients seen through an IPv6 socket
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+
+        value = int(address)
+        networks = self.networks[address.version]
+        return any(value & mask in networks[prefixlen] for prefixlen, mask in self.masks[address.version])
+
+    def __bool__(self):
+        return self.configured
@@ -0,0 +1,284 @@
+"""
+Columnar Parquet and Arrow IPC output of OCR results for bulk runs
+
+Requires the optional pyarrow package.
+"""
+from pathlib import Path
+
+from common.serialization import dumps
+
+# File formats by suffix
+PARQUET = 'parquet'
+ARROW = 'arrow'
+FORMATS = {'.parquet': PARQUET, '.arrow': ARROW, '.feather': ARROW}
+
+
+def import_pyarrow():
+    """
+    Import pyarrow, which is only needed for columnar output
+
+    :raises ValueError:  If pyarrow is not installed
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        raise ValueError('Parquet and Arrow output are not available; install the pyarrow package')
+    return pyarrow
+
+
+def result_schema():
+    """
+    Columns of result files; the same for every output level and model, so
+    files of different runs can be read as one dataset
+    """
+    pa = import_pyarrow()
+    return pa.schema([
+        ('filename', pa.string()),
+        ('url', pa.string()),
+        # Path of a local image as given to the CLI, which tells images with the same filename apart
+        ('path', pa.string()),
+        ('model_type', pa.string()),
+        ('success', pa.bool_()),
+        ('error', pa.string()),
+        ('raw_text', pa.string()),
+        # Groups of lines of text
+        ('groupings', pa.list_(pa.list_(pa.string()))),
+        # Words or lines with their [x1, y1, ..., x4, y4] boxes and scores
+        ('box_text', pa.list_(pa.string())),
+        ('boxes', pa.list_(pa.list_(pa.int32()))),
+        ('box_scores', pa.list_(pa.float32())),
+        # Boxes found in detect mode
+        ('text_regions', pa.list_(pa.list_(pa.int32()))),
+        ('frame_count', pa.int32()),
+        ('prefiltered', pa.bool_()),
+        ('near_duplicate_distance', pa.int32()),
+        # Nested results that do not fit columns, as JSON
+        ('frames', pa.string()),
+        ('raw_output', pa.string()),
+    ])
+
+
+def group_lines(groupings):
+    """
+    Groupings as groups of lines of text; keras-ocr splits lines into lists
+    of words, which are joined with spaces as in its raw text
+
+    :param list groupings:  Groupings of a simplified text
+    :return list|None:  Groups of line strings
+    """
+    if groupings is None:
+        return None
+    return [[' '.join(line) if isinstance(line, (list, tuple)) else line for line in group] for group in groupings]
+
+
+def error_row(result, error):
+    """
+    Row for a result that could not be converted to the schema, so the image
+    is still accounted for
+
+    :param dict result:  Prepared result
+    :param str error:  Reason
+    :return dict:  Values by column
+    """
+    return {'filename': result.get('filename'),
+            'url': result.get('url'),
+            'path': result.get('path'),
+            'model_type': result.get('model_type'),
+            'success': False,
+            'error': 'Unable to store result: %s' % error}
+
+
+def result_row(result):
+    """
+    Flatten a prepared result into a row of `result_schema`
+
+    :param dict result:  Result from `serialization.prepare_result`
+    :return dict:  Values by column
+    """
+    simplified_text = result.get('simplified_text')
+    if not isinstance(simplified_text, dict):
+        simplified_text = {}
+    boxes = result.get('boxes') or {}
+    raw_output = result.get('raw_output')
+    return {'filename': result.get('filename'),
+            'url': result.get('url'),
+            'path': result.get('path'),
+            'model_type': result.get('model_type'),
+            'success': result.get('success'),
+            'error': result.get('error'),
+            'raw_text': simplified_text.get('raw_text'),
+            'groupings': group_lines(simplified_text.get('groupings')),
+            'box_text': boxes.get('text'),
+            'boxes': boxes.get('boxes'),
+            'box_scores': boxes.get('scores'),
+            'text_regions': result.get('text_regions'),
+            'frame_count': result.get('frame_count'),
+            'prefiltered': result.get('prefiltered'),
+            'near_duplicate_distance': result.get('near_duplicate_distance'),
+            'frames': dumps(result['frames']) if result.get('frames') else None,
+            # Legacy output is already a JSON string
+            'raw_output': raw_output if isinstance(raw_output, str) or raw_output is None else dumps(raw_output)}
+
+
+def part_paths(path):
+    """
+    Existing result files written to `path`: the file itself and the parts
+    added by resumed runs (`results.1.parquet`, `results.2.parquet`, ...)
+
+    :param Path path:  Result file
+    :return list:  Paths in the order they were written
+    """
+    parts = sorted((part for part in path.parent.glob('%s.*%s' % (path.stem, path.suffix))
+                    if part.name[len(path.stem) + 1:-len(path.suffix)].isdigit()),
+                   key=lambda part: int(part.name[len(path.stem) + 1:-len(path.suffix)]))
+    return ([path] if path.exists() else []) + parts
+
+
+def next_part_path(path):
+    """
+    Path to write new results to without overwriting earlier ones
+
+    :param Path path:  Result file
+    :return Path:  `path` if it does not exist yet, otherwise the next numbered part
+    """
+    existing = part_paths(path)
+    if not existing:
+        return path
+    number = 1
+    while path.with_name('%s.%i%s' % (path.stem, number, path.suffix)) in existing:
+        number += 1
+    return path.with_name('%s.%i%s' % (path.stem, number, path.suffix))
+
+
+def finished_images(path, logger=None):
+    """
+    URLs of downloaded images and paths of local images that have results in
+    `path` or its parts; filenames for files written before paths were stored
+
+    Only these columns are read. Files that cannot be read, such as
+    the last file of an interrupted run, are renamed with an `.incomplete`
+    suffix so the rest can still be read as one dataset.
+
+    :param Path path:  Result file
+    :param logger:  Used to report unreadable files
+    :return set:  Finished filenames and URLs
+    """
+    import_pyarrow()
+    finished = set()
+    for part in part_paths(path):
+        try:
+            table = read_columns(part, ['filename', 'url', 'path'])
+        except Exception as e:
+            if logger:
+                logger.warning('Unable to read results in %s, moving it aside: %s' % (part, str(e)))
+            part.rename(part.with_name(part.name + '.incomplete'))
+            continue
+        columns = [table.column(name).to_pylist() if name in table.column_names else [None] * table.num_rows
+                   for name in ('url', 'path', 'filename')]
+        finished.update(url or image_path or filename for url, image_path, filename in zip(*columns))
+    return finished
+
+
+def read_columns(path, columns):
+    """
+    Read only some columns of a result file
+
+    :param Path path:  Parquet or Arrow IPC file
+    :param list columns:  Column names; those the file does not have, such as columns added
+                          after it was written, are left out
+    :return pyarrow.Table:  Table with these columns
+    """
+    pa = import_pyarrow()
+    if FORMATS.get(Path(path).suffix.lower()) == PARQUET:
+        import pyarrow.parquet as pq
+        names = pq.read_schema(path).names
+        return pq.read_table(path, columns=[column for column in columns if column in names])
+    import pyarrow.ipc
+    with pa.memory_map(str(path)) as source:
+        table = pa.ipc.open_file(source).read_all()
+        return table.select([column for column in columns if column in table.column_names])
+
+
+class ColumnarWriter:
+    """
+    Columnar Result Writer
+
+    Buffers results in memory and writes them as one Parquet row group or
+    Arrow record batch every `row_group_size` results, instead of a small file
+    per image. The format follows the suffix of the path: `.parquet`, or
+    `.arrow`/`.feather` for Arrow IPC. Parquet files are only readable once
+    closed.
+    """
+    def __init__(self, path, row_group_size=10000, compression='zstd', logger=None):
+        """
+        :param Path path:  File to write
+        :param int row_group_size:  Results buffered before they are written
+        :param str compression:  Compression codec of Parquet files and Arrow record batches
+        :param logger:  Used to report results that cannot be stored
+        """
+        pa = import_pyarrow()
+        self.path = Path(path)
+        self.format = FORMATS.get(self.path.suffix.lower())
+        if self.format is None:
+            raise ValueError('Result file must end in %s' % ', '.join(FORMATS))
+        self.row_group_size = max(1, int(row_group_size))
+        self.log = logger
+        self.schema = result_schema()
+        self.rows = []
+        self.written = 0
+
+        if self.format == PARQUET:
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(str(self.path), self.schema, compression=compression)
+        else:
+            import pyarrow.ipc
+            self.writer = pa.ipc.new_file(str(self.path), self.schema,
+                                          options=pa.ipc.IpcWriteOptions(compression=compression))
+
+    def write(self, results):
+        """
+        Add prepared results, writing a row group once enough are buffered
+
+        :param list results:  Results from `serialization.prepare_result`
+        """
+        self.rows.extend(results)
+        while len(self.rows) >= self.row_group_size:
+            self._write_rows(self.rows[:self.row_group_size])
+            self.rows = self.rows[self.row_group_size:]
+
+    def flush(self):
+        """
+        Write buffered results as a final, possibly smaller, row group
+        """
+        if self.rows:
+            self._write_rows(self.rows)
+            self.rows = []
+
+    def close(self):
+        """
+        Write buffered results and finish the file
+        """
+        self.flush()
+        self.writer.close()
+
+    def _write_rows(self, results):
+        pa = import_pyarrow()
+        try:
+            table = pa.Table.from_pylist([result_row(result) for result in results], schema=self.schema)
+        except (pa.ArrowException, TypeError, ValueError):
+            # Convert results one at a time, so one that does not fit only loses its own row
+            table = pa.Table.from_batches([self._result_batch(result) for result in results], schema=self.schema)
+        if self.format == PARQUET:
+            self.writer.write_table(table, row_group_size=len(results))
+        else:
+            self.writer.write_table(table, max_chunksize=len(results))
+        self.written += len(results)
+
+    def _result_batch(self, result):
+        pa = import_pyarrow()
+        try:
+            return pa.RecordBatch.from_pylist([result_row(result)], schema=self.schema)
+        except (pa.ArrowException, TypeError, ValueError) as e:
+            if self.log:
+                self.log.warning('Unable to store result for %s: %s' % (result.get('filename'), str(e)))
+            return pa.RecordBatch.from_pylist([error_row(result, str(e))], schema=self.schema)
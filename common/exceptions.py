@@ -18,3 +18,27 @@ class TextDetectionException(OCRDetectionException):
 	Unable to detect text in image
 	"""
 	pass
+
+class JobQueueFullException(OCRServerException):
+	"""
+	Too many jobs waiting to be processed
+	"""
+	pass
+
+class InvalidImageException(OCRServerException):
+	"""
+	Upload is not a supported image or is too large
+	"""
+	pass
+
+class ImageDownloadException(OCRServerException):
+	"""
+	Unable to download an image from a URL
+	"""
+	pass
+
+class ModelBusyException(OCRServerException):
+	"""
+	No model replica became available in time
+	"""
+	pass
@@ -18,6 +18,22 @@ def get_image_filename(image):
     return filename
 
 
+def read_image_bytes(image_file):
+    """
+    Read the raw contents of an image without consuming it
+
+    :param image_file:  Local file path or requests file stream
+    :return bytes:  Image file contents
+    """
+    if type(image_file) == FileStorage:
+        position = image_file.stream.tell()
+        data = image_file.stream.read()
+        image_file.stream.seek(position)
+        return data
+    with open(image_file, 'rb') as infile:
+        return infile.read()
+
+
 def make_jsonifiable(d: MutableMapping):
     """
     Return a dictionary where all nested sets and ndarray have been converted to lists.
@@ -0,0 +1,113 @@
+"""
+Decoding of images at reduced resolution
+"""
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageOps
+from werkzeug.datastructures import FileStorage
+
+from common.helper_functions import read_image_bytes
+
+
+def open_image(image_file):
+    """
+    Open an image without decoding its pixels yet
+
+    :param image_file:  Local file path, requests file stream or raw bytes
+    :return PIL.Image.Image:  Lazily loaded image
+    """
+    if isinstance(image_file, (bytes, bytearray)):
+        return Image.open(BytesIO(image_file))
+    if type(image_file) == FileStorage:
+        return Image.open(BytesIO(read_image_bytes(image_file)))
+    return Image.open(str(image_file))
+
+
+def load_image(image_file, max_side=None):
+    """
+    Decode an image to an RGB array with its longest side at most `max_side`
+
+    JPEGs are decoded at a reduced DCT scale where possible, so large photos
+    are never decoded at full resolution; other formats are decoded and then
+    downscaled. EXIF orientation is applied.
+
+    :param image_file:  Local file path, requests file stream or raw bytes
+    :param int max_side:  Maximum length of the longest side; None or 0 for no limit
+    :return tuple:  RGB array of shape (height, width, 3) and the (x, y) scale
+                    that maps coordinates in the array back to the original image
+    """
+    image = open_image(image_file)
+    original_width, original_height = image.size
+
+    if max_side and max(image.size) > max_side and image.format == 'JPEG':
+        # Picks the largest DCT reduction that keeps the image at least this size
+        image.draft('RGB', (max_side, max_side))
+
+    decoded_size = image.size
+    image = ImageOps.exif_transpose(image)
+    if image.size != decoded_size:
+        # Rotated by 90 degrees
+        original_width, original_height = original_height, original_width
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    image = downscale(image, max_side)
+    scale = (original_width / image.width, original_height / image.height)
+    return np.asarray(image), scale
+
+
+def load_frames(image_file, max_side=None, max_frames=16, duplicate_threshold=12):
+    """
+    Decode evenly spaced frames of an animated image, skipping frames that
+    look the same as one already returned
+
+    Frames are compared on small grayscale thumbnails; a frame is a duplicate
+    if no thumbnail pixel differs by more than `duplicate_threshold` (on a
+    0-255 scale) from those of a returned frame. The largest rather than the
+    mean difference is used, as a change of a few words only affects a small
+    part of the frame.
+
+    :param image_file:  Local file path, requests file stream or raw bytes
+    :param int max_side:  Maximum length of the longest side; None or 0 for no limit
+    :param int max_frames:  Maximum number of frames sampled
+    :param float duplicate_threshold:  Largest difference at which frames count as the same
+    :return tuple:  List of (frame index, RGB array, (x, y) scale) tuples and
+                    the number of frames in the image; no frames are decoded if
+                    the image is not animated
+    """
+    image = open_image(image_file)
+    frame_count = getattr(image, 'n_frames', 1)
+    if frame_count < 2:
+        return [], frame_count
+    sampled = np.unique(np.linspace(0, frame_count - 1, min(frame_count, max(1, max_frames))).round().astype(int))
+
+    frames = []
+    thumbnails = []
+    for index in sampled.tolist():
+        image.seek(index)
+        frame = image.convert('RGB')
+        thumbnail = np.asarray(frame.convert('L').resize((64, 64), Image.BILINEAR), dtype=np.int16)
+        if any(np.abs(thumbnail - seen).max() <= duplicate_threshold for seen in thumbnails):
+            continue
+        thumbnails.append(thumbnail)
+
+        resized = downscale(frame, max_side)
+        frames.append((index, np.asarray(resized), (frame.width / resized.width, frame.height / resized.height)))
+    return frames, frame_count
+
+
+def downscale(image, max_side=None):
+    """
+    Resize an image so its longest side is at most `max_side`
+
+    :param PIL.Image.Image image:  Decoded image
+    :param int max_side:  Maximum length of the longest side; None or 0 for no limit
+    :return PIL.Image.Image:  The image, resized if needed
+    """
+    if max_side and max(image.size) > max_side:
+        ratio = max_side / max(image.size)
+        image = image.resize((max(1, round(image.width * ratio)), max(1, round(image.height * ratio))),
+                             Image.BILINEAR, reducing_gap=2.0)
+    return image
@@ -0,0 +1,110 @@
+"""
+Cheap checks of image headers before anything is decoded
+"""
+from common.exceptions import InvalidImageException
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Start of frame markers carrying the image dimensions; C4, C8 and CC are other segments
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length field
+JPEG_STANDALONE_MARKERS = set(range(0xD0, 0xDA)) | {0x01}
+# Start of an image streamed in chunks that its dimensions must be found in
+HEADER_BYTES = 64 * 1024
+
+
+def sniff_image(header):
+    """
+    Identify an image from its first bytes
+
+    :param bytes header:  Start of the file
+    :return tuple:  Format (`png`, `gif` or `jpeg`), width and height; the
+                    dimensions are None if not (yet) found in `header`
+    :raises InvalidImageException:  If the bytes are not a supported image
+    """
+    if header.startswith(PNG_SIGNATURE):
+        if len(header) < 24:
+            return 'png', None, None
+        return 'png', int.from_bytes(header[16:20], 'big'), int.from_bytes(header[20:24], 'big')
+
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        if len(header) < 10:
+            return 'gif', None, None
+        return 'gif', int.from_bytes(header[6:8], 'little'), int.from_bytes(header[8:10], 'little')
+
+    if header.startswith(b'\xff\xd8'):
+        return ('jpeg',) + _jpeg_dimensions(header)
+
+    if len(header) < 8 and (PNG_SIGNATURE.startswith(header) or b'GIF89a'.startswith(header[:6])
+                            or b'GIF87a'.startswith(header[:6])):
+        # Not enough bytes to tell yet
+        return None, None, None
+    raise InvalidImageException('Not a supported image format')
+
+
+def _jpeg_dimensions(data):
+    """
+    Walk JPEG segments up to the start of frame marker
+    """
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            raise InvalidImageException('Corrupt JPEG header')
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # Fill byte
+            position += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            position += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            if position + 9 > len(data):
+                break
+            return int.from_bytes(data[position + 7:position + 9], 'big'), int.from_bytes(data[position + 5:position + 7], 'big')
+        if marker == 0xDA:
+            # Image data started without a frame header
+            raise InvalidImageException('Corrupt JPEG header')
+        position += 2 + int.from_bytes(data[position + 2:position + 4], 'big')
+    return None, None
+
+
+def validate_image(data, max_pixels=None):
+    """
+    Check that bytes are a supported image within the pixel limit
+
+    :param bytes data:  Image file contents, or at least its start
+    :param int max_pixels:  Maximum width * height; None for no limit
+    :return tuple:  Format, width and height
+    :raises InvalidImageException:  If the image is not supported, truncated or too large
+    """
+    image_format, width, height = sniff_image(data)
+    if image_format is None or width is None:
+        raise InvalidImageException('Truncated image header')
+    if not width or not height:
+        raise InvalidImageException('Image has no pixels')
+    if max_pixels and width * height > max_pixels:
+        raise InvalidImageException('Image of %ix%i pixels exceeds the limit of %i pixels' % (width, height, max_pixels))
+    return image_format, width, height
+
+
+def check_header(buffer, max_pixels=None):
+    """
+    Check the start of an image that is still being received
+
+    Only the first HEADER_BYTES are read, so checking after every chunk does
+    not copy the whole image each time.
+
+    :param BytesIO buffer:  Bytes received so far
+    :param int max_pixels:  Maximum width * height; None for no limit
+    :return bool:  True if the header is acceptable; False if more bytes are needed
+    :raises InvalidImageException:  If the image is not supported or too large, or its
+                                    dimensions are not in the first HEADER_BYTES
+    """
+    with buffer.getbuffer() as view:
+        header = bytes(view[:HEADER_BYTES])
+    if sniff_image(header)[1] is None:
+        if len(header) >= HEADER_BYTES:
+            raise InvalidImageException('Image dimensions not found in the first %i bytes' % HEADER_BYTES)
+        return False
+    validate_image(header, max_pixels)
+    return True
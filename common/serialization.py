@@ -0,0 +1,137 @@
+"""
+Serialization of OCR results at different levels of detail
+"""
+import gzip
+import json
+
+import numpy as np
+
+# Output levels, from least to most detail
+TEXT = 'text'  # simplified_text only
+BOXES = 'boxes'  # simplified_text and compact word boxes
+FULL = 'full'  # simplified_text, boxes and raw model output as nested arrays
+LEGACY = 'legacy'  # simplified_text and raw model output as a JSON string (original API)
+OUTPUT_LEVELS = (TEXT, BOXES, FULL, LEGACY)
+
+# Body encodings
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+
+def json_default(value):
+    """
+    Convert NumPy values for `json.dumps`; only called for objects the C
+    encoder does not handle itself
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('Object of type %s is not JSON serializable' % type(value).__name__)
+
+
+def dumps(data):
+    """
+    JSON encode data that may contain NumPy arrays and values
+    """
+    return json.dumps(data, default=json_default, separators=(',', ':'))
+
+
+def compact_boxes(texts, boxes, scores=None):
+    """
+    Convert word boxes in bulk to a compact columnar structure
+
+    :param list texts:  Recognized text per box
+    :param boxes:  Array like of shape (N, points, 2)
+    :param scores:  Optional confidence per box
+    :return dict:  `text`, `boxes` as flat integer [x1, y1, x2, y2, ...] lists and `scores`
+    """
+    boxes = np.asarray(boxes, dtype=float)
+    return {'text': list(texts),
+            'boxes': np.rint(boxes).astype(int).reshape(len(boxes), -1).tolist() if len(boxes) else [],
+            'scores': np.round(np.asarray(scores, dtype=float), 4).tolist() if scores is not None else None}
+
+
+def parse_regions(regions):
+    """
+    Convert text regions given by a client to an array of boxes
+
+    :param list regions:  Rectangles as [x1, y1, x2, y2], or quadrilaterals as
+                          [x1, y1, ..., x4, y4] or [[x1, y1], ..., [x4, y4]]
+    :return np.ndarray:  Boxes of shape (N, 4, 2) with clockwise corners starting top left
+    :raises ValueError:  If a region is not in one of these forms
+    """
+    if not isinstance(regions, (list, tuple, np.ndarray)):
+        raise ValueError('Regions must be a list of boxes')
+    boxes = []
+    for region in regions:
+        try:
+            points = np.asarray(region, dtype=float).reshape(-1)
+        except (TypeError, ValueError):
+            raise ValueError('Region %s is not a list of numbers' % str(region))
+        if len(points) == 4:
+            x1, y1, x2, y2 = points
+            points = np.array([x1, y1, x2, y1, x2, y2, x1, y2])
+        if len(points) != 8 or not np.isfinite(points).all():
+            raise ValueError('Region %s must have 4 or 8 coordinates' % str(region))
+        boxes.append(points.reshape(4, 2))
+    return np.array(boxes, dtype=float).reshape(len(boxes), 4, 2)
+
+
+def prepare_result(result, output_level=LEGACY, logger=None):
+    """
+    Reduce a result from ImageTextDetector to the requested level of detail
+
+    :param dict result:  Result dictionary
+    :param str output_level:  One of OUTPUT_LEVELS
+    :param logger:  Used to report raw output that cannot be serialized
+    :return dict:  New result dictionary
+    """
+    if output_level not in OUTPUT_LEVELS:
+        raise ValueError('Output level must be one of %s' % ', '.join(OUTPUT_LEVELS))
+
+    prepared = dict(result)
+    if output_level in (TEXT, LEGACY):
+        prepared.pop('boxes', None)
+    if output_level in (TEXT, BOXES):
+        prepared.pop('raw_output', None)
+
+    if output_level == LEGACY and 'raw_output' in prepared:
+        # Check that raw_output is a jsonifable object
+        try:
+            prepared['raw_output'] = json.dumps(prepared['raw_output'], default=json_default)
+        except TypeError as e:
+            if logger:
+                logger.warning('Model %s returning non JSON serializable objects: %s' % (result.get('model_type'), str(e)))
+            del prepared['raw_output']
+    if 'frames' in prepared:
+        # Per frame results of animated images
+        prepared['frames'] = [prepare_result(frame, output_level, logger) for frame in prepared['frames']]
+    return prepared
+
+
+def encode(data, encoding=JSON, compress=False):
+    """
+    Encode a response body
+
+    :param data:  Data to encode
+    :param str encoding:  `json` or `msgpack` (requires the msgpack package)
+    :param bool compress:  Gzip the encoded body
+    :return tuple:  Encoded bytes and their mimetype
+    """
+    if encoding == MSGPACK:
+        try:
+            import msgpack
+        except ImportError:
+            raise ValueError('msgpack encoding is not available; install the msgpack package')
+        body = msgpack.packb(data, default=json_default)
+        mimetype = 'application/msgpack'
+    elif encoding == JSON:
+        body = dumps(data).encode('utf-8')
+        mimetype = 'application/json'
+    else:
+        raise ValueError('Encoding must be json or msgpack')
+
+    if compress:
+        body = gzip.compress(body, compresslevel=5)
+    return body, mimetype
@@ -0,0 +1,41 @@
+"""
+Deterministic synthetic text images for warming up and benchmarking models
+"""
+import random
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+WORDS = ['the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog', 'text', 'image', 'server',
+         'digital', 'methods', 'meme', 'caption', 'reply', 'share', 'post', 'viral', 'news']
+
+
+def text_image(width=640, height=480, lines=4, words_per_line=5, seed=0, font_size=None):
+    """
+    Draw lines of random words in black on a white background
+
+    :param int width:  Image width
+    :param int height:  Image height
+    :param int lines:  Number of lines of text
+    :param int words_per_line:  Number of words per line
+    :param int seed:  Seed for the words chosen; the same arguments always give the same image
+    :param int font_size:  Font size; by default lines fill the height of the image
+    :return tuple:  RGB image as an array of shape (height, width, 3) and the text drawn
+    """
+    generator = random.Random(seed)
+    line_height = height // max(lines + 1, 2)
+    font_size = font_size or max(10, int(line_height * .6))
+    try:
+        font = ImageFont.load_default(size=font_size)
+    except TypeError:
+        # Pillow < 10.1 has a single size bitmap default font
+        font = ImageFont.load_default()
+
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    text = []
+    for line in range(lines):
+        words = [generator.choice(WORDS) for _ in range(words_per_line)]
+        draw.text((max(5, width // 20), line_height // 2 + line * line_height), ' '.join(words), fill='black', font=font)
+        text.append(' '.join(words))
+    return np.asarray(image), '\n'.join(text)
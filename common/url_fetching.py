@@ -0,0 +1,275 @@
+"""
+Concurrent downloading of images from URLs
+"""
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import PurePosixPath
+from urllib.parse import urljoin, urlparse, unquote
+from collections import deque
+import ipaddress
+import socket
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+
+from common.exceptions import ImageDownloadException, InvalidImageException
+from common.image_validation import check_header, validate_image
+
+# Bytes read from the response at a time
+CHUNK_SIZE = 64 * 1024
+# Redirects followed per download; each is checked like the original URL
+MAX_REDIRECTS = 5
+
+
+def is_url(value):
+    """
+    Check whether an input is an http(s) URL rather than a file path
+    """
+    return isinstance(value, str) and value.lower().startswith(('http://', 'https://'))
+
+
+class UrlFetcher:
+    """
+    Image downloader
+
+    Downloads run in a thread pool over a shared connection pool, so
+    connections to the same host are reused. The number of simultaneous
+    connections per host is capped, and downloads are refused as soon as they
+    exceed the size or pixel limit.
+
+    Unless `allow_private` is set, only hosts that resolve to public addresses
+    are contacted, so clients cannot make the server request loopback, private
+    or link-local (cloud metadata) addresses. Redirects are checked the same
+    way at every hop. Failures are reported to clients without the details of
+    the error, which are only logged.
+    """
+    def __init__(self, logger, workers=8, per_host=4, timeout=10, max_bytes=16 * 1024 * 1024, max_pixels=None,
+                 allow_private=False):
+        """
+        :param logger:  Logger
+        :param int workers:  Number of simultaneous downloads
+        :param int per_host:  Maximum simultaneous connections to a single host
+        :param float timeout:  Seconds to wait when connecting and between received bytes
+        :param int max_bytes:  Largest image accepted
+        :param int max_pixels:  Largest width * height accepted; None for no limit
+        :param bool allow_private:  Also download from hosts with non-public addresses; only for
+                                    trusted input, such as the command line
+        """
+        self.log = logger
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.allow_private = allow_private
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ocr-url-fetch')
+
+        self._host_limits = {}
+        self._host_lock = threading.Lock()
+
+    def host_limit(self, host):
+        """
+        Semaphore limiting the connections to a host
+        """
+        with self._host_lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_limits[host]
+
+    def fetch(self, url):
+        """
+        Download an image
+
+        :param str url:  http(s) URL of the image
+        :return FileStorage:  The downloaded image
+        :raises ImageDownloadException:  If the image could not be downloaded
+        :raises InvalidImageException:  If the download is not an acceptable image
+        """
+        if not is_url(url):
+            raise ImageDownloadException('Not an http(s) URL: %s' % url)
+        host = urlparse(url).netloc
+
+        with self.host_limit(host):
+            try:
+                with self.open_url(url) as response:
+                    length = response.headers.get('Content-Length')
+                    if length and length.isdigit() and int(length) > self.max_bytes:
+                        raise InvalidImageException('Image exceeds %i bytes' % self.max_bytes)
+
+                    buffer = BytesIO()
+                    header_checked = False
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        buffer.write(chunk)
+                        if buffer.tell() > self.max_bytes:
+                            raise InvalidImageException('Image exceeds %i bytes' % self.max_bytes)
+                        if not header_checked:
+                            # Stop downloading as soon as the image is known to be too large
+                            header_checked = check_header(buffer, self.max_pixels)
+            except requests.HTTPError as e:
+                raise ImageDownloadException('Unable to download %s: HTTP status %i' % (url, e.response.status_code))
+            except requests.RequestException as e:
+                # Connection errors would tell clients which internal hosts and ports exist
+                self.log.warning('Unable to download %s: %s' % (url, str(e)))
+                raise ImageDownloadException('Unable to download %s' % url)
+
+        image_format, _, _ = validate_image(buffer.getvalue(), self.max_pixels)
+        buffer.seek(0)
+        return FileStorage(stream=buffer, filename=self.url_filename(url, image_format),
+                           content_type='image/%s' % image_format)
+
+    def open_url(self, url):
+        """
+        Request a URL, following redirects only to allowed hosts
+
+        :param str url:  http(s) URL
+        :return requests.Response:  Streamed response with a successful status
+        :raises ImageDownloadException:  If the URL or a redirect points to a host that is not allowed
+        :raises requests.RequestException:  If the request failed
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            self.check_host(url)
+            response = self.session.get(url, stream=True, timeout=self.timeout, allow_redirects=False)
+            if not response.is_redirect:
+                try:
+                    response.raise_for_status()
+                except requests.HTTPError:
+                    response.close()
+                    raise
+                return response
+            response.close()
+            url = urljoin(url, response.headers['Location'])
+            if not is_url(url):
+                raise ImageDownloadException('Redirected to a URL that is not http(s)')
+        raise ImageDownloadException('Too many redirects')
+
+    def check_host(self, url):
+        """
+        Check that the host of a URL only resolves to public addresses
+
+        The host is resolved again when connecting, so a host that changes its
+        DNS records in between is not stopped; restrict outgoing traffic at
+        the network level where that matters.
+
+        :param str url:  http(s) URL
+        :raises ImageDownloadException:  If the host does not resolve or has a non-public address
+        """
+        if self.allow_private:
+            return
+        parsed = urlparse(url)
+        try:
+            addresses = {info[4][0] for info in socket.getaddrinfo(parsed.hostname, parsed.port or None,
+                                                                   proto=socket.IPPROTO_TCP)}
+        except (socket.gaierror, UnicodeError, TypeError):
+            raise ImageDownloadException('Unable to download %s' % url)
+        for address in addresses:
+            # Strip the scope of link-local IPv6 addresses
+            address = ipaddress.ip_address(address.split('%')[0])
+            if getattr(address, 'ipv4_mapped', None):
+                address = address.ipv4_mapped
+            if not address.is_global or address.is_multicast:
+                self.log.warning('Refusing to download %s: %s is not a public address' % (url, address))
+                raise ImageDownloadException('Unable to download %s: host not allowed' % url)
+
+    def fetch_all(self, urls, prefetch=None):
+        """
+        Download images concurrently, yielding them in order
+
+        Downloads continue in the background while the caller handles the
+        images already yielded; at most `prefetch` downloads are held at once.
+
+        :param list urls:  URLs to download
+        :param int prefetch:  Maximum downloads in progress or waiting to be
+                              taken; defaults to twice the number of workers
+        :return:  Generator of (url, FileStorage or the exception raised) tuples
+        """
+        prefetch = prefetch or self.workers * 2
+        urls = iter(urls)
+        pending = deque()
+        try:
+            for url in urls:
+                pending.append((url, self.executor.submit(self.fetch, url)))
+                if len(pending) >= prefetch:
+                    break
+            while pending:
+                url, future = pending.popleft()
+                next_url = next(urls, None)
+                if next_url is not None:
+                    pending.append((next_url, self.executor.submit(self.fetch, next_url)))
+                try:
+                    yield url, future.result()
+                except (ImageDownloadException, InvalidImageException) as e:
+                    self.log.warning('%s: %s' % (url, str(e)))
+                    yield url, e
+        finally:
+            # Generator closed early
+            for _, future in pending:
+                future.cancel()
+
+    def process_urls(self, detector, urls, model_type, batch_size=None, **options):
+        """
+        Download images and run them through a detector, downloading the
+        next images while the current batch is being processed
+
+        :param ImageTextDetector detector:  Detector to process images with
+        :param list urls:  Image URLs
+        :param str model_type:  Model to use
+        :param int batch_size:  Images processed at once; defaults to the detector's batch size
+        :param options:  Keyword arguments passed on to `ImageTextDetector.process_images`
+        :return:  Generator of lists of results, in the order of `urls`
+        """
+        batch_size = batch_size or detector.batch_size
+        batch = []
+        for url, image in self.fetch_all(urls, prefetch=max(self.workers, batch_size) * 2):
+            batch.append((url, image))
+            if len(batch) >= batch_size:
+                yield self._process_batch(detector, batch, model_type, options)
+                batch = []
+        if batch:
+            yield self._process_batch(detector, batch, model_type, options)
+
+    @staticmethod
+    def _process_batch(detector, batch, model_type, options):
+        """
+        Process the downloaded images of a batch, with an error result for
+        each failed download
+        """
+        downloaded = [image for _, image in batch if isinstance(image, FileStorage)]
+        annotations = iter(detector.process_images(downloaded, model_type, **options) if downloaded else [])
+
+        results = []
+        for url, image in batch:
+            if isinstance(image, FileStorage):
+                result = next(annotations)
+            else:
+                result = {'filename': UrlFetcher.url_filename(url), 'model_type': model_type,
+                          'success': False, 'error': str(image)}
+            result['url'] = url
+            results.append(result)
+        return results
+
+    @staticmethod
+    def url_filename(url, image_format=None):
+        """
+        Filename for a downloaded image, with an extension matching its format
+        """
+        filename = secure_filename(unquote(PurePosixPath(urlparse(url).path).name)) or 'download'
+        if image_format:
+            extensions = ('.jpg', '.jpeg') if image_format == 'jpeg' else ('.%s' % image_format,)
+            if not filename.lower().endswith(extensions):
+                filename += extensions[0]
+        return filename
+
+    def close(self):
+        """
+        Stop the download threads and close pooled connections
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
@@ -0,0 +1,24 @@
+"""
+Gunicorn settings; read automatically when gunicorn is started in this directory
+
+With PRELOAD_BEFORE_FORK in config.yml, the app and its model weights are
+loaded once in the master process and shared copy-on-write by all workers.
+Each worker then runs its own warm-up inference after the fork, as inference
+threads of the models do not survive forking.
+
+config.yml is read directly rather than through the `server` package, as
+importing that creates the detector and starts its threads; without
+PRELOAD_BEFORE_FORK this must only happen in the workers.
+"""
+import yaml
+
+with open('config.yml') as file:
+    config_data = yaml.safe_load(file) or {}
+
+preload_app = bool(config_data.get('PRELOAD_BEFORE_FORK', False))
+
+
+def post_fork(server, worker):
+    if preload_app:
+        from server import app, detector
+        detector.preload(app.config['PRELOAD_MODELS'], background=config_data.get('PRELOAD_IN_BACKGROUND', True))
@@ -1,12 +1,16 @@
 import argparse
 import logging
 
+from ocr_detection.backends import BACKENDS, get_backend
+
+
 def parse_args():
     """
     Parse command line arguments
     """
     cli = argparse.ArgumentParser()
-    cli.add_argument("--models", "-m", nargs="+", type=str, help="Models to download.")
+    cli.add_argument("--models", "-m", nargs="+", type=str, help="Models to download (%s)." % ", ".join(BACKENDS))
+    cli.add_argument("--lang", default="en", help="Language of multilingual models such as paddle_ocr.")
 
     return cli.parse_args()
 
@@ -15,14 +19,15 @@ if __name__ == "__main__":
     args = parse_args()
     if args.models:
         for model in args.models:
-            if model == "keras_ocr":
-                from ocr_detection.keras_ocr_model import KerasOCRPipeline
-                KerasOCRPipeline(logging)
-            elif model == "paddle_ocr":
-                from ocr_detection.paddle_ocr_model import PaddlesOCRPipeline
-                PaddlesOCRPipeline(logging)
-            else:
+            backend = get_backend(model)
+            if backend is None:
                 print(f"Invalid model: {model}")
+                continue
+            try:
+                backend.load(logging, args.lang if backend.multilingual else backend.languages[0])
+            except ValueError as e:
+                # e.g. paddle_ocr_cpu, whose quantized models are downloaded by hand and set in config.yml
+                print(f"Skipping {model}: {e}")
         exit(0)
     else:
         print("Must specify --models.")
@@ -0,0 +1,132 @@
+"""
+Registry of OCR model backends and their capabilities
+"""
+__author__ = "Dale Wahl"
+__credits__ = ["Dale Wahl"]
+__maintainer__ = "Dale Wahl"
+__email__ = "4cat@oilab.eu"
+
+# Registered backends by model type
+BACKENDS = {}
+
+# Modes of ImageTextDetector that all bundled backends support
+ALL_MODES = ('full', 'detect', 'recognize')
+
+
+class Backend:
+    """
+    OCR Backend
+
+    Describes how to load a model and what it can do. Models are only
+    imported when first loaded.
+    """
+    def __init__(self, name, loader, description='', languages=None, modes=ALL_MODES, reads_files=False,
+                 language_option=None):
+        """
+        :param str name:  Model type used in requests
+        :param loader:  Callable taking a logger, a language and backend options, returning a pipeline
+        :param str description:  Short description
+        :param tuple languages:  Supported languages, the first being the default; None if any
+                                 language may be requested and models are loaded per language
+        :param tuple modes:  Supported ImageTextDetector modes
+        :param bool reads_files:  Whether the pipeline can read image files that could not be
+                                  decoded in memory itself
+        :param str language_option:  Backend option that sets the only supported language, for
+                                     backends whose model files are made for one language;
+                                     `languages` is used if the option is not set
+        """
+        self.name = name
+        self.loader = loader
+        self.description = description
+        self.languages = tuple(languages) if languages else None
+        self.modes = tuple(modes)
+        self.reads_files = reads_files
+        self.language_option = language_option
+
+    @property
+    def multilingual(self):
+        return self.languages is None and self.language_option is None
+
+    def supported_languages(self, options=None):
+        """
+        Languages that can be requested with the given backend options
+
+        :param dict options:  Backend specific options, e.g. from config.yml
+        :return tuple|None:  Languages, the first being the default; None if any
+        """
+        if self.language_option and (options or {}).get(self.language_option):
+            return (options[self.language_option],)
+        return self.languages
+
+    def load(self, logger, language, **options):
+        """
+        Load a pipeline for a language
+
+        :param logger:  Logger
+        :param str language:  Language
+        :param options:  Backend specific options, e.g. from config.yml
+        :return:  Loaded pipeline
+        """
+        if self.language_option:
+            # Passed on as the language instead
+            options.pop(self.language_option, None)
+        return self.loader(logger, language, **options)
+
+    def capabilities(self, options=None):
+        """
+        Description of the backend for clients
+
+        :param dict options:  Backend specific options, e.g. from config.yml
+        """
+        languages = self.supported_languages(options)
+        return {'description': self.description,
+                'languages': list(languages) if languages else 'any',
+                'modes': list(self.modes)}
+
+
+def register_backend(backend):
+    """
+    Make a backend available by its name, replacing any with the same name
+
+    :param Backend backend:  Backend to register
+    """
+    BACKENDS[backend.name] = backend
+
+
+def get_backend(name):
+    """
+    :param str name:  Model type
+    :return Backend|None:  Registered backend, or None if unknown
+    """
+    return BACKENDS.get(name)
+
+
+def _load_paddle_ocr(logger, lang, **options):
+    from ocr_detection.paddle_ocr_model import PaddlesOCRPipeline
+    return PaddlesOCRPipeline(logger, lang=lang, **options)
+
+
+def _load_paddle_ocr_cpu(logger, lang, **options):
+    # Without local model directories PaddleOCR would quietly download the regular float models
+    missing = [option for option in ('det_model_dir', 'rec_model_dir') if not options.get(option)]
+    if missing:
+        raise ValueError('paddle_ocr_cpu needs %s of the quantized models in BACKEND_OPTIONS' % ' and '.join(missing))
+    from ocr_detection.paddle_ocr_model import PaddlesOCRPipeline
+    # Quantized models only pay off with MKL-DNN
+    settings = {'use_gpu': False, 'enable_mkldnn': True}
+    settings.update(options)
+    return PaddlesOCRPipeline(logger, lang=lang, variant='cpu', **settings)
+
+
+def _load_keras_ocr(logger, lang, **options):
+    from ocr_detection.keras_ocr_model import KerasOCRPipeline
+    return KerasOCRPipeline(logger, **options)
+
+
+register_backend(Backend('paddle_ocr', _load_paddle_ocr, description='PaddleOCR', reads_files=True))
+# The recognition model and its character dictionary are made for one language, set with the `lang` option
+register_backend(Backend('paddle_ocr_cpu', _load_paddle_ocr_cpu, reads_files=True, languages=('en',),
+                         language_option='lang',
+                         description='PaddleOCR on CPU with MKL-DNN, for int8 quantized models loaded from local '
+                                     'directories'))
+register_backend(Backend('keras_ocr', _load_keras_ocr, description='keras-ocr (CRAFT and CRNN)', languages=('en',)))
@@ -0,0 +1,148 @@
+"""
+Collects images from concurrent requests into batches for a model
+"""
+from collections import Counter
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+from common.exceptions import ModelBusyException
+
+__author__ = "Dale Wahl"
+__credits__ = ["Dale Wahl"]
+__maintainer__ = "Dale Wahl"
+__email__ = "4cat@oilab.eu"
+
+
+class BatchScheduler:
+    """
+    Micro-batching scheduler
+
+    Images submitted by any thread are queued. A worker thread waits up to
+    `max_wait_ms` after the first queued image for more to arrive (or until
+    `max_batch_size` is reached), runs them through `model.predict` together
+    and hands each caller its own prediction. If the model fails on a batch,
+    its images are run again one by one, so only the callers of images that
+    fail on their own get the exception; if no replica was free, all callers
+    get that right away. With several workers, as many
+    batches run at the same time, e.g. one per replica in a ModelPool.
+    """
+    def __init__(self, model, logger, max_batch_size=8, max_wait_ms=5, workers=1):
+        """
+        :param model:  Pipeline or ModelPool with a `predict(images)` method
+        :param logger:  Logger
+        :param int max_batch_size:  Maximum number of images per model call
+        :param float max_wait_ms:  Time to wait for more images after the first
+        :param int workers:  Batches run at the same time
+        """
+        self.model = model
+        self.log = logger
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self.stopped = False
+        self._submit_lock = threading.Lock()
+
+        # Achieved batch sizes
+        self._lock = threading.Lock()
+        self.batch_sizes = Counter()
+
+        self._workers = [threading.Thread(target=self._run, name='ocr-batch-scheduler-%i' % number, daemon=True)
+                         for number in range(max(1, int(workers)))]
+        for worker in self._workers:
+            worker.start()
+
+    def predict(self, images):
+        """
+        Get predictions for images, batched with those of other callers
+
+        :param list images:  Preprocessed images
+        :return list:  Raw predictions, one per image
+        """
+        futures = []
+        with self._submit_lock:
+            if self.stopped:
+                return self.model.predict(images)
+            for image in images:
+                future = Future()
+                self._queue.put((image, future))
+                futures.append(future)
+        return [future.result() for future in futures]
+
+    def stop(self):
+        """
+        Finish queued images and stop the worker threads, so the model can be
+        released; later calls run the model directly
+        """
+        with self._submit_lock:
+            self.stopped = True
+            # One for each worker; queued images come first
+            for _ in self._workers:
+                self._queue.put(None)
+
+    def stats(self):
+        """
+        Counts of achieved batch sizes
+        """
+        with self._lock:
+            batches = sum(self.batch_sizes.values())
+            images = sum(size * count for size, count in self.batch_sizes.items())
+            return {'batches': batches,
+                    'images': images,
+                    'mean_batch_size': images / batches if batches else 0.0,
+                    'batch_sizes': dict(sorted(self.batch_sizes.items())),
+                    'max_batch_size': self.max_batch_size,
+                    'max_wait_ms': self.max_wait * 1000}
+
+    def _run(self):
+        """
+        Collect and run batches until stopped
+        """
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Stopped; nothing can be queued after this
+                    stopping = True
+                    break
+                batch.append(item)
+
+            with self._lock:
+                self.batch_sizes[len(batch)] += 1
+
+            try:
+                predictions = self.model.predict([image for image, _ in batch])
+            except Exception as e:
+                if len(batch) == 1 or isinstance(e, ModelBusyException):
+                    # Waiting for a replica again per image would only delay the error
+                    for _, future in batch:
+                        future.set_exception(e)
+                    continue
+                self.log.warning('Batch of %i images failed, running them one by one: %s' % (len(batch), str(e)))
+                busy = None
+                for image, future in batch:
+                    if busy is not None:
+                        future.set_exception(busy)
+                        continue
+                    try:
+                        future.set_result(self.model.predict([image])[0])
+                    except ModelBusyException as e:
+                        busy = e
+                        future.set_exception(e)
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+
+            for (_, future), prediction in zip(batch, predictions):
+                future.set_result(prediction)
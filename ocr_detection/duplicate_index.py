@@ -0,0 +1,282 @@
+"""
+Perceptual hash index of OCR predictions for near-duplicate images
+"""
+from collections import OrderedDict
+import threading
+
+import numpy as np
+from PIL import Image, ImageFilter, ImageOps
+
+from common.image_loading import open_image
+
+__author__ = "Dale Wahl"
+__credits__ = ["Dale Wahl"]
+__maintainer__ = "Dale Wahl"
+__email__ = "4cat@oilab.eu"
+
+# EXIF orientations that rotate the image by 90 degrees
+ROTATED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def dhash(image, hash_size=16, thumbnail_size=None):
+    """
+    Difference hash of an image: whether each pixel of a small grayscale
+    thumbnail is brighter than its left neighbour
+
+    The hash survives re-encoding, recompression and resizing. JPEGs are only
+    decoded at the smallest DCT scale that covers the thumbnails; the text
+    thumbnail is taken from at least four times its size, as coarser scales
+    blur strokes differently than downscaling does.
+
+    :param PIL.Image.Image image:  Image from `open_image`, not yet decoded
+    :param int hash_size:  Thumbnail height; the hash has hash_size ** 2 bits
+    :param int thumbnail_size:  If set, also return the fine detail of a grayscale thumbnail
+                                of this width and height, to compare the text of images with
+    :return tuple:  Hash as an integer, the (width, height) of the image after EXIF
+                    rotation and the thumbnail detail (None if not requested)
+    """
+    width, height = image.size
+    if image.getexif().get(0x0112) in ROTATED_ORIENTATIONS:
+        width, height = height, width
+
+    if image.format == 'JPEG':
+        draft_size = max(hash_size, thumbnail_size or 0) * 4
+        image.draft('L', (draft_size, draft_size))
+    image = ImageOps.exif_transpose(image).convert('L')
+    small = np.asarray(image.resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    detail = None
+    if thumbnail_size:
+        # Subtract a blurred copy, leaving strokes rather than the background
+        thumbnail = image.resize((thumbnail_size, thumbnail_size), Image.BOX)
+        detail = (np.asarray(thumbnail, dtype=np.int16)
+                  - np.asarray(thumbnail.filter(ImageFilter.GaussianBlur(1)), dtype=np.int16))
+    return int.from_bytes(bits.tobytes(), 'big'), (width, height), detail
+
+
+def text_mask(boxes, size, shape):
+    """
+    Pixels of a thumbnail covered by the bounding rectangles of text boxes
+
+    :param np.ndarray boxes:  Boxes of shape (N, points, 2), in image coordinates
+    :param tuple size:  (width, height) of the image
+    :param tuple shape:  (height, width) of the thumbnail
+    :return np.ndarray:  Boolean mask of the thumbnail's shape
+    """
+    mask = np.zeros(shape, dtype=bool)
+    scale = np.array([shape[1] / max(size[0], 1), shape[0] / max(size[1], 1)])
+    for box in np.asarray(boxes, dtype=float).reshape(-1, 4, 2) * scale:
+        left, top = np.floor(box.min(axis=0)).astype(int)
+        right, bottom = np.ceil(box.max(axis=0)).astype(int)
+        mask[max(top, 0):max(bottom, top + 1), max(left, 0):max(right, left + 1)] = True
+    return mask
+
+
+def text_difference(pixels, stored_pixels):
+    """
+    How differently two images vary where the stored one had text
+
+    The hash barely sees text, so a meme template with another caption can
+    hash as a near-duplicate; the thumbnail detail under the stored
+    prediction's boxes tells them apart. It is compared by correlation,
+    which ignores the contrast shifts of recompression.
+
+    :param np.ndarray pixels:  Thumbnail detail of the new image within the stored image's `text_mask`
+    :param np.ndarray stored_pixels:  Thumbnail detail of the stored image within the same mask
+    :return float:  One minus the correlation of the pixels: 0 for the same text, 1 or more for unrelated pixels
+    """
+    first = pixels.astype(np.float32)
+    second = stored_pixels.astype(np.float32)
+    first -= first.mean()
+    second -= second.mean()
+    norm = np.sqrt((first * first).sum() * (second * second).sum())
+    if not norm:
+        # Flat regions only match each other
+        return 0.0 if not first.any() and not second.any() else 1.0
+    return float(1 - (first * second).sum() / norm)
+
+
+def hamming_distance(first, second):
+    """
+    Number of differing bits of two hashes
+    """
+    return bin(first ^ second).count('1')
+
+
+class DuplicateIndex:
+    """
+    Near-duplicate Index
+
+    Keeps the raw predictions of recently processed images by their perceptual
+    hash, so a re-encoded or resized copy of an image can reuse them.
+
+    Lookups use multi-index hashing: the hash is split into
+    `max_distance + 1` chunks, and any hash within `max_distance` bits must
+    match at least one chunk exactly. Only the entries sharing a chunk are
+    compared, so a lookup does not scan the whole index.
+
+    Matches are then verified on the detail of a grayscale thumbnail,
+    comparing only the pixels under the stored prediction's text boxes, so the
+    same template with a different caption is not taken for a duplicate. Only
+    those pixels are kept with each entry. Predictions without text cannot be
+    verified this way and are not indexed; the text pre-filter is the cheap
+    path for such images.
+    """
+    def __init__(self, logger, max_distance=4, max_size=10000, hash_size=16, max_aspect_difference=0.05,
+                 thumbnail_size=128, max_text_difference=0.2):
+        """
+        :param logger:  Logger
+        :param int max_distance:  Largest Hamming distance at which images count as duplicates
+        :param int max_size:  Maximum number of images kept; least recently used are dropped. Each keeps
+                              up to 2 * `thumbnail_size` ** 2 bytes of thumbnail pixels.
+        :param int hash_size:  Passed on to `dhash`
+        :param float max_aspect_difference:  Largest relative difference in aspect ratio of duplicates;
+                                             crops of an image are not duplicates
+        :param int thumbnail_size:  Width and height of the thumbnails text is compared on; captions
+                                    need a few thumbnail pixels of height to be told apart
+        :param float max_text_difference:  Largest `text_difference` of duplicates; recompressed and
+                                            resized copies mostly score below 0.1, another caption
+                                            0.2 or more. Rejected copies only cost a model run.
+        """
+        self.log = logger
+        self.max_distance = max(0, int(max_distance))
+        self.max_size = max(1, int(max_size))
+        self.hash_size = hash_size
+        self.max_aspect_difference = max_aspect_difference
+        self.thumbnail_size = thumbnail_size
+        self.max_text_difference = max_text_difference
+
+        hash_bits = hash_size * hash_size
+        chunk_count = min(self.max_distance + 1, hash_bits)
+        self.chunk_bits = -(-hash_bits // chunk_count)
+        self.chunk_count = -(-hash_bits // self.chunk_bits)
+
+        # entry ID -> (options, hash, size, prediction, packed text mask, thumbnail detail within it),
+        # least recently used first
+        self._entries = OrderedDict()
+        # (options, chunk number, chunk value) -> entry IDs
+        self._chunks = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        # Matches of the hash rejected because their text differs
+        self.rejected = 0
+
+    def image_hash(self, image_file):
+        """
+        Hash an image for `lookup` and `add`
+
+        Animated images are not indexed, as their results may combine several
+        frames.
+
+        :param image_file:  Local file path, requests file stream or raw bytes
+        :return tuple|None:  Hash, (width, height) and thumbnail detail of the image; None if it is animated
+        """
+        image = open_image(image_file)
+        if getattr(image, 'n_frames', 1) > 1:
+            return None
+        return dhash(image, self.hash_size, self.thumbnail_size)
+
+    def lookup(self, image_hash, size, thumbnail, options):
+        """
+        Find the closest indexed image within `max_distance` whose text regions match
+
+        :param int image_hash:  Hash from `image_hash`
+        :param tuple size:  (width, height) of the image
+        :param np.ndarray thumbnail:  Thumbnail detail from `image_hash`
+        :param str options:  Model and parameters the prediction must have been made with
+        :return tuple|None:  Stored prediction, the (x, y) scale from the stored image to
+                             this one and the Hamming distance; None if there is no match
+        """
+        matches = []
+        with self._lock:
+            if self.chunk_count > self.max_distance:
+                candidates = set()
+                for key in self._chunk_keys(image_hash, options):
+                    candidates.update(self._chunks.get(key, ()))
+            else:
+                # Chunks too small to guarantee a shared chunk; compare with everything
+                candidates = [entry_id for entry_id, entry in self._entries.items() if entry[0] == options]
+            for entry_id in candidates:
+                _, stored_hash, stored_size, prediction, mask, pixels = self._entries[entry_id]
+                distance = hamming_distance(image_hash, stored_hash)
+                if distance > self.max_distance or not self._similar_aspect(size, stored_size):
+                    continue
+                matches.append((distance, entry_id, stored_size, prediction, mask, pixels))
+
+            best = None
+            for match in sorted(matches, key=lambda match: match[:2]):
+                mask = np.unpackbits(match[4], count=thumbnail.size).reshape(thumbnail.shape).astype(bool)
+                if text_difference(thumbnail[mask], match[5]) <= self.max_text_difference:
+                    best = match[:4]
+                    break
+                self.rejected += 1
+
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            distance, entry_id, stored_size, prediction = best
+            self._entries.move_to_end(entry_id)
+
+        scale = (size[0] / stored_size[0], size[1] / stored_size[1])
+        return prediction, scale, distance
+
+    def add(self, image_hash, size, thumbnail, options, prediction, boxes):
+        """
+        Index the raw prediction of an image
+
+        :param int image_hash:  Hash from `image_hash`
+        :param tuple size:  (width, height) of the image; the prediction must be in these coordinates
+        :param np.ndarray thumbnail:  Thumbnail detail from `image_hash`
+        :param str options:  Model and parameters the prediction was made with
+        :param prediction:  Raw model prediction
+        :param np.ndarray boxes:  Text boxes of the prediction, of shape (N, points, 2); without
+                                  any the prediction is not indexed
+        """
+        mask = text_mask(boxes, size, thumbnail.shape)
+        if not mask.any():
+            return
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (options, image_hash, tuple(size), prediction, np.packbits(mask),
+                                       thumbnail[mask])
+            for key in self._chunk_keys(image_hash, options):
+                self._chunks.setdefault(key, set()).add(entry_id)
+
+            while len(self._entries) > self.max_size:
+                evicted_id, (evicted_options, evicted_hash, *_) = self._entries.popitem(last=False)
+                for key in self._chunk_keys(evicted_hash, evicted_options):
+                    entry_ids = self._chunks.get(key)
+                    if entry_ids is not None:
+                        entry_ids.discard(evicted_id)
+                        if not entry_ids:
+                            del self._chunks[key]
+
+    def stats(self):
+        """
+        Hit and miss counters
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'rejected': self.rejected,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': len(self._entries),
+                    'max_size': self.max_size,
+                    'max_distance': self.max_distance}
+
+    def _chunk_keys(self, image_hash, options):
+        mask = (1 << self.chunk_bits) - 1
+        return [(options, chunk, (image_hash >> (chunk * self.chunk_bits)) & mask)
+                for chunk in range(self.chunk_count)]
+
+    def _similar_aspect(self, size, stored_size):
+        aspect = size[0] / size[1] if size[1] else 0
+        stored_aspect = stored_size[0] / stored_size[1] if stored_size[1] else 0
+        return abs(aspect - stored_aspect) <= self.max_aspect_difference * max(aspect, stored_aspect)
@@ -1,10 +1,27 @@
 """
 Handles images and uses OCR models to detect and extract text
 """
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 import os
+import re
+import tempfile
+import threading
+import time
 
-from common.exceptions import TextDetectionException, OCRModelTypeNotAvailableException
-from common.helper_functions import get_image_filename
+import numpy as np
+
+from common.exceptions import TextDetectionException, OCRModelTypeNotAvailableException, ModelBusyException
+from common.helper_functions import get_image_filename, read_image_bytes
+from common.serialization import parse_regions
+from ocr_detection.backends import BACKENDS, get_backend
+from ocr_detection.batch_scheduler import BatchScheduler
+from ocr_detection.metrics import Metrics
+from ocr_detection.model_pool import ModelPool
+from ocr_detection.result_cache import ResultCache
+from ocr_detection.single_flight import SingleFlight
+from ocr_detection.text_prefilter import TextPrefilter
+from ocr_detection.tiling import split_tiles, deduplicate_boxes
 
 __author__ = "Dale Wahl"
 __credits__ = ["Dale Wahl"]
@@ -18,66 +35,862 @@ class ImageTextDetector:
 
     Handles text detection for different loaded models.
     """
-    def __init__(self, logger, temp_image_dir=None):
+    # Modes: detect and recognize text, only find text boxes, or only read given regions
+    FULL = 'full'
+    DETECT = 'detect'
+    RECOGNIZE = 'recognize'
+    MODES = (FULL, DETECT, RECOGNIZE)
+
+    def __init__(self, logger, temp_image_dir=None, batch_size=8, cache=None, batch_window_ms=0, max_side=None,
+                 paddle_lang='en', max_paddle_languages=2, max_frames=None, duplicate_index=None, tile_size=None,
+                 tile_overlap=128, model_replicas=1, checkout_timeout=30, backend_options=None, text_prefilter=None,
+                 coalesce=True):
         self.log = logger
         self.temp_image_dir = temp_image_dir
+        # Default limit of the longest side of images sent to a model; None for no limit
+        self.max_side = max_side
+        # Default number of frames sampled from animated images; None to only read the first frame
+        self.max_frames = max_frames
+        # Default size of tiles that larger images are split into; None to never split images
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        # Maximum number of images sent through a model at once
+        self.batch_size = max(1, int(batch_size))
+        # Optional ResultCache; results are looked up before running any model
+        self.cache = cache
+        # Optional DuplicateIndex; predictions of near-duplicate images are reused
+        self.duplicate_index = duplicate_index
+        # Optional TextPrefilter; images that it finds no text in skip the models
+        self.text_prefilter = text_prefilter
+        # Images being processed; concurrent calls with the same image and options wait for one result
+        self.in_flight = SingleFlight() if coalesce else None
+        # If set, images from concurrent calls are collected for this long and batched together
+        self.batch_window_ms = batch_window_ms
+        self.schedulers = {}
+        self._scheduler_lock = threading.Lock()
+        # Stage latencies, outcome counters and model load times
+        self.metrics = Metrics()
+
+        # Models that have run a warm-up inference, and errors while preloading
+        self.warm_models = set()
+        self.load_errors = {}
+        self._model_lock = threading.Lock()
 
-        # Load models
-        # We are loading here as it can be time consuming in general and, for the first run, needs to download models
-        self.keras_ocr = None
-        self.paddle_ocr = None
+        # Loaded models by (model type, language), least recently used first; see `backends` for what can be loaded
+        self.models = OrderedDict()
+        # Options per backend passed on when loading its models, e.g. paths of local model files
+        self.backend_options = backend_options or {}
+        self.paddle_lang = paddle_lang
+        self.max_paddle_languages = max(1, int(max_paddle_languages))
+        self._pool_lock = threading.Lock()
 
-    def get_model(self, model_type):
+        # Replicas per loaded model, by model signature; each replica runs one inference at a time
+        self.model_replicas = max(1, int(model_replicas))
+        self.checkout_timeout = checkout_timeout
+        self.model_pools = {}
+        # Calls using each model, by signature; a model unloaded while in use keeps its pool until
+        # the last of them is done, so its replicas stay exclusive
+        self._model_users = Counter()
+        self._retired = set()
+
+    def get_model(self, model_type, lang=None):
         """
         Select model
+
+        Models are looked up in the backend registry and (with their packages)
+        only imported and loaded on first use. Multilingual backends such as
+        PaddleOCR are loaded per language; once more than
+        `max_paddle_languages` languages of a backend are loaded, the least
+        recently used is dropped; calls that run the model use `lease_model`
+        instead, so it is not dropped while they do.
+
+        :param str model_type:  Model to use
+        :param str lang:  Language (e.g. `en`, `german`, `fr`, `japan`, `ch`); defaults to `paddle_lang`
+                          for multilingual backends and the only language of others
         """
-        if model_type == 'paddle_ocr':
-            if self.paddle_ocr is None:
-                from ocr_detection.paddle_ocr_model import PaddlesOCRPipeline
-                self.paddle_ocr = PaddlesOCRPipeline(self.log)
-            return self.paddle_ocr
-        if model_type == 'keras_ocr':
-            if self.keras_ocr is None:
-                from ocr_detection.keras_ocr_model import KerasOCRPipeline
-                self.keras_ocr = KerasOCRPipeline(self.log)
-            return self.keras_ocr
-        else:
+        backend = get_backend(model_type)
+        if backend is None:
             raise OCRModelTypeNotAvailableException('Model type "%s" not available' % model_type)
+        if backend.multilingual:
+            lang = lang or self.paddle_lang
+            if not re.fullmatch(r'[a-z_]+', lang):
+                raise OCRModelTypeNotAvailableException('Language "%s" not available' % lang)
+        else:
+            languages = backend.supported_languages(self.backend_options.get(model_type))
+            lang = lang or languages[0]
+            if lang not in languages:
+                raise OCRModelTypeNotAvailableException('Model type "%s" only supports %s' %
+                                                        (model_type, ', '.join(languages)))
+
+        with self._pool_lock:
+            if (model_type, lang) in self.models:
+                self.models.move_to_end((model_type, lang))
+                return self.models[(model_type, lang)]
+
+        # Only one thread loads a model
+        with self._model_lock:
+            return self._get_model(backend, lang)
+
+    def _get_model(self, backend, lang):
+        key = (backend.name, lang)
+        with self._pool_lock:
+            if key in self.models:
+                return self.models[key]
+
+        options = self.backend_options.get(backend.name) or {}
+        start = time.perf_counter()
+        try:
+            model = backend.load(self.log, lang, **options)
+        except (AssertionError, ValueError) as e:
+            # PaddleOCR asserts the language is supported; backends raise ValueError for missing options
+            raise OCRModelTypeNotAvailableException('Model type "%s" with language "%s" not available: %s' %
+                                                    (backend.name, lang, str(e)))
+        self.metrics.set_gauge('model_load_seconds', backend.name, time.perf_counter() - start)
+        self.add_pool(model, lambda: backend.load(self.log, lang, **options))
+
+        with self._pool_lock:
+            self.models[key] = model
+            evicted = []
+            if backend.multilingual:
+                languages = [loaded for loaded in self.models if loaded[0] == backend.name]
+                for evicted_key in languages[:max(0, len(languages) - self.max_paddle_languages)]:
+                    evicted.append((evicted_key, self.models.pop(evicted_key)))
+        for (model_type, evicted_lang), evicted_model in evicted:
+            self.log.info('Unloading %s language %s' % (model_type, evicted_lang))
+            self.unload(evicted_model)
+        return model
+
+    @contextmanager
+    def lease_model(self, model_type, lang=None):
+        """
+        Select a model, as with `get_model`, for the duration of a call; it is
+        not unloaded before the call is done
+
+        :param str model_type:  Model to use
+        :param str lang:  Language; see `get_model`
+        """
+        while True:
+            model = self.get_model(model_type, lang)
+            with self._pool_lock:
+                # Otherwise unloaded in between; load it again
+                if model.model_signature in self.model_pools:
+                    self._model_users[model.model_signature] += 1
+                    break
+        try:
+            yield model
+        finally:
+            self.release_model(model)
+
+    def release_model(self, model):
+        """
+        End a lease from `lease_model`, finishing the unloading of the model if
+        that waited for it
+        """
+        signature = model.model_signature
+        with self._pool_lock:
+            self._model_users[signature] -= 1
+            if self._model_users[signature] > 0:
+                return
+            del self._model_users[signature]
+            if signature not in self._retired:
+                return
+            self._retired.discard(signature)
+            self.model_pools.pop(signature, None)
+        self.stop_scheduler(model)
+
+    def unload(self, model):
+        """
+        Drop the replica pool and batch scheduler of a model that was evicted;
+        if calls still use it, once the last of them is done
+        """
+        with self._pool_lock:
+            if self._model_users[model.model_signature]:
+                self._retired.add(model.model_signature)
+                return
+            self.model_pools.pop(model.model_signature, None)
+        self.stop_scheduler(model)
+
+    def backends(self):
+        """
+        Registered backends and their capabilities
+        """
+        return {name: backend.capabilities(self.backend_options.get(name))
+                for name, backend in sorted(BACKENDS.items())}
+
+    def add_pool(self, model, factory):
+        """
+        Start the replica pool of a newly loaded model, with the model as its first replica
+
+        :param model:  Loaded pipeline
+        :param factory:  Callable that loads another replica of the same model
+        """
+        with self._pool_lock:
+            self.model_pools[model.model_signature] = ModelPool(factory, self.log, size=self.model_replicas,
+                                                                timeout=self.checkout_timeout, first=model)
+            # Loaded again while an earlier copy was waiting to be unloaded; its calls use the new pool
+            reloaded = model.model_signature in self._retired
+            self._retired.discard(model.model_signature)
+        if reloaded:
+            self.stop_scheduler(model)
+
+    def pool(self, model):
+        """
+        Replica pool of a model
+
+        :raises ModelBusyException:  If the model was unloaded, which only happens to models used
+                                     without `lease_model`
+        """
+        with self._pool_lock:
+            pool = self.model_pools.get(model.model_signature)
+        if pool is None:
+            raise ModelBusyException('Model was unloaded; try again later')
+        return pool
+
+    def checkout(self, model):
+        """
+        Use a replica of a model exclusively
 
-    def process_image(self, image_file, model_type, local=False):
+        :raises ModelBusyException:  If no replica became idle within `checkout_timeout`
+        """
+        return self.pool(model).checkout()
+
+    def pool_stats(self):
+        """
+        Replica counts and checkouts per model and language
+        """
+        with self._pool_lock:
+            pools = dict(self.model_pools)
+        return {signature: pool.stats() for signature, pool in pools.items()}
+
+    def preload(self, model_types, background=True, warm_up=True):
+        """
+        Load models and run a warm-up inference on each
+
+        :param list model_types:  Models to load
+        :param bool background:  Load in a background thread instead of blocking
+        :param bool warm_up:  Run the warm-up inference; without it, only the weights of all
+                              replicas are loaded, e.g. before forking worker processes
+        :return threading.Thread|None:  The loading thread if in the background
+        """
+        if not background:
+            self._preload(model_types, warm_up)
+            return None
+        thread = threading.Thread(target=self._preload, args=(model_types, warm_up), name='ocr-model-preload',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def _preload(self, model_types, warm_up=True):
+        for model_type in model_types:
+            try:
+                if warm_up:
+                    self.warm_up(model_type)
+                else:
+                    with self.lease_model(model_type) as model:
+                        self.pool(model).fill()
+            except Exception as e:
+                self.log.error('Unable to preload %s: %s' % (model_type, str(e)))
+                self.load_errors[model_type] = str(e)
+
+    def warm_up(self, model_type):
+        """
+        Load a model and run it once on a synthetic image, so the first request
+        does not pay for lazy initialisation
+        """
+        from common.synthetic_images import text_image
+
+        image, _ = text_image(width=320, height=160, lines=2, words_per_line=3)
+        start = time.perf_counter()
+        with self.lease_model(model_type) as model:
+            self.pool(model).warm_up([image])
+        self.metrics.set_gauge('warm_up_seconds', model_type, time.perf_counter() - start)
+        self.warm_models.add(model_type)
+        self.log.info('Model %s loaded and warmed up' % model_type)
+
+    def status(self):
+        """
+        Loaded and warmed up models
+        """
+        with self._pool_lock:
+            loaded = ['%s:%s' % (model_type, lang) if get_backend(model_type).multilingual else model_type
+                      for model_type, lang in self.models]
+        return {'loaded': sorted(loaded),
+                'warm': sorted(self.warm_models),
+                'errors': dict(self.load_errors)}
+
+    def process_image(self, image_file, model_type, local=False, use_cache=True, max_side=None, lang=None,
+                      max_frames=None, mode=FULL, regions=None, tile_size=None, prefilter=True):
         """
         Take image, return text!
 
         :param image_file:  Image file to process
         :param model_type:  Model to use
         :param local:  If True, image_file is a local file path; False, it is a requests file stream
+        :param use_cache:  If False, always run the model and do not store the result
+        :param int max_side:  Downscale so the longest side is at most this long; defaults to `self.max_side`
+        :param str lang:  Language of the text (PaddleOCR only)
+        :param int max_frames:  Frames sampled from animated images; defaults to `self.max_frames`
+        :param str mode:  One of MODES
+        :param list regions:  Boxes to recognize text in, if `mode` is `recognize`
+        :param int tile_size:  Split larger images into tiles of this size; defaults to `self.tile_size`
+        :param bool prefilter:  If False, do not skip images the text pre-filter finds no text in
+        """
+        return self.process_images([image_file], model_type, local=local, use_cache=use_cache, max_side=max_side,
+                                   lang=lang, max_frames=max_frames, mode=mode,
+                                   regions=[regions] if regions is not None else None, tile_size=tile_size,
+                                   prefilter=prefilter)[0]
+
+    def process_images(self, image_files, model_type, local=False, use_cache=True, max_side=None, lang=None,
+                       max_frames=None, mode=FULL, regions=None, tile_size=None, prefilter=True):
         """
-        filename = get_image_filename(image_file)
-        model = self.get_model(model_type)
-        results = {"filename": filename,
-                   'model_type': model_type}
+        Take several images, return text for each!
 
-        if model_type == 'paddle_ocr' and not local:
-            if self.temp_image_dir:
-                # Must download image first
-                image_file.save(os.path.join(self.temp_image_dir, filename))
-                image_file = os.path.join(self.temp_image_dir, filename)
-            else:
-                raise TextDetectionException('Paddle OCR requires a temporary image download folder to be set')
+        Images are preprocessed one by one and then sent through the model in
+        batches of at most `batch_size` images. Results are returned in the
+        same order as `image_files`.
 
+        :param list image_files:  Image files to process
+        :param model_type:  Model to use
+        :param local:  If True, image_files are local file paths; False, they are requests file streams
+        :param use_cache:  If False, always run the model and do not store the results
+        :param int max_side:  Downscale so the longest side is at most this long; defaults to `self.max_side`.
+                              Boxes are returned in the coordinates of the original image.
+        :param str lang:  Language of the text (PaddleOCR only); defaults to `paddle_lang`
+        :param int max_frames:  Sample up to this many frames of animated images, skipping
+                                duplicate frames, and merge their text with frame indices;
+                                defaults to `self.max_frames`. If not set, only the first
+                                frame is read.
+        :param str mode:  `full` to detect and recognize text; `detect` to only return the
+                          `text_regions` found, skipping the recognizer; `recognize` to only
+                          read the text in `regions`, skipping the detector
+        :param list regions:  Per image, the boxes to recognize text in (see
+                              `serialization.parse_regions`), in the coordinates of the
+                              original image; required if `mode` is `recognize`
+        :param int tile_size:  Split images with a side longer than this (after downscaling to
+                               `max_side`) into overlapping tiles of at most this size, which go
+                               through the model as a batch; boxes found twice in the overlaps
+                               are merged. Defaults to `self.tile_size`; not used in `recognize` mode.
+        :param bool prefilter:  If `text_prefilter` is set, images it finds no text in skip the
+                                model and get the result of an image without text, marked
+                                `prefiltered`; False to run the model on every image. Only
+                                used in `full` mode, for images that are not animated.
+        :return list:  One result dictionary per image
+        """
+        if mode not in self.MODES:
+            raise ValueError('Mode must be one of %s' % ', '.join(self.MODES))
+        if mode == self.RECOGNIZE:
+            if regions is None or len(regions) != len(image_files):
+                raise ValueError('Recognize mode requires regions for each image')
+            regions = [parse_regions(image_regions) for image_regions in regions]
+        else:
+            regions = None
+
+        backend = get_backend(model_type)
+        if backend is not None and mode not in backend.modes:
+            raise ValueError('Model type "%s" does not support %s mode' % (model_type, mode))
+        max_side = max_side or self.max_side
+        # Frames are only merged in full mode
+        max_frames = (max_frames or self.max_frames) if mode == self.FULL else None
+        # Regions are recognized on the whole image
+        tile_size = (tile_size or self.tile_size) if mode != self.RECOGNIZE else None
+        prefilter = prefilter and self.text_prefilter is not None and mode == self.FULL
+        with self.lease_model(model_type, lang) as model:
+            with self.metrics.in_flight(model_type), self.metrics.timer('process_images', model_type):
+                return self._process_images(model, model_type, image_files, local, use_cache, max_side, max_frames,
+                                            mode, regions, tile_size, prefilter)
+
+    def _process_images(self, model, model_type, image_files, local, use_cache, max_side, max_frames=None,
+                        mode=FULL, regions=None, tile_size=None, prefilter=False, coalesce=True):
+        results = [{"filename": get_image_filename(image_file),
+                    'model_type': model_type} for image_file in image_files]
+
+        # Model parameters that change its output
+        options = '%s:max_side=%s' % (model.model_signature, max_side)
+        if max_frames:
+            options += ':max_frames=%s' % max_frames
+        if mode != self.FULL:
+            options += ':mode=%s' % mode
+        if tile_size:
+            options += ':tile_size=%s:%s' % (tile_size, self.tile_overlap)
+        if prefilter:
+            options += ':prefilter=%s' % self.text_prefilter.signature
+        if mode == self.RECOGNIZE:
+            # Results depend on the regions as well
+            use_cache = False
+
+        # Keys of image contents and options, for the result cache and to coalesce identical images
+        image_keys = {}
+        coalesce = coalesce and self.in_flight is not None
+        if use_cache and (self.cache is not None or coalesce):
+            for index, image_file in enumerate(image_files):
+                try:
+                    image_bytes = read_image_bytes(image_file)
+                except OSError:
+                    # Leave it to preprocessing to report unreadable files
+                    continue
+                image_keys[index] = ResultCache.make_key(image_bytes, model_type, options)
+        cache_keys = image_keys if self.cache is not None else {}
+        # Images this call processes for concurrent calls as well, and those another call is processing
+        leading = {}
+        following = {}
+        # Perceptual hashes and sizes of images to add to the duplicate index
+        image_hashes = {}
+
+        # Files written to disk for models that could not decode them in memory
+        temp_files = []
         try:
-            image = model.preprocess_image(image_file)
-        except TextDetectionException as e:
-            annotations = {"success": False, "error": str(e)}
-            results.update(annotations)
-            return results
+            # Preprocess all images; failures are recorded and skipped
+            pending = []
+            # Predictions per frame of animated images, by image index
+            frame_predictions = {}
+            # Predictions per tile of large images, by image index
+            tile_predictions = {}
+            for index, image_file in enumerate(image_files):
+                if coalesce and index in image_keys:
+                    # The cache is checked after claiming, so a result published in between is not missed
+                    flight, leader = self.in_flight.claim(image_keys[index])
+                    if not leader:
+                        following[index] = flight
+                        continue
+                    leading[index] = image_keys[index]
+
+                if index in cache_keys:
+                    cached = self.cache.get(cache_keys[index])
+                    if cached is not None:
+                        self.log.debug('Using cached result for %s' % results[index]['filename'])
+                        results[index].update(cached)
+                        self.metrics.increment('cache_hit', model_type)
+                        continue
+
+                if self.duplicate_index is not None and use_cache and mode == self.FULL:
+                    if self.reuse_duplicate(model, model_type, index, image_file, options, results, cache_keys,
+                                            image_hashes):
+                        continue
+
+                try:
+                    with self.metrics.timer('preprocess_image', model_type):
+                        frames, frame_count = self.preprocess_frames(model, model_type, image_file, max_side, max_frames)
+                        if frame_count > 1:
+                            results[index]['frame_count'] = frame_count
+                            frame_predictions[index] = []
+                            pending.extend((index, image, scale, frame, None) for frame, image, scale in frames)
+                            duplicates = min(frame_count, max_frames) - len(frames)
+                            if duplicates > 0:
+                                self.metrics.increment('duplicate_frames', model_type, duplicates)
+                        else:
+                            image, scale = self.preprocess_image(model, model_type, image_file, local, temp_files,
+                                                                 max_side)
+                            if prefilter and not self.has_text(model, model_type, image):
+                                self.log.debug('No text found by pre-filter in %s' % results[index]['filename'])
+                                self.finish_result(model, model_type, index, results, cache_keys, prefiltered=True)
+                                continue
+                            shape = getattr(image, 'shape', None)
+                            if tile_size and shape and max(shape[:2]) > tile_size:
+                                tiles = split_tiles(image, tile_size, self.tile_overlap)
+                                tile_predictions[index] = []
+                                pending.extend((index, tile, scale, None, offset) for tile, offset in tiles)
+                                self.metrics.increment('tiles', model_type, len(tiles))
+                            else:
+                                pending.append((index, image, scale, None, None))
+                except TextDetectionException as e:
+                    results[index].update({"success": False, "error": str(e)})
+                    self.metrics.increment('failure', model_type)
+
+            # Similar sized images together means less padding within a batch
+            pending.sort(key=lambda item: self.image_area(item[1]))
+
+            # Images the model failed on; their other tiles and frames are skipped
+            failed = set()
+            for start in range(0, len(pending), self.batch_size):
+                batch = [item for item in pending[start:start + self.batch_size] if item[0] not in failed]
+                if not batch:
+                    continue
+                try:
+                    with self.metrics.timer('annotate_image', model_type):
+                        predictions = self.annotate(model, model_type, mode, batch, regions)
+                except ModelBusyException:
+                    raise
+                except Exception as e:
+                    predictions = self.annotate_singly(model, model_type, mode, batch, regions, e)
+
+                for (index, _, scale, frame, offset), prediction in zip(batch, predictions):
+                    if index in failed:
+                        continue
+                    if isinstance(prediction, Exception):
+                        self.fail_image(model_type, index, prediction, results)
+                        failed.add(index)
+                        continue
+                    if offset is not None:
+                        tile_predictions[index].append((offset, scale, prediction))
+                        continue
+                    if mode == self.DETECT:
+                        self.finish_detection(model_type, index, prediction * scale, results, cache_keys)
+                        continue
+                    if tuple(scale) != (1, 1):
+                        # Boxes in the coordinates of the original image
+                        prediction = model.transform_predictions(prediction, scale=scale)
+                    if frame is not None:
+                        frame_predictions[index].append((frame, prediction))
+                        continue
+                    if index in image_hashes:
+                        self.duplicate_index.add(*image_hashes[index], options, prediction,
+                                                  boxes=model.split_predictions(prediction)[1])
+                    self.finish_result(model, model_type, index, results, cache_keys, prediction=prediction)
+
+            for index, predictions in tile_predictions.items():
+                if index in failed:
+                    continue
+                with self.metrics.timer('merge_tiles', model_type):
+                    prediction = self.merge_tiles(model, mode, predictions)
+                if mode == self.DETECT:
+                    self.finish_detection(model_type, index, prediction, results, cache_keys)
+                    continue
+                if index in image_hashes:
+                    self.duplicate_index.add(*image_hashes[index], options, prediction,
+                                             boxes=model.split_predictions(prediction)[1])
+                self.finish_result(model, model_type, index, results, cache_keys, prediction=prediction)
+
+            for index, predictions in frame_predictions.items():
+                if index in failed:
+                    continue
+                predictions.sort(key=lambda item: item[0])
+                self.finish_result(model, model_type, index, results, cache_keys, frame_predictions=predictions)
+        finally:
+            # Release waiting calls, also if the model failed; they then process the image themselves
+            for index, key in leading.items():
+                self.in_flight.publish(key, {name: value for name, value in results[index].items()
+                                             if name not in ('filename', 'model_type')}
+                                       if 'success' in results[index] else None)
+            for temp_file in temp_files:
+                try:
+                    os.remove(temp_file)
+                except OSError as e:
+                    self.log.warning('Unable to remove temporary image %s: %s' % (temp_file, str(e)))
+
+        # Only wait for other calls once this call's own images are published, so calls waiting on each
+        # other's images cannot deadlock
+        retry = []
+        for index, flight in following.items():
+            shared = flight.wait()
+            if shared is None:
+                retry.append(index)
+                continue
+            self.log.debug('Using result of concurrent request for %s' % results[index]['filename'])
+            results[index].update(shared)
+            self.metrics.increment('coalesced', model_type)
+        if retry:
+            retried = self._process_images(model, model_type, [image_files[index] for index in retry], local,
+                                           use_cache, max_side, max_frames, mode,
+                                           [regions[index] for index in retry] if regions is not None else None,
+                                           tile_size, prefilter, coalesce=False)
+            for index, result in zip(retry, retried):
+                results[index].update(result)
+
+        return results
+
+    def annotate(self, model, model_type, mode, batch, regions=None):
+        """
+        Run a batch of preprocessed images, tiles or frames through the model
+
+        :param list batch:  (image index, image, scale, frame, tile offset) per item
+        :param list regions:  Regions per image index, in `recognize` mode
+        :return list:  One prediction per item
+        """
+        images = [image for _, image, _, _, _ in batch]
+        if mode == self.DETECT:
+            with self.checkout(model) as replica:
+                return replica.detect(images)
+        if mode == self.RECOGNIZE:
+            # Regions in the coordinates of the preprocessed images
+            with self.checkout(model) as replica:
+                return replica.recognize(images, [regions[index] / scale for index, _, scale, _, _ in batch])
+        return self.predict(model, model_type, images)
+
+    def annotate_singly(self, model, model_type, mode, batch, regions, error):
+        """
+        Run the items of a failed batch one at a time, so that an image the
+        model cannot handle does not fail the other images of the batch
+
+        :param list batch:  Items of the failed batch; see `annotate`
+        :param list regions:  Regions per image index, in `recognize` mode
+        :param Exception error:  Why the batch failed
+        :return list:  One prediction per item, or the exception for items that failed on their own
+        """
+        if len(batch) == 1:
+            return [error]
+        self.log.warning('Batch of %i images failed, retrying them one at a time: %s' % (len(batch), str(error)))
+        predictions = []
+        for item in batch:
+            try:
+                with self.metrics.timer('annotate_image', model_type):
+                    predictions.extend(self.annotate(model, model_type, mode, [item], regions))
+            except ModelBusyException:
+                raise
+            except Exception as e:
+                predictions.append(e)
+        return predictions
+
+    def fail_image(self, model_type, index, error, results):
+        """
+        Record that the model failed on an image; the result is not cached
+        """
+        self.log.error('Unable to process %s: %s' % (results[index]['filename'], str(error)))
+        if isinstance(error, TextDetectionException):
+            message = str(error)
+        else:
+            # Details are in the log
+            message = 'Unable to process image'
+        results[index].update({"success": False, "error": message})
+        self.metrics.increment('failure', model_type)
+
+    def finish_result(self, model, model_type, index, results, cache_keys, prediction=None, frame_predictions=None,
+                      prefiltered=False):
+        """
+        Format the prediction of an image, or the per frame predictions of an
+        animated image, into its result and cache it
+
+        If `prefiltered`, the image was skipped by the text pre-filter and gets
+        the same result as an image the model found no text in.
+        """
+        if prefiltered:
+            annotations = {"success": False, "error": "No predictions returned", "prefiltered": True}
+            self.metrics.increment('prefilter_skip', model_type)
+        else:
+            try:
+                with self.metrics.timer('create_text_groups', model_type):
+                    if frame_predictions is not None:
+                        annotations = self.merge_frames(model, frame_predictions)
+                    else:
+                        annotations = model.format_predictions(prediction)
+                annotations["success"] = True
+                self.metrics.increment('success', model_type)
+            except TextDetectionException as e:
+                # No text found
+                annotations = {"success": False, "error": str(e)}
+                self.metrics.increment('no_predictions', model_type)
+        results[index].update(annotations)
+
+        if index in cache_keys:
+            self.cache.set(cache_keys[index], annotations)
+
+    def finish_detection(self, model_type, index, boxes, results, cache_keys):
+        """
+        Store the text boxes found in an image as its result and cache it
+
+        :param np.ndarray boxes:  Boxes of shape (N, 4, 2) in the coordinates of the original image
+        """
+        if len(boxes):
+            annotations = {'text_regions': np.rint(boxes).astype(int).reshape(len(boxes), -1).tolist(),
+                           'success': True}
+            self.metrics.increment('success', model_type)
+        else:
+            annotations = {'text_regions': [], 'success': False, 'error': 'No text detected'}
+            self.metrics.increment('no_predictions', model_type)
+        results[index].update(annotations)
+
+        if index in cache_keys:
+            self.cache.set(cache_keys[index], annotations)
+
+    def has_text(self, model, model_type, image):
+        """
+        Check a preprocessed image with the text pre-filter
+
+        :return bool:  False if the image can skip the model
+        """
+        with self.metrics.timer('text_prefilter', model_type):
+            if self.text_prefilter.method == TextPrefilter.DETECT:
+                if self.DETECT not in get_backend(model_type).modes:
+                    return True
+                with self.checkout(model) as replica:
+                    return self.text_prefilter.has_text(image, replica.detect)
+            return self.text_prefilter.has_text(image)
+
+    def reuse_duplicate(self, model, model_type, index, image_file, options, results, cache_keys, image_hashes):
+        """
+        Use the prediction of a near-duplicate image, rescaled to the size of
+        this image, if there is one in the duplicate index
+
+        The hash of images without a match is added to `image_hashes`, so
+        their prediction can be indexed once made.
+
+        :return bool:  Whether a near-duplicate was found
+        """
+        try:
+            with self.metrics.timer('perceptual_hash', model_type):
+                image_hash = self.duplicate_index.image_hash(image_file)
+        except Exception:
+            # Leave it to preprocessing to report unreadable files
+            return False
+        if image_hash is None:
+            return False
+
+        match = self.duplicate_index.lookup(*image_hash, options)
+        if match is None:
+            image_hashes[index] = image_hash
+            return False
+
+        prediction, scale, distance = match
+        self.log.debug('Using result of near-duplicate image for %s' % results[index]['filename'])
+        if tuple(scale) != (1, 1):
+            prediction = model.transform_predictions(prediction, scale=scale)
+        self.finish_result(model, model_type, index, results, cache_keys, prediction=prediction)
+        results[index]['near_duplicate_distance'] = distance
+        self.metrics.increment('near_duplicate_hit', model_type)
+        return True
+
+    def merge_tiles(self, model, mode, tile_predictions):
+        """
+        Combine the predictions of the tiles of an image, in the coordinates of
+        the original image, dropping boxes found again in the overlap of
+        another tile
+
+        :param list tile_predictions:  ((x, y) offset, (x, y) scale, raw prediction) per tile
+        :return:  Raw prediction for the whole image, or the array of boxes in `detect` mode
+        """
+        if mode == self.DETECT:
+            boxes = [(prediction + offset) * scale for offset, scale, prediction in tile_predictions]
+            tile_ids = np.concatenate([[tile] * len(tile_boxes) for tile, tile_boxes in enumerate(boxes)])
+            boxes = np.concatenate(boxes).reshape(-1, 4, 2)
+            return boxes[deduplicate_boxes(boxes, tile_ids)]
+
+        predictions = [model.transform_predictions(prediction, scale=scale,
+                                                   offset=(offset[0] * scale[0], offset[1] * scale[1]))
+                       for offset, scale, prediction in tile_predictions]
+        boxes = [model.split_predictions(prediction)[1] for prediction in predictions]
+        tile_ids = np.concatenate([[tile] * len(tile_boxes) for tile, tile_boxes in enumerate(boxes)])
+        boxes = np.concatenate(boxes).reshape(-1, 4, 2)
+        return model.combine_predictions(predictions, deduplicate_boxes(boxes, tile_ids))
+
+    @staticmethod
+    def merge_frames(model, frame_predictions):
+        """
+        Combine the predictions of the frames of an animated image
+
+        Each frame with text is kept with its frame index; text groups repeated
+        in later frames are only included once in the combined text.
+
+        :param list frame_predictions:  (frame index, raw prediction) tuples, in frame order
+        :return dict:  Combined simplified text and the results per frame
+        """
+        frames = []
+        groupings = []
+        seen = set()
+        for frame, prediction in frame_predictions:
+            try:
+                annotations = model.format_predictions(prediction)
+            except TextDetectionException:
+                continue
+            frames.append(dict(annotations, frame=frame))
+            for group in annotations['simplified_text']['groupings']:
+                # Groups are lists of lines, which keras-ocr splits into lists of words
+                key = tuple(tuple(line) if isinstance(line, list) else line for line in group)
+                if key not in seen:
+                    seen.add(key)
+                    groupings.append(group)
+
+        if not frames:
+            raise TextDetectionException("No predictions returned")
+        return {'simplified_text': {'groupings': groupings, 'raw_text': model.groupings_text(groupings)},
+                'frames': frames}
+
+    def predict(self, model, model_type, images):
+        """
+        Run preprocessed images through an idle replica of a model, via its
+        batch scheduler if batching across calls is enabled and the model runs
+        batches of images at once
+        """
+        runner = self.pool(model)
+        if not self.batch_window_ms or not getattr(model, 'batches_images', True):
+            return runner.predict(images)
+
+        with self._scheduler_lock:
+            if model.model_signature not in self.schedulers:
+                # One worker per replica, so all replicas can run batches
+                self.schedulers[model.model_signature] = BatchScheduler(runner, self.log,
+                                                                        max_batch_size=self.batch_size,
+                                                                        max_wait_ms=self.batch_window_ms,
+                                                                        workers=self.model_replicas)
+            scheduler = self.schedulers[model.model_signature]
+        return scheduler.predict(images)
+
+    def stop_scheduler(self, model):
+        """
+        Stop and remove the batch scheduler of a model that is being unloaded
+        """
+        with self._scheduler_lock:
+            scheduler = self.schedulers.pop(model.model_signature, None)
+        if scheduler is not None:
+            scheduler.stop()
+
+    def batch_stats(self):
+        """
+        Achieved batch sizes per model and language
+        """
+        with self._scheduler_lock:
+            schedulers = dict(self.schedulers)
+        return {signature: scheduler.stats() for signature, scheduler in schedulers.items()}
+
+    def preprocess_image(self, model, model_type, image_file, local, temp_files, max_side=None):
+        """
+        Preprocess an image for a model
 
+        Uploads are decoded in memory. If PaddleOCR cannot do so, the upload is
+        written to a uniquely named temporary file that PaddleOCR reads itself;
+        the path is added to `temp_files` for cleanup.
+
+        :return tuple:  Preprocessed image and the (x, y) scale back to the original
+        """
         try:
-            annotations = model.annotate_image(image)
-            annotations["success"] = True
+            return model.preprocess_image(image_file, max_side)
+        except TextDetectionException:
+            if local or not get_backend(model_type).reads_files:
+                raise
+
+        self.log.debug('Falling back to temporary file for %s' % get_image_filename(image_file))
+        filepath = self.save_temp_image(image_file, model_type)
+        temp_files.append(filepath)
+        return model.preprocess_image(filepath, max_side)
+
+    def preprocess_frames(self, model, model_type, image_file, max_side=None, max_frames=None):
+        """
+        Preprocess the distinct frames of an animated image
+
+        :return tuple:  List of (frame index, preprocessed image, scale) and the
+                        number of frames; the frame count is 1 if `max_frames` is
+                        not set or the image is not animated, in which case the
+                        image is preprocessed as usual
+        """
+        if not max_frames or max_frames < 2:
+            return [], 1
+        try:
+            return model.preprocess_frames(image_file, max_side, max_frames)
         except TextDetectionException as e:
-            # No text found
-            annotations = {"success": False, "error": str(e)}
+            self.log.debug('Unable to read frames of %s: %s' % (get_image_filename(image_file), str(e)))
+            return [], 1
 
-        results.update(annotations)
-        return results
+    def save_temp_image(self, image_file, model_type):
+        """
+        Save an uploaded image to a unique file in the temporary image folder
+
+        :param image_file:  Requests file stream
+        :param str model_type:  Model the image is saved for, for metrics
+        :return str:  Path to saved image
+        """
+        if not self.temp_image_dir:
+            raise TextDetectionException('Reading images from files requires a temporary image download folder to be set')
+
+        with self.metrics.timer('file_save', model_type):
+            extension = os.path.splitext(get_image_filename(image_file))[1]
+            handle, filepath = tempfile.mkstemp(suffix=extension, dir=self.temp_image_dir)
+            with os.fdopen(handle, 'wb') as outfile:
+                image_file.stream.seek(0)
+                outfile.write(image_file.stream.read())
+        return filepath
+
+    @staticmethod
+    def image_area(image):
+        """
+        Pixel count of a preprocessed image, or 0 if it is not an array
+        """
+        shape = getattr(image, 'shape', None)
+        return shape[0] * shape[1] if shape else 0
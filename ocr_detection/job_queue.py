@@ -0,0 +1,165 @@
+"""
+Background processing of submitted OCR jobs
+"""
+from io import BytesIO
+import queue
+import threading
+import time
+import uuid
+
+from werkzeug.datastructures import FileStorage
+
+from common.exceptions import JobQueueFullException
+
+__author__ = "Dale Wahl"
+__credits__ = ["Dale Wahl"]
+__maintainer__ = "Dale Wahl"
+__email__ = "4cat@oilab.eu"
+
+
+class JobQueue:
+    """
+    OCR Job Queue
+
+    Jobs are submitted with the image contents already read into memory and
+    are processed by a pool of background threads through the
+    ImageTextDetector. Results are kept until they are fetched or the job
+    expires.
+    """
+    QUEUED = 'queued'
+    PROCESSING = 'processing'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+
+    def __init__(self, detector, logger, workers=2, max_queue=100, ttl=3600):
+        """
+        :param ImageTextDetector detector:  Detector used to process jobs
+        :param logger:  Logger
+        :param int workers:  Number of background worker threads
+        :param int max_queue:  Maximum number of jobs waiting to be processed
+        :param int ttl:  Seconds a job is kept after it was submitted or finished
+        """
+        self.detector = detector
+        self.log = logger
+        self.ttl = ttl
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+        self.worker_count = workers
+        self.workers = []
+        self._start_workers()
+
+    def submit(self, images, model_type, **options):
+        """
+        Add a job to the queue
+
+        :param list images:  List of (filename, image bytes) tuples
+        :param str model_type:  Model to use
+        :param options:  Keyword arguments passed on to `ImageTextDetector.process_images`
+        :return str:  Job ID
+        """
+        self.expire()
+        self._start_workers()
+
+        job_id = uuid.uuid4().hex
+        job = {'job_id': job_id,
+               'status': self.QUEUED,
+               'model_type': model_type,
+               'submitted': time.time(),
+               'finished': None,
+               'results': None,
+               'error': None}
+        with self._lock:
+            self.jobs[job_id] = job
+        try:
+            self.queue.put_nowait((job_id, images, model_type, options))
+        except queue.Full:
+            with self._lock:
+                del self.jobs[job_id]
+            raise JobQueueFullException('Job queue is full; try again later')
+
+        self.log.info('Queued job %s with %i images' % (job_id, len(images)))
+        return job_id
+
+    def get(self, job_id):
+        """
+        Get the status of a job
+
+        Finished jobs are removed once fetched.
+
+        :param str job_id:  Job ID
+        :return dict|None:  Job, or None if unknown or expired
+        """
+        self.expire()
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job['status'] in (self.FINISHED, self.FAILED):
+                del self.jobs[job_id]
+            return dict(job)
+
+    def expire(self):
+        """
+        Remove jobs that were never fetched within the TTL
+        """
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if now - (job['finished'] or job['submitted']) > self.ttl]
+            for job_id in expired:
+                del self.jobs[job_id]
+        if expired:
+            self.log.info('Expired %i jobs' % len(expired))
+
+    def stats(self):
+        """
+        Queue depth and job counts per status
+        """
+        with self._lock:
+            statuses = [job['status'] for job in self.jobs.values()]
+        return {'queue_depth': self.queue.qsize(),
+                'max_queue': self.queue.maxsize,
+                'workers': len(self.workers),
+                **{status: statuses.count(status) for status in
+                   (self.QUEUED, self.PROCESSING, self.FINISHED, self.FAILED)}}
+
+    def _start_workers(self):
+        """
+        Start worker threads that are not running; threads do not survive a
+        fork, e.g. when gunicorn preloads the app before starting its workers
+        """
+        with self._lock:
+            self.workers = [worker for worker in self.workers if worker.is_alive()]
+            for i in range(len(self.workers), self.worker_count):
+                worker = threading.Thread(target=self._work, name='ocr-job-worker-%i' % i, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def _work(self):
+        """
+        Process jobs from the queue until the process exits
+        """
+        while True:
+            job_id, images, model_type, options = self.queue.get()
+            try:
+                with self._lock:
+                    job = self.jobs.get(job_id)
+                    if job is None:
+                        # Expired while waiting
+                        continue
+                    job['status'] = self.PROCESSING
+
+                try:
+                    files = [FileStorage(stream=BytesIO(data), filename=filename) for filename, data in images]
+                    results = self.detector.process_images(files, model_type, **options)
+                    status, error = self.FINISHED, None
+                except Exception as e:
+                    self.log.error('Job %s failed: %s' % (job_id, str(e)))
+                    results, status, error = None, self.FAILED, str(e)
+
+                with self._lock:
+                    job.update({'status': status, 'results': results, 'error': error, 'finished': time.time()})
+            finally:
+                self.queue.task_done()
@@ -2,9 +2,11 @@
 keras-ocr python package used to detect text in images
 """
 import keras_ocr
-from pathlib import Path
-from werkzeug.datastructures import FileStorage
-from common.helper_functions import get_image_filename, make_jsonifiable
+import numpy as np
+from common.helper_functions import get_image_filename
+from common.image_loading import load_image, load_frames
+from common.serialization import compact_boxes
+from ocr_detection.text_grouping import group_words
 
 from common.exceptions import TextDetectionException
 
@@ -25,153 +27,184 @@ class KerasOCRPipeline:
     predicted, an algorythm attempts to sort them into likely groupings based
     on locations within the original image.
     """
-    def __init__(self, log):
+    def __init__(self, log, **pipeline_options):
         # Load models
         # keras-ocr will automatically download pretrained
         # weights for the detector and recognizer.
-        self.pipeline = keras_ocr.pipeline.Pipeline()
+        self.pipeline = keras_ocr.pipeline.Pipeline(**pipeline_options)
         self.log = log
+        # Identifies the model and settings for cached results
+        self.model_signature = 'keras_ocr-%s' % getattr(keras_ocr, '__version__', 'unknown')
 
-    def preprocess_image(self, image_file):
+    def preprocess_image(self, image_file, max_side=None):
         """
         Do any preprocessing of image that is needed.
+
+        :param image_file:  Local file path or requests file stream
+        :param int max_side:  Downscale so the longest side is at most this long
+        :return tuple:  RGB image array and the (x, y) scale back to the original
         """
         self.log.debug("Reading image %s" % get_image_filename(image_file))
-        if type(image_file) == Path:
-            preprocessed_image = keras_ocr.tools.read(str(image_file))
-        elif type(image_file) == FileStorage:
-            preprocessed_image = keras_ocr.tools.read(image_file)
-        else:
-            # Might as well try...
-            try:
-                preprocessed_image = keras_ocr.tools.read(image_file)
-            except Exception as e:
-                self.log.error(str(e))
-                raise TextDetectionException('Unable to process image: %s' % str(e))
-        return preprocessed_image
+        try:
+            return load_image(image_file, max_side)
+        except Exception as e:
+            self.log.error(str(e))
+            raise TextDetectionException('Unable to process image: %s' % str(e))
+
+    def preprocess_frames(self, image_file, max_side=None, max_frames=16):
+        """
+        Decode the distinct frames of an animated image
+
+        :param image_file:  Local file path or requests file stream
+        :param int max_side:  Downscale so the longest side is at most this long
+        :param int max_frames:  Maximum number of frames sampled
+        :return tuple:  List of (frame index, RGB image array, (x, y) scale) and the number of frames
+        """
+        self.log.debug("Reading frames of image %s" % get_image_filename(image_file))
+        try:
+            return load_frames(image_file, max_side, max_frames)
+        except Exception as e:
+            self.log.error(str(e))
+            raise TextDetectionException('Unable to process image: %s' % str(e))
+
+    def predict(self, images):
+        """
+        Run a batch of preprocessed images through the pipeline at once
+
+        keras-ocr pads the images to a common size and runs both the detector
+        and recognizer over the whole batch.
+
+        :param list images:  Preprocessed images
+        :return list:  Raw predictions, one list of (word, box) per image
+        """
+        self.log.debug("Making predictions for %i image(s)" % len(images))
+        return self.pipeline.recognize(images)
+
+    def detect(self, images):
+        """
+        Find text boxes without recognizing their text
+
+        The images are resized and padded the same way `Pipeline.recognize`
+        does before running only its detector.
+
+        :param list images:  Preprocessed images
+        :return list:  Array of boxes of shape (N, 4, 2) per image
+        """
+        self.log.debug("Detecting text in %i image(s)" % len(images))
+        resized = [keras_ocr.tools.resize_image(image, max_scale=self.pipeline.scale, max_size=self.pipeline.max_size)
+                   for image in images]
+        max_height, max_width = np.array([image.shape[:2] for image, _ in resized]).max(axis=0)
+        padded = np.array([keras_ocr.tools.pad(image, width=max_width, height=max_height) for image, _ in resized])
+        box_groups = self.pipeline.detector.detect(images=padded)
+        return [np.asarray(boxes, dtype=float).reshape(-1, 4, 2) / scale
+                for boxes, (_, scale) in zip(box_groups, resized)]
+
+    def recognize(self, images, box_groups):
+        """
+        Recognize the text in given boxes without running the detector
+
+        :param list images:  Preprocessed images
+        :param list box_groups:  Array of boxes of shape (N, 4, 2) per image, in image coordinates
+        :return list:  Raw predictions, one list of (word, box) per image
+        """
+        self.log.debug("Recognizing %i region(s)" % sum(len(boxes) for boxes in box_groups))
+        box_groups = [np.asarray(boxes, dtype=np.float32).reshape(-1, 4, 2) for boxes in box_groups]
+        words = self.pipeline.recognizer.recognize_from_boxes(images=images, box_groups=box_groups)
+        return [list(zip(image_words, boxes)) for image_words, boxes in zip(words, box_groups)]
 
     def annotate_image(self, image):
         """
         Get text from models
 
-        :param Path image_file:  Path to file to annotate
-        :param keras_ocr.pipeline pipeline:  Pipeline to run images through
+        :param image:  Preprocessed image to annotate
         :return dict:  List of word groupings
         """
-        self.log.debug("Making predictions")
-        predictions = self.pipeline.recognize([image])[0]
+        return self.format_predictions(self.predict([image])[0])
+
+    def format_predictions(self, predictions):
+        """
+        Group the raw predictions of a single image into text
 
+        :param list predictions:  Raw predictions for one image
+        :return dict:  Simplified text and raw output
+        """
         if predictions:
             self.log.debug("Grouping text")
             text_groups = self.create_text_groups(predictions)
             self.log.debug("Removing position information")
-            text = self.remove_positional_information(text_groups)
-            return make_jsonifiable({'simplified_text': text,
-                    'raw_output': predictions})
+            text = self.remove_positional_information(text_groups, predictions)
+            return {'simplified_text': text,
+                    'boxes': compact_boxes(*self.split_predictions(predictions)),
+                    'raw_output': predictions}
         else:
             raise TextDetectionException("No predictions returned")
 
-    def create_text_groups(self, text_from_image):
+    def split_predictions(self, predictions):
         """
-        This function cycles through predicted words and groups them based on
-        their location on the image. It first finds words likely to be in a
-        horizontal row, orders theses and checks to see if there are any large
-        spaces between them (breaking them appart if there are). It then
-        examines each group to see if there is another row closely following and
-        groups them together.
+        Split the raw predictions of a single image into columns
 
-        Through testing, using the height of a word seems to generally allow for
-        accurate groupings however the size of text does not always correspond
-        so neatly with the spacing between words and lines. Also of note: this
-        method of grouping will not work with non horizontal words/rows.
+        :param list predictions:  Raw predictions for one image
+        :return tuple:  Words, array of boxes of shape (N, 4, 2) and scores (None; keras-ocr has no scores)
         """
-        texts = [SimpleBox(text) for text in text_from_image]
-        # could sort texts by finding min of right bottom point (x + y) or, like, pythagorean theorem
-
-        row_groups = []
-        while texts:
-            # grab first word
-            text = texts[0]
-
-            # collect all text on same "line"
-            temp_row = [j for j in texts if abs(text.bottom - j.bottom) <= text.height/2]
+        words = [word for word, _ in predictions]
+        boxes = np.array([box for _, box in predictions]).reshape(len(predictions), 4, 2)
+        return words, boxes, None
 
-           # sort the list in place in order of left to right
-            temp_row.sort(key=lambda x: x.left, reverse=False)
-
-            # Find large breaks within words
-            # Initialize new list with first word
-            temp_row_2 = [temp_row[0]]
-            # Loop through rest of words in temp_row
-            for index, word in enumerate(temp_row[1:]):
-                # Is word close to previous?
-                if abs(word.left - temp_row[index].right) < text.height/2:
-                    temp_row_2.append(word)
-                else:
-                    break
-
-            # add word group to collection
-            row_groups.append(temp_row_2)
-            # remove those words from possible words
-            [texts.pop(texts.index(word)) for word in temp_row_2]
+    def transform_predictions(self, predictions, scale=(1, 1), offset=(0, 0)):
+        """
+        Scale and then shift the boxes of the raw predictions of a single image
 
-        # Now to check if rows are near each other... somehow...
-        rows = [BigBox(row) for row in row_groups]
+        :param list predictions:  Raw predictions for one image
+        :param tuple scale:  (x, y) factors
+        :param tuple offset:  (x, y) to add after scaling
+        :return list:  New predictions
+        """
+        return [(word, box * np.asarray(scale, dtype=box.dtype) + np.asarray(offset, dtype=box.dtype))
+                for word, box in predictions]
 
-        text_groups = []
+    def combine_predictions(self, predictions, indices=None):
+        """
+        Combine the raw predictions of several tiles of an image into one
 
-        while rows:
-            matching_row = rows[0]
+        :param list predictions:  Raw predictions, already in image coordinates
+        :param indices:  Indices of the words to keep, counted over all predictions; None for all
+        :return list:  Combined predictions
+        """
+        combined = [word for prediction in predictions for word in prediction]
+        if indices is None:
+            return combined
+        return [combined[index] for index in indices]
 
-            group = [matching_row]
-            for new_row in rows[1:]:
-                # is top of new_row near bottom of our row?
-                if (new_row.top - matching_row.bottom) < (matching_row.height*.75):
-                    # and is center of row within the margins of our row?
-                    if  matching_row.left < new_row.center < matching_row.right:
-                        group.append(new_row)
-                        matching_row = new_row
+    def create_text_groups(self, text_from_image):
+        """
+        Groups predicted words based on their location on the image: first
+        into horizontal rows, broken apart at large spaces, then rows that
+        closely follow each other into groups (see `text_grouping`).
 
-            text_groups.append(group)
-            # remove those rows from possible rows
-            [rows.pop(rows.index(row)) for row in group]
+        Through testing, using the height of a word seems to generally allow for
+        accurate groupings however the size of text does not always correspond
+        so neatly with the spacing between words and lines. Also of note: this
+        method of grouping will not work with non horizontal words/rows.
 
-        return text_groups
+        :param list text_from_image:  Predicted (word, box) tuples
+        :return list:  Groups of rows of word indices
+        """
+        return group_words([box for _, box in text_from_image])
 
-    def remove_positional_information(self, text_groups):
+    def remove_positional_information(self, text_groups, text_from_image):
         """
         Takes the result from create_text_groups and returns only the text.
-
-        TODO: build this object in the create_text_groups function to prevent
-        this double loop.
         """
+        words = [word for word, _ in text_from_image]
+        groupings = [[[words[index] for index in line] for line in group] for group in text_groups]
         text = {}
-        text['groupings'] = [[[word.word for word in line.original] for line in group] for group in text_groups]
-        text['raw_text'] = '\n\n'.join(['\n'.join([' '.join([word.word for word in line.original]) for line in group]) for group in text_groups])
+        text['groupings'] = groupings
+        text['raw_text'] = self.groupings_text(groupings)
         return text
 
-
-class SimpleBox():
-    """
-    This class reorganizes words to find location attributes
-    """
-    def __init__(self, stupid_box):
-        self.word = stupid_box[0]
-        self.top = min([i[1] for i in stupid_box[1]])
-        self.left = min([i[0] for i in stupid_box[1]])
-        self.bottom = max([i[1] for i in stupid_box[1]])
-        self.right = max([i[0] for i in stupid_box[1]])
-        self.height = self.bottom - self.top
-
-class BigBox():
-    """
-    Similarly to SimpleBox, this represents a grouping of many SimpleBoxes
-    """
-    def __init__(self, list_of_simple_boxes):
-        self.original = list_of_simple_boxes
-        self.top = min([i.top for i in list_of_simple_boxes])
-        self.left = min([i.left for i in list_of_simple_boxes])
-        self.bottom = max([i.bottom for i in list_of_simple_boxes])
-        self.right = max([i.right for i in list_of_simple_boxes])
-        self.height = self.bottom - self.top
-        self.center = ((self.right - self.left)/2) + self.left
+    @staticmethod
+    def groupings_text(groupings):
+        """
+        Join groups of lines of words into text; groups are separated by a blank line
+        """
+        return '\n\n'.join(['\n'.join([' '.join(line) for line in group]) for group in groupings])
@@ -0,0 +1,144 @@
+"""
+Latency histograms and counters for the stages of text detection
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+__author__ = "Dale Wahl"
+__credits__ = ["Dale Wahl"]
+__maintainer__ = "Dale Wahl"
+__email__ = "4cat@oilab.eu"
+
+# Upper bounds of histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics:
+    """
+    Thread safe collection of per-model stage histograms, counters and gauges
+
+    Can be rendered as JSON-able dictionaries or in the Prometheus text format.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # {(stage, model_type): [counts per bucket + overflow, sum, count]}
+            self._histograms = {}
+            # {(name, model_type): value}
+            self._counters = {}
+            self._gauges = {}
+
+    def observe(self, stage, model_type, seconds):
+        """
+        Record the duration of a stage
+        """
+        with self._lock:
+            histogram = self._histograms.get((stage, model_type))
+            if histogram is None:
+                histogram = self._histograms[(stage, model_type)] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, stage, model_type):
+        """
+        Time the enclosed block as a stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, model_type, time.perf_counter() - start)
+
+    def increment(self, name, model_type, amount=1):
+        with self._lock:
+            self._counters[(name, model_type)] = self._counters.get((name, model_type), 0) + amount
+
+    def set_gauge(self, name, model_type, value):
+        with self._lock:
+            self._gauges[(name, model_type)] = value
+
+    def add_gauge(self, name, model_type, amount):
+        with self._lock:
+            self._gauges[(name, model_type)] = self._gauges.get((name, model_type), 0) + amount
+
+    @contextmanager
+    def in_flight(self, model_type):
+        """
+        Count the enclosed block as an in-flight request
+        """
+        self.add_gauge('in_flight', model_type, 1)
+        try:
+            yield
+        finally:
+            self.add_gauge('in_flight', model_type, -1)
+
+    def to_dict(self):
+        """
+        All metrics as nested dictionaries of {name: {model_type: value}}
+        """
+        with self._lock:
+            histograms = {}
+            for (stage, model_type), (counts, total, count) in self._histograms.items():
+                histograms.setdefault(stage, {})[model_type] = {
+                    'count': count,
+                    'sum': total,
+                    'mean': total / count if count else 0.0,
+                    'buckets': dict(zip([str(bucket) for bucket in self.buckets] + ['+Inf'], counts))}
+            counters, gauges = {}, {}
+            for source, target in ((self._counters, counters), (self._gauges, gauges)):
+                for (name, model_type), value in source.items():
+                    target.setdefault(name, {})[model_type] = value
+        return {'histograms': histograms, 'counters': counters, 'gauges': gauges}
+
+    def merge(self, other):
+        """
+        Add metrics from another Metrics' `to_dict()`, e.g. from a worker
+        process; gauges are overwritten
+        """
+        bucket_names = [str(bucket) for bucket in self.buckets] + ['+Inf']
+        with self._lock:
+            for stage, models in other.get('histograms', {}).items():
+                for model_type, values in models.items():
+                    histogram = self._histograms.setdefault((stage, model_type), [[0] * len(bucket_names), 0.0, 0])
+                    for index, name in enumerate(bucket_names):
+                        histogram[0][index] += values['buckets'].get(name, 0)
+                    histogram[1] += values['sum']
+                    histogram[2] += values['count']
+            for name, models in other.get('counters', {}).items():
+                for model_type, value in models.items():
+                    self._counters[(name, model_type)] = self._counters.get((name, model_type), 0) + value
+            for name, models in other.get('gauges', {}).items():
+                for model_type, value in models.items():
+                    self._gauges[(name, model_type)] = value
+
+    def to_prometheus(self, prefix='ocr'):
+        """
+        All metrics in the Prometheus text exposition format
+        """
+        metrics = self.to_dict()
+        lines = ['# TYPE %s_stage_duration_seconds histogram' % prefix]
+        for stage, models in sorted(metrics['histograms'].items()):
+            for model_type, values in sorted(models.items()):
+                labels = 'stage="%s",model="%s"' % (stage, model_type)
+                cumulative = 0
+                for bucket, count in values['buckets'].items():
+                    cumulative += count
+                    lines.append('%s_stage_duration_seconds_bucket{%s,le="%s"} %i' % (prefix, labels, bucket, cumulative))
+                lines.append('%s_stage_duration_seconds_sum{%s} %f' % (prefix, labels, values['sum']))
+                lines.append('%s_stage_duration_seconds_count{%s} %i' % (prefix, labels, values['count']))
+
+        for kind, name_format in (('counter', '%s_%s_total'), ('gauge', '%s_%s')):
+            for name, models in sorted(metrics[kind + 's'].items()):
+                metric = name_format % (prefix, name)
+                lines.append('# TYPE %s %s' % (metric, kind))
+                for model_type, value in sorted(models.items()):
+                    lines.append('%s{model="%s"} %s' % (metric, model_type, value))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,158 @@
+"""
+Pool of model replicas for concurrent inference
+"""
+from contextlib import contextmanager
+import queue
+import threading
+import time
+
+from common.exceptions import ModelBusyException
+
+__author__ = "Dale Wahl"
+__credits__ = ["Dale Wahl"]
+__maintainer__ = "Dale Wahl"
+__email__ = "4cat@oilab.eu"
+
+
+class ModelPool:
+    """
+    Model Replica Pool
+
+    Each replica is used by one thread at a time: inference checks out an
+    idle replica and returns it when done. Replicas are created on demand up
+    to `size`; once all are busy, callers wait up to `timeout` seconds for one
+    to be returned.
+    """
+    def __init__(self, factory, logger, size=1, timeout=30, first=None):
+        """
+        :param factory:  Callable that loads a new replica
+        :param logger:  Logger
+        :param int size:  Maximum number of replicas
+        :param float timeout:  Seconds to wait for an idle replica
+        :param first:  Already loaded replica to start the pool with
+        """
+        self.factory = factory
+        self.log = logger
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self.replicas = []
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._reserved = 0
+
+        # Counters
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+
+        if first is not None:
+            self.replicas.append(first)
+            self._reserved = 1
+            self._idle.put(first)
+
+    @property
+    def primary(self):
+        """
+        The first replica; used for work that does not run the model
+        """
+        return self.replicas[0] if self.replicas else None
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        """
+        Use a replica exclusively
+
+        :param float timeout:  Seconds to wait for an idle replica; defaults to `self.timeout`
+        :raises ModelBusyException:  If no replica became idle in time
+        """
+        replica = self._acquire(self.timeout if timeout is None else timeout)
+        try:
+            yield replica
+        finally:
+            self._idle.put(replica)
+
+    def predict(self, images):
+        """
+        Run images through an idle replica
+
+        :param list images:  Preprocessed images
+        :return list:  Raw predictions, one per image
+        """
+        with self.checkout() as replica:
+            return replica.predict(images)
+
+    def fill(self):
+        """
+        Load all replicas that have not been loaded yet
+        """
+        while True:
+            with self._lock:
+                if self._reserved >= self.size:
+                    return
+                self._reserved += 1
+            self._idle.put(self._create())
+
+    def warm_up(self, images):
+        """
+        Load all replicas and run images through each of them once
+        """
+        self.fill()
+        replicas = [self._acquire(self.timeout) for _ in range(self.size)]
+        try:
+            for replica in replicas:
+                replica.predict(images)
+        finally:
+            for replica in replicas:
+                self._idle.put(replica)
+
+    def stats(self):
+        """
+        Replica counts and checkout counters
+        """
+        with self._lock:
+            return {'size': self.size,
+                    'loaded': len(self.replicas),
+                    'idle': self._idle.qsize(),
+                    'checkouts': self.checkouts,
+                    'waits': self.waits,
+                    'timeouts': self.timeouts}
+
+    def _acquire(self, timeout):
+        try:
+            replica = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._reserved < self.size
+                if create:
+                    self._reserved += 1
+                else:
+                    self.waits += 1
+            if create:
+                replica = self._create()
+            else:
+                try:
+                    replica = self._idle.get(timeout=timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise ModelBusyException('No model available within %s seconds; try again later' % timeout)
+        with self._lock:
+            self.checkouts += 1
+        return replica
+
+    def _create(self):
+        """
+        Load a replica for a reserved slot
+        """
+        start = time.perf_counter()
+        try:
+            replica = self.factory()
+        except Exception:
+            with self._lock:
+                self._reserved -= 1
+            raise
+        with self._lock:
+            self.replicas.append(replica)
+        self.log.info('Loaded model replica %i of %i in %.1f seconds' % (len(self.replicas), self.size,
+                                                                         time.perf_counter() - start))
+        return replica
@@ -1,12 +1,19 @@
 """
 paddle_ocr python package used to detect text in images
 """
+import hashlib
+
+import cv2
+import numpy as np
+import paddleocr
 from paddleocr import PaddleOCR
-from pathlib import Path
-import os
+from werkzeug.datastructures import FileStorage
 
 from common.exceptions import TextDetectionException
 from common.helper_functions import get_image_filename
+from common.image_loading import load_image, load_frames
+from common.serialization import compact_boxes
+from ocr_detection.text_grouping import group_lines
 
 __author__ = "Dale Wahl"
 __credits__ = ["Dale Wahl"]
@@ -19,107 +26,227 @@ class PaddlesOCRPipeline:
     This processor uses the PaddleOCR package (https://github.com/PaddlePaddle/PaddleOCR#readme)
     to extract text from images.
     """
-    def __init__(self, log):
+    # PaddleOCR runs images one at a time, so batching concurrent requests only adds latency
+    batches_images = False
+
+    def __init__(self, log, lang='en', variant=None, **ocr_options):
+        """
+        :param log:  Logger
+        :param str lang:  Language
+        :param str variant:  Name of the backend variant, e.g. `cpu`
+        :param ocr_options:  Further PaddleOCR arguments, e.g. `use_gpu`, `enable_mkldnn`,
+                             `cpu_threads`, `det_model_dir` and `rec_model_dir`
+        """
         ## Paddleocr supports Chinese, English, French, German, Korean and Japanese.
         # You can set the parameter `lang` as `ch`, `en`, `fr`, `german`, `korean`, `japan`
         # to switch the language model in order.
-        # TODO: how do we want to handle language parameter? Perhaps only load other language models if requested
-        # TODO: download can cause Gunicorn timeout! It seems the worker restarts and picks up download on where it left off, but we may want to spin off a process for the first run to trigger downloads!
-        self.ocr = PaddleOCR(use_angle_cls=True, lang='en') # need to run only once to download and load model into memory
+        # Other languages are loaded on request and kept in a pool by ImageTextDetector
+        # Note: download can cause Gunicorn timeout; the server preloads models in a background thread (PRELOAD_IN_BACKGROUND)
+        self.ocr = PaddleOCR(use_angle_cls=True, lang=lang, **ocr_options) # need to run only once to download and load model into memory
         self.log = log
-
-    def preprocess_image(self, image_file):
+        self.lang = lang
+        # Identifies the model and settings for cached results
+        self.model_signature = 'paddleocr-%s-%s-cls0' % (getattr(paddleocr, '__version__', 'unknown'), lang)
+        if variant:
+            self.model_signature += '-%s' % variant
+        if ocr_options:
+            # Other model files or settings give other results
+            options = repr(sorted((key, str(value)) for key, value in ocr_options.items()))
+            self.model_signature += '-%s' % hashlib.sha1(options.encode('utf-8')).hexdigest()[:8]
+
+    def preprocess_image(self, image_file, max_side=None):
         """
         Do any preprocessing of image that is needed.
+
+        Images are decoded in memory into the BGR array PaddleOCR expects. Local
+        files that cannot be decoded are left for PaddleOCR to read itself.
+
+        :param image_file:  Local file path or requests file stream
+        :param int max_side:  Downscale so the longest side is at most this long
+        :return tuple:  BGR image array (or path) and the (x, y) scale back to the original
+        """
+        self.log.debug("Decoding image %s" % get_image_filename(image_file))
+        try:
+            image, scale = load_image(image_file, max_side)
+        except Exception as e:
+            if type(image_file) != FileStorage:
+                return str(image_file), (1, 1)
+            raise TextDetectionException('Unable to decode image in memory: %s' % str(e))
+        return np.ascontiguousarray(image[:, :, ::-1]), scale
+
+    def preprocess_frames(self, image_file, max_side=None, max_frames=16):
+        """
+        Decode the distinct frames of an animated image
+
+        :param image_file:  Local file path or requests file stream
+        :param int max_side:  Downscale so the longest side is at most this long
+        :param int max_frames:  Maximum number of frames sampled
+        :return tuple:  List of (frame index, BGR image array, (x, y) scale) and the number of frames
+        """
+        self.log.debug("Decoding frames of image %s" % get_image_filename(image_file))
+        try:
+            frames, frame_count = load_frames(image_file, max_side, max_frames)
+        except Exception as e:
+            raise TextDetectionException('Unable to decode image in memory: %s' % str(e))
+        return [(index, np.ascontiguousarray(image[:, :, ::-1]), scale) for index, image, scale in frames], frame_count
+
+    def predict(self, images):
+        """
+        Run a batch of preprocessed images through PaddleOCR
+
+        PaddleOCR's `ocr()` takes a single image, so the images are passed one
+        by one; recognition of the detected regions is batched internally.
+
+        :param list images:  Preprocessed images
+        :return list:  Raw predictions, one per image
+        """
+        self.log.debug("Making predictions for %i image(s)" % len(images))
+        # Currently making cls=False; found that cls=True can cause poor predictions for left to right text
+        return [self.ocr.ocr(image if isinstance(image, np.ndarray) else str(image), cls=False)
+                for image in images]
+
+    def detect(self, images):
+        """
+        Find text boxes without recognizing their text
+
+        :param list images:  Preprocessed images
+        :return list:  Array of boxes of shape (N, 4, 2) per image
+        """
+        self.log.debug("Detecting text in %i image(s)" % len(images))
+        detections = []
+        for image in images:
+            result = self.ocr.ocr(image if isinstance(image, np.ndarray) else str(image), det=True, rec=False, cls=False)
+            boxes = result[0] if result and result[0] is not None else []
+            detections.append(np.array(boxes, dtype=float).reshape(-1, 4, 2))
+        return detections
+
+    def recognize(self, images, box_groups):
+        """
+        Recognize the text in given boxes without running the detector
+
+        Each box is cropped to its bounding rectangle; the crops of an image
+        are recognized as one batch.
+
+        :param list images:  Preprocessed images
+        :param list box_groups:  Array of boxes of shape (N, 4, 2) per image, in image coordinates
+        :return list:  Raw predictions in the PaddleOCR output format, one per image
+        """
+        self.log.debug("Recognizing %i region(s)" % sum(len(boxes) for boxes in box_groups))
+        predictions = []
+        for image, boxes in zip(images, box_groups):
+            if not isinstance(image, np.ndarray):
+                image = cv2.imread(str(image))
+            boxes = np.asarray(boxes, dtype=float).reshape(-1, 4, 2)
+            crops = [self.crop(image, box) for box in boxes]
+            # The recognizer itself: PaddleOCR.ocr treats a list of images as pages and changes its page count
+            lines = self.ocr.text_recognizer(crops)[0] if crops else []
+            predictions.append([[[box.tolist(), tuple(line)] for box, line in zip(boxes, lines)]])
+        return predictions
+
+    @staticmethod
+    def crop(image, box):
+        """
+        Cut the bounding rectangle of a box out of an image, at least one pixel large
         """
-        # No additional preprocessing
-        return image_file
+        height, width = image.shape[:2]
+        x1, y1 = np.clip(np.floor(box.min(axis=0)).astype(int), 0, [width - 1, height - 1])
+        x2, y2 = np.clip(np.ceil(box.max(axis=0)).astype(int), [x1 + 1, y1 + 1], [width, height])
+        return image[y1:y2, x1:x2]
 
     def annotate_image(self, image):
         """
         Get text from models
 
-        :param Path image_file:  Path to file to annotate
-        :param keras_ocr.pipeline pipeline:  Pipeline to run images through
+        :param image:  Preprocessed image to annotate
         :return dict:  List of word groupings
         """
-        self.log.debug("Making predictions")
-        # Currently making cls=False; found that cls=True can cause poor predictions for left to right text
-        predictions = self.ocr.ocr(str(image), cls=False)
+        return self.format_predictions(self.predict([image])[0])
 
-        # Remove temp image
-        #
+    def format_predictions(self, predictions):
+        """
+        Group the raw predictions of a single image into text
 
-        if predictions[0]:
+        :param list predictions:  Raw PaddleOCR output for one image
+        :return dict:  Simplified text and raw output
+        """
+        if predictions and predictions[0]:
             self.log.debug("Grouping text")
             text_groups = self.create_text_groups(predictions[0])
             self.log.debug("Removing position information")
-            text = self.remove_positional_information(text_groups)
-            return {'simplified_text': text, 'raw_output': predictions}
+            text = self.remove_positional_information(text_groups, predictions[0])
+            return {'simplified_text': text,
+                    'boxes': compact_boxes(*self.split_predictions(predictions)),
+                    'raw_output': predictions}
         else:
             raise TextDetectionException("No predictions returned")
 
-    def create_text_groups(self, text_from_image):
+    def split_predictions(self, predictions):
+        """
+        Split the raw PaddleOCR output of a single image into columns
+
+        :param list predictions:  Raw PaddleOCR output for one image
+        :return tuple:  Lines of text, array of boxes of shape (N, 4, 2) and scores
+        """
+        lines = predictions[0] if predictions and predictions[0] else []
+        texts = [line[1][0] for line in lines]
+        boxes = np.array([line[0] for line in lines], dtype=float).reshape(len(lines), 4, 2)
+        scores = np.array([line[1][1] for line in lines], dtype=float)
+        return texts, boxes, scores
+
+    def transform_predictions(self, predictions, scale=(1, 1), offset=(0, 0)):
         """
-        This function cycles through predicted words and groups them based on
-        their location on the image. It first finds words likely to be in a
-        horizontal row, orders theses and checks to see if there are any large
-        spaces between them (breaking them appart if there are). It then
-        examines each group to see if there is another row closely following and
-        groups them together.
+        Scale and then shift the boxes of the raw PaddleOCR output of a single image
 
-        Through testing, using the height of a word seems to generally allow for
-        accurate groupings however the size of text does not always correspond
-        so neatly with the spacing between words and lines. Also of note: this
-        method of grouping will not work with non horizontal words/rows.
+        :param list predictions:  Raw PaddleOCR output for one image
+        :param tuple scale:  (x, y) factors
+        :param tuple offset:  (x, y) to add after scaling
+        :return list:  New predictions
         """
-        # Now to check if rows are near each other... somehow...
-        rows = [BigBox(row) for row in text_from_image]
+        if not predictions or not predictions[0]:
+            return predictions
+        boxes = np.array([line[0] for line in predictions[0]], dtype=float) * scale + offset
+        return [[[box, line[1]] for box, line in zip(boxes.tolist(), predictions[0])]]
 
-        text_groups = []
+    def combine_predictions(self, predictions, indices=None):
+        """
+        Combine the raw PaddleOCR output of several tiles of an image into one
 
-        while rows:
-            matching_row = rows[0]
+        :param list predictions:  Raw PaddleOCR output, already in image coordinates
+        :param indices:  Indices of the lines to keep, counted over all predictions; None for all
+        :return list:  Combined output
+        """
+        combined = [line for prediction in predictions if prediction and prediction[0] for line in prediction[0]]
+        if indices is not None:
+            combined = [combined[index] for index in indices]
+        return [combined]
 
-            group = [matching_row]
-            for new_row in rows[1:]:
-                # is top of new_row near bottom of our row?
-                if (new_row.top - matching_row.bottom) < (matching_row.height*.75):
-                    # and is center of row within the margins of our row?
-                    if  matching_row.left < new_row.center < matching_row.right:
-                        group.append(new_row)
-                        matching_row = new_row
+    def create_text_groups(self, text_from_image):
+        """
+        PaddleOCR already returns lines of text; this groups lines that
+        closely follow each other (see `text_grouping`).
 
-            text_groups.append(group)
-            # remove those rows from possible rows
-            [rows.pop(rows.index(row)) for row in group]
+        Also of note: this method of grouping will not work with non
+        horizontal words/rows.
 
-        return text_groups
+        :param list text_from_image:  Predicted [box, (text, score)] lines
+        :return list:  Groups of line indices
+        """
+        return group_lines([line[0] for line in text_from_image])
 
-    def remove_positional_information(self, text_groups):
+    def remove_positional_information(self, text_groups, text_from_image):
         """
         Takes the result from create_text_groups and returns only the text.
-
-        TODO: build this object in the create_text_groups function to prevent
-        this double loop.
         """
+        lines = [line[1][0] for line in text_from_image]
+        groupings = [[lines[index] for index in group] for group in text_groups]
         text = {}
-        text['groupings'] = [[line.original[1][0] for line in group] for group in text_groups]
-        text['raw_text'] = '\n\n'.join(['\n'.join([line.original[1][0] for line in group]) for group in text_groups])
+        text['groupings'] = groupings
+        text['raw_text'] = self.groupings_text(groupings)
         return text
 
-
-class BigBox():
-    """
-    Similarly to SimpleBox, this represents a grouping of many SimpleBoxes
-    """
-    def __init__(self, grouped_row):
-        self.original = grouped_row
-
-        bounding_box = grouped_row[0]
-        self.top = min([i[1] for i in bounding_box])
-        self.left = min([i[0] for i in bounding_box])
-        self.bottom = max([i[1] for i in bounding_box])
-        self.right = max([i[0] for i in bounding_box])
-        self.height = self.bottom - self.top
-        self.center = ((self.right - self.left)/2) + self.left
+    @staticmethod
+    def groupings_text(groupings):
+        """
+        Join groups of lines into text; groups are separated by a blank line
+        """
+        return '\n\n'.join(['\n'.join(group) for group in groupings])
@@ -0,0 +1,154 @@
+"""
+Content addressed cache of OCR results
+"""
+from collections import OrderedDict
+from contextlib import closing
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from common.serialization import json_default
+
+__author__ = "Dale Wahl"
+__credits__ = ["Dale Wahl"]
+__maintainer__ = "Dale Wahl"
+__email__ = "4cat@oilab.eu"
+
+
+class ResultCache:
+    """
+    OCR Result Cache
+
+    Results are keyed on a hash of the image bytes together with the model and
+    its parameters. A bounded in-memory LRU sits in front of an optional SQLite
+    database so results survive worker restarts and are shared between
+    workers.
+    """
+    def __init__(self, logger, max_size=1024, cache_dir=None):
+        self.log = logger
+        self.max_size = max(0, int(max_size))
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Counters
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.db_path = None
+        if cache_dir:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            self.db_path = os.path.join(cache_dir, 'ocr_results.sqlite')
+            with closing(self._connect()) as connection, connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS results "
+                                   "(key TEXT PRIMARY KEY, result TEXT NOT NULL, created REAL NOT NULL)")
+
+    @staticmethod
+    def make_key(image_bytes, model_type, model_signature=''):
+        """
+        Build a cache key from the image contents and model parameters
+
+        :param bytes image_bytes:  Raw image file contents
+        :param str model_type:  Model used
+        :param str model_signature:  Model version and any parameters that change its output
+        :return str:  Cache key
+        """
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        return '%s:%s:%s' % (model_type, model_signature, digest)
+
+    def get(self, key):
+        """
+        Get a cached result
+
+        :param str key:  Key from `make_key`
+        :return dict|None:  A fresh copy of the result, or None if not cached
+        """
+        with self._lock:
+            serialized = self._memory.get(key)
+            if serialized is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return json.loads(serialized)
+
+        serialized = self._read_disk(key)
+        with self._lock:
+            if serialized is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, serialized)
+        return json.loads(serialized)
+
+    def set(self, key, result):
+        """
+        Store a result
+
+        Results that cannot be converted to JSON are not cached.
+
+        :param str key:  Key from `make_key`
+        :param dict result:  Result to store
+        """
+        try:
+            serialized = json.dumps(result, default=json_default)
+        except TypeError as e:
+            self.log.debug('Not caching result: %s' % str(e))
+            return
+
+        with self._lock:
+            self._remember(key, serialized)
+        self._write_disk(key, serialized)
+
+    def stats(self):
+        """
+        Hit and miss counters
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {'memory_hits': self.memory_hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                    'memory_entries': len(self._memory),
+                    'max_size': self.max_size,
+                    'persistent': self.db_path is not None}
+
+    def _remember(self, key, serialized):
+        """
+        Add to the in-memory LRU, evicting the least recently used entries;
+        caller must hold the lock
+        """
+        if not self.max_size:
+            return
+        self._memory[key] = serialized
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _read_disk(self, key):
+        if not self.db_path:
+            return None
+        try:
+            with closing(self._connect()) as connection:
+                row = connection.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            self.log.warning('Unable to read OCR cache: %s' % str(e))
+            return None
+        return row[0] if row else None
+
+    def _write_disk(self, key, serialized):
+        if not self.db_path:
+            return
+        try:
+            with closing(self._connect()) as connection, connection:
+                connection.execute("INSERT OR REPLACE INTO results (key, result, created) VALUES (?, ?, ?)",
+                                   (key, serialized, time.time()))
+        except sqlite3.Error as e:
+            self.log.warning('Unable to write OCR cache: %s' % str(e))
@@ -0,0 +1,91 @@
+"""
+Coalescing of identical images processed at the same time
+"""
+import threading
+
+__author__ = "Dale Wahl"
+__credits__ = ["Dale Wahl"]
+__maintainer__ = "Dale Wahl"
+__email__ = "4cat@oilab.eu"
+
+
+class Flight:
+    """
+    An image being processed, which other callers can wait on
+    """
+    __slots__ = ('event', 'result')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+    def wait(self, timeout=None):
+        """
+        Wait for the image to be processed
+
+        :param float timeout:  Seconds to wait; None to wait until it is done
+        :return dict|None:  Result, or None if processing failed or did not finish in time
+        """
+        self.event.wait(timeout)
+        return self.result
+
+
+class SingleFlight:
+    """
+    Single-flight Request Coalescing
+
+    The first caller to claim a key processes the image and publishes the
+    result; callers claiming the same key before then wait for it instead of
+    running the model again. Only images in progress are tracked: once
+    published, a key is forgotten and left to the result cache.
+    """
+    def __init__(self):
+        # key -> Flight of images in progress
+        self._flights = {}
+        self._lock = threading.Lock()
+
+        # Counters
+        self.leaders = 0
+        self.followers = 0
+
+    def claim(self, key):
+        """
+        Claim an image for processing
+
+        :param str key:  Image digest and model parameters
+        :return tuple:  The Flight for the key, and whether the caller should process the
+                        image and `publish` its result (True) or wait on the Flight (False)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.followers += 1
+                return flight, False
+            flight = self._flights[key] = Flight()
+            self.leaders += 1
+            return flight, True
+
+    def publish(self, key, result):
+        """
+        Hand the result of a claimed image to everyone waiting on it
+
+        Must be called for every claimed key, also if processing failed, or
+        waiting callers are never released.
+
+        :param str key:  Claimed key
+        :param dict|None result:  Result, or None if processing failed
+        """
+        with self._lock:
+            flight = self._flights.pop(key, None)
+        if flight is not None:
+            flight.result = result
+            flight.event.set()
+
+    def stats(self):
+        """
+        Counts of processed and coalesced images
+        """
+        with self._lock:
+            return {'in_flight': len(self._flights),
+                    'leaders': self.leaders,
+                    'coalesced': self.followers}
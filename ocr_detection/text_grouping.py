@@ -0,0 +1,159 @@
+"""
+Groups detected words into lines and paragraphs based on their positions
+"""
+import numpy as np
+
+__author__ = "Dale Wahl"
+__credits__ = ["Dale Wahl"]
+__maintainer__ = "Dale Wahl"
+__email__ = "4cat@oilab.eu"
+
+
+def box_bounds(boxes):
+    """
+    Bounding rectangles of polygons
+
+    :param boxes:  Array like of shape (N, points, 2) with x, y coordinates
+    :return tuple:  Arrays of top, left, bottom and right coordinates
+    """
+    boxes = np.asarray(boxes)
+    xs, ys = boxes[..., 0], boxes[..., 1]
+    return ys.min(axis=1), xs.min(axis=1), ys.max(axis=1), xs.max(axis=1)
+
+
+def group_words_into_lines(top, left, bottom, right):
+    """
+    Find words likely to be in a horizontal row, order them from left to right
+    and break rows where there is a large space between words.
+
+    Starting from the first remaining word, all remaining words whose bottom
+    lies within half its height are candidates; these are sorted by their left
+    edge and the row is cut at the first gap of more than half that height.
+    Candidates are found in a bottom-sorted index instead of rescanning every
+    word.
+
+    :return list:  Lines, each a list of word indices ordered left to right
+    """
+    count = len(bottom)
+    height = bottom - top
+    remaining = np.ones(count, dtype=bool)
+
+    by_bottom = np.argsort(bottom, kind='stable')
+    sorted_bottom = bottom[by_bottom]
+
+    lines = []
+    first = 0
+    while True:
+        while first < count and not remaining[first]:
+            first += 1
+        if first == count:
+            break
+
+        half_height = height[first] / 2
+        # Widen the search window slightly; the exact test below decides
+        margin = abs(half_height) * 1e-6 + 1e-9
+        start = np.searchsorted(sorted_bottom, bottom[first] - half_height - margin, side='left')
+        end = np.searchsorted(sorted_bottom, bottom[first] + half_height + margin, side='right')
+        candidates = by_bottom[start:end]
+        candidates = candidates[remaining[candidates]]
+        candidates = candidates[np.abs(bottom[first] - bottom[candidates]) <= half_height]
+
+        # Left to right; ties keep their original order
+        candidates.sort()
+        row = candidates[np.argsort(left[candidates], kind='stable')]
+
+        # Find large breaks within words
+        close = np.abs(left[row[1:]] - right[row[:-1]]) < half_height
+        length = 1 + (len(close) if close.all() else int(np.argmin(close)))
+        line = row[:length]
+
+        remaining[line] = False
+        lines.append(line.tolist())
+
+    return lines
+
+
+def group_lines_into_paragraphs(top, left, bottom, right):
+    """
+    Group lines that closely follow each other.
+
+    Starting from the first remaining line, the next line in order whose top
+    is within 75% of the current line's height below it and whose center lies
+    between the current line's margins is added; the search then continues
+    from that line. Candidates are found in a center-sorted index.
+
+    :return list:  Paragraphs, each a list of line indices
+    """
+    count = len(bottom)
+    height = bottom - top
+    center = ((right - left) / 2) + left
+    remaining = np.ones(count, dtype=bool)
+
+    by_center = np.argsort(center, kind='stable')
+    sorted_center = center[by_center]
+
+    paragraphs = []
+    first = 0
+    while True:
+        while first < count and not remaining[first]:
+            first += 1
+        if first == count:
+            break
+
+        paragraph = [first]
+        remaining[first] = False
+        current = first
+        while True:
+            # Center strictly within the margins of the current line
+            start = np.searchsorted(sorted_center, left[current], side='right')
+            end = np.searchsorted(sorted_center, right[current], side='left')
+            candidates = by_center[start:end]
+            candidates = candidates[(candidates > current) & remaining[candidates]]
+            # is top of the candidate near bottom of our line?
+            candidates = candidates[(top[candidates] - bottom[current]) < (height[current] * .75)]
+            if not len(candidates):
+                break
+
+            current = int(candidates.min())
+            paragraph.append(current)
+            remaining[current] = False
+
+        paragraphs.append(paragraph)
+
+    return paragraphs
+
+
+def group_words(boxes):
+    """
+    Group words into lines and lines into paragraphs
+
+    :param boxes:  Word polygons of shape (N, points, 2)
+    :return list:  Paragraphs, each a list of lines, each a list of word indices
+    """
+    if not len(boxes):
+        return []
+    top, left, bottom, right = box_bounds(boxes)
+    lines = group_words_into_lines(top, left, bottom, right)
+
+    # Bounding box of each line
+    order = np.concatenate(lines)
+    starts = np.cumsum([0] + [len(line) for line in lines[:-1]])
+    line_bounds = (np.minimum.reduceat(top[order], starts),
+                   np.minimum.reduceat(left[order], starts),
+                   np.maximum.reduceat(bottom[order], starts),
+                   np.maximum.reduceat(right[order], starts))
+
+    paragraphs = group_lines_into_paragraphs(*line_bounds)
+    return [[lines[line] for line in paragraph] for paragraph in paragraphs]
+
+
+def group_lines(boxes):
+    """
+    Group already detected lines into paragraphs
+
+    :param boxes:  Line polygons of shape (N, points, 2)
+    :return list:  Paragraphs, each a list of line indices
+    """
+    if not len(boxes):
+        return []
+    return group_lines_into_paragraphs(*box_bounds(boxes))
@@ -0,0 +1,145 @@
+"""
+Cheap check for text in an image before running the OCR models on it
+"""
+import threading
+
+import numpy as np
+from PIL import Image
+
+__author__ = "Dale Wahl"
+__credits__ = ["Dale Wahl"]
+__maintainer__ = "Dale Wahl"
+__email__ = "4cat@oilab.eu"
+
+
+def thumbnail(image, size):
+    """
+    Downscale an image array so its longest side is at most `size`
+
+    :param np.ndarray image:  Image array of shape (height, width, channels) or (height, width)
+    :param int size:  Maximum width and height
+    :return tuple:  Thumbnail array and the (x, y) scale back to the original
+    """
+    height, width = image.shape[:2]
+    factor = size / max(height, width, 1)
+    if factor >= 1:
+        return image, (1, 1)
+    new_size = (max(1, round(width * factor)), max(1, round(height * factor)))
+    small = np.asarray(Image.fromarray(np.ascontiguousarray(image, dtype=np.uint8)).resize(new_size, Image.BOX))
+    return small, (width / new_size[0], height / new_size[1])
+
+
+def text_cells(image, size=1024, cell_size=16, edge_threshold=48, min_density=0.08):
+    """
+    Number of cells of a thumbnail that look like text
+
+    Text is dense, high contrast strokes in both directions: a cell counts
+    if at least `min_density` of its pixels are strong horizontal edges and
+    half that are strong vertical edges. Smooth photos and plain backgrounds
+    have none; busy textures such as foliage may score as text, which only
+    costs a model run.
+
+    :param np.ndarray image:  Image array of shape (height, width, channels) or (height, width)
+    :param int size:  Longest side of the thumbnail checked
+    :param int cell_size:  Width and height of cells in thumbnail pixels
+    :param int edge_threshold:  Brightness difference (0-255) between neighbouring pixels that counts as an edge
+    :param float min_density:  Fraction of strong edge pixels a cell needs
+    :return int:  Number of text-like cells
+    """
+    # Downscale before converting to grayscale; the channel order does not matter here
+    gray = thumbnail(np.asarray(image, dtype=np.uint8), size)[0]
+    if gray.ndim == 3:
+        gray = gray[:, :, :3].mean(axis=2)
+    gray = gray.astype(np.int16)
+    height, width = gray.shape[0] - 1, gray.shape[1] - 1
+    rows, columns = height // cell_size, width // cell_size
+    if not rows or not columns:
+        return 0
+
+    horizontal = np.abs(np.diff(gray, axis=1))[:height] > edge_threshold
+    vertical = np.abs(np.diff(gray, axis=0))[:, :width] > edge_threshold
+
+    def density(edges):
+        cells = edges[:rows * cell_size, :columns * cell_size].reshape(rows, cell_size, columns, cell_size)
+        return cells.mean(axis=(1, 3))
+
+    text_like = (density(horizontal) >= min_density) & (density(vertical) >= min_density / 2)
+    return int(text_like.sum())
+
+
+class TextPrefilter:
+    """
+    Text Pre-filter
+
+    Decides from a thumbnail whether an image may contain text, so images
+    without any can skip the full detector and recognizer. With the `edges`
+    method this is a contrast heuristic that takes milliseconds; with `detect`
+    the model's own text detector runs on the thumbnail, which is slower but
+    more reliable. Small text that does not survive downscaling to the
+    thumbnail is missed, so `size` should not be too small.
+    """
+    EDGES = 'edges'
+    DETECT = 'detect'
+    METHODS = (EDGES, DETECT)
+
+    def __init__(self, logger, method=EDGES, size=1024, min_cells=2):
+        """
+        :param logger:  Logger
+        :param str method:  One of METHODS
+        :param int size:  Longest side of the thumbnail checked
+        :param int min_cells:  Text-like cells needed with the `edges` method; a short word
+                               in the thumbnail covers a few
+        """
+        if method not in self.METHODS:
+            raise ValueError('Text pre-filter method must be one of %s' % ', '.join(self.METHODS))
+        self.log = logger
+        self.method = method
+        self.size = max(32, int(size))
+        self.min_cells = max(1, int(min_cells))
+        self._lock = threading.Lock()
+
+        # Counters
+        self.checked = 0
+        self.skipped = 0
+
+    @property
+    def signature(self):
+        """
+        Settings that change which images are skipped, for cache keys
+        """
+        if self.method == self.EDGES:
+            return '%s:%s:%s' % (self.method, self.size, self.min_cells)
+        return '%s:%s' % (self.method, self.size)
+
+    def has_text(self, image, detect=None):
+        """
+        Check whether an image may contain text
+
+        :param np.ndarray image:  Preprocessed image array
+        :param detect:  Callable that finds text boxes in a list of images, such as
+                        a pipeline's `detect`; required for the `detect` method
+        :return bool:  False if the image can be skipped
+        """
+        if not isinstance(image, np.ndarray):
+            # Left for the model to read; nothing to check
+            return True
+        if self.method == self.DETECT:
+            found = len(detect([thumbnail(image, self.size)[0]])[0]) > 0
+        else:
+            found = text_cells(image, self.size) >= self.min_cells
+
+        with self._lock:
+            self.checked += 1
+            if not found:
+                self.skipped += 1
+        return found
+
+    def stats(self):
+        """
+        Counts of checked and skipped images
+        """
+        with self._lock:
+            return {'method': self.method,
+                    'checked': self.checked,
+                    'skipped': self.skipped,
+                    'skip_rate': self.skipped / self.checked if self.checked else 0.0}
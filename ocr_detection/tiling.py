@@ -0,0 +1,80 @@
+"""
+Splitting of large images into overlapping tiles and merging of the boxes found in them
+"""
+import numpy as np
+
+from ocr_detection.text_grouping import box_bounds
+
+__author__ = "Dale Wahl"
+__credits__ = ["Dale Wahl"]
+__maintainer__ = "Dale Wahl"
+__email__ = "4cat@oilab.eu"
+
+
+def tile_starts(length, tile_size, overlap):
+    """
+    Start positions of tiles covering a length, with at least `overlap`
+    between consecutive tiles; the last tile ends at the end
+
+    :return list:  Start positions
+    """
+    if length <= tile_size:
+        return [0]
+    step = max(1, tile_size - overlap)
+    starts = list(range(0, length - tile_size, step))
+    starts.append(length - tile_size)
+    return starts
+
+
+def split_tiles(image, tile_size, overlap=128):
+    """
+    Split an image into overlapping tiles of at most `tile_size` by `tile_size`
+
+    A side that fits within `tile_size` is not split, so lines of text in a
+    tall screenshot stay whole.
+
+    :param np.ndarray image:  Image array of shape (height, width, channels)
+    :param int tile_size:  Maximum width and height of tiles
+    :param int overlap:  Minimum overlap between neighbouring tiles; should be
+                         larger than the height of a line of text
+    :return list:  (tile, (x, y) offset of the tile) tuples
+    """
+    height, width = image.shape[:2]
+    overlap = min(overlap, tile_size // 2)
+    return [(np.ascontiguousarray(image[y:y + tile_size, x:x + tile_size]), (x, y))
+            for y in tile_starts(height, tile_size, overlap)
+            for x in tile_starts(width, tile_size, overlap)]
+
+
+def deduplicate_boxes(boxes, tile_ids, threshold=0.5):
+    """
+    Find the boxes to keep after merging the boxes of overlapping tiles
+
+    Text in the overlap of two tiles is found in both, often cut off at the
+    edge of one of them. Boxes are visited from large to small, and a box is
+    dropped if more than `threshold` of its area lies within a kept box from
+    another tile; the larger, most complete box is kept.
+
+    :param np.ndarray boxes:  Boxes of shape (N, points, 2) in image coordinates
+    :param tile_ids:  Tile each box was found in
+    :param float threshold:  Fraction of a box's area that must be covered to drop it
+    :return np.ndarray:  Indices of the boxes to keep, in their original order
+    """
+    if not len(boxes):
+        return np.zeros(0, dtype=int)
+    top, left, bottom, right = box_bounds(boxes)
+    tile_ids = np.asarray(tile_ids)
+    area = np.maximum(bottom - top, 0) * np.maximum(right - left, 0)
+
+    kept = []
+    for index in np.argsort(-area, kind='stable'):
+        if kept:
+            others = np.array(kept)
+            others = others[tile_ids[others] != tile_ids[index]]
+            overlap_width = np.minimum(right[others], right[index]) - np.maximum(left[others], left[index])
+            overlap_height = np.minimum(bottom[others], bottom[index]) - np.maximum(top[others], top[index])
+            covered = np.maximum(overlap_width, 0) * np.maximum(overlap_height, 0)
+            if len(covered) and covered.max() > threshold * max(area[index], 1e-9):
+                continue
+        kept.append(index)
+    return np.sort(np.array(kept, dtype=int))
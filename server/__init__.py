@@ -1,18 +1,18 @@
 from flask import Flask, abort, request
 import logging
 import os
-import yaml
 
+from server.config import WatchedConfig
 from ocr_detection.image_handler import ImageTextDetector
+from ocr_detection.job_queue import JobQueue
+from ocr_detection.result_cache import ResultCache
+from ocr_detection.duplicate_index import DuplicateIndex
+from ocr_detection.text_prefilter import TextPrefilter
+from common.url_fetching import UrlFetcher
 
-def update_config(config_filepath='config.yml'):
-    # Import config options
-    with open(config_filepath) as file:
-        config_data = yaml.load(file, Loader=yaml.FullLoader)
-    return config_data
-
-# Import config options
-config_data = update_config()
+# Import config options; reloaded whenever config.yml changes
+config = WatchedConfig()
+config_data = config.data
 
 # Flask application instance
 app = Flask(__name__)
@@ -37,6 +37,7 @@ levels = {
     "FATAL": logging.FATAL
 }
 app.logger.setLevel(levels[config_data.get('LOG_LEVEL', 'INFO')])
+config.log = app.logger
 
 # # Test logs
 # app.logger.debug('this is a DEBUG message')
@@ -55,8 +56,14 @@ for folder in [app.config['IMAGE_FOLDER']]:
     if not os.path.isdir(folder):
         os.makedirs(folder)
 
-# Limit size of upload; 16 * 1024 * 1024 is 16 megabytes
-#app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+# Limit size of requests and of each image; 16 * 1024 * 1024 is 16 megabytes
+app.config['MAX_CONTENT_LENGTH'] = config_data.get('MAX_REQUEST_MB', 128) * 1024 * 1024
+app.config['MAX_IMAGE_BYTES'] = config_data.get('MAX_IMAGE_MB', 16) * 1024 * 1024
+# Limit of width * height, checked from the image header before decoding
+app.config['MAX_IMAGE_PIXELS'] = config_data.get('MAX_IMAGE_PIXELS', 100000000)
+
+# Maximum number of images accepted by a single batch request
+app.config['MAX_BATCH_IMAGES'] = config_data.get('MAX_BATCH_IMAGES', 64)
 
 # Allowed upload extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
@@ -67,9 +74,8 @@ def limit_remote_addr():
     """
     Checks the incoming IP address and compares with whitelist
     """
-    config_data = update_config()
-    trusted_proxies = config_data.get('TRUSTED_PROXIES')
-    ip_whitelist = config_data.get('IP_WHITELIST')
+    trusted_proxies = config.trusted_proxies
+    ip_whitelist = config.ip_whitelist
 
     if ip_whitelist:
         # # Allow all to view plots
@@ -90,11 +96,63 @@ def limit_remote_addr():
 # Set default OCR model
 app.config['DEFAULT_MODEL'] = config_data.get('DEFAULT_MODEL', 'paddleocr')
 
+# Cache OCR results; a CACHE_SIZE of 0 disables the cache
+result_cache = None
+if config_data.get('CACHE_SIZE', 1024):
+    cache_dir = config_data.get('CACHE_DIR')
+    result_cache = ResultCache(logger=app.logger, max_size=config_data.get('CACHE_SIZE', 1024),
+                               cache_dir=os.path.join(path, cache_dir) if cache_dir else None)
+
+# Reuse results of near-duplicate images; a NEAR_DUPLICATE_DISTANCE of 0 disables the index
+duplicate_index = None
+if config_data.get('NEAR_DUPLICATE_DISTANCE', 0):
+    duplicate_index = DuplicateIndex(logger=app.logger, max_distance=config_data.get('NEAR_DUPLICATE_DISTANCE'),
+                                     max_size=config_data.get('NEAR_DUPLICATE_SIZE', 10000))
+
+# Skip the models for images without text; a blank TEXT_PREFILTER runs the models on every image
+text_prefilter = None
+if config_data.get('TEXT_PREFILTER'):
+    text_prefilter = TextPrefilter(logger=app.logger, method=config_data.get('TEXT_PREFILTER'),
+                                   size=config_data.get('TEXT_PREFILTER_SIZE', 1024),
+                                   min_cells=config_data.get('TEXT_PREFILTER_MIN_CELLS', 2))
+
 # Instantiate our OCR detector
-detector = ImageTextDetector(logger=app.logger, temp_image_dir=app.config['IMAGE_FOLDER'])
-# Load models on startup
-for model in ['paddle_ocr', 'keras_ocr']:
-    detector.get_model(model_type=model)
+detector = ImageTextDetector(logger=app.logger, temp_image_dir=app.config['IMAGE_FOLDER'],
+                             batch_size=config_data.get('BATCH_SIZE', 8), cache=result_cache,
+                             batch_window_ms=config_data.get('BATCH_WINDOW_MS', 0),
+                             max_side=config_data.get('MAX_SIDE') or None,
+                             paddle_lang=config_data.get('PADDLE_LANG', 'en'),
+                             max_paddle_languages=config_data.get('PADDLE_MAX_LANGUAGES', 2),
+                             max_frames=config_data.get('MAX_FRAMES') or None, duplicate_index=duplicate_index,
+                             tile_size=config_data.get('TILE_SIZE') or None,
+                             tile_overlap=config_data.get('TILE_OVERLAP', 128),
+                             model_replicas=config_data.get('MODEL_REPLICAS', 1),
+                             checkout_timeout=config_data.get('MODEL_CHECKOUT_TIMEOUT', 30),
+                             backend_options=config_data.get('BACKEND_OPTIONS') or {},
+                             text_prefilter=text_prefilter,
+                             coalesce=config_data.get('COALESCE_REQUESTS', True))
+# Background workers for submitted jobs
+job_queue = JobQueue(detector=detector, logger=app.logger, workers=config_data.get('JOB_WORKERS', 2),
+                     max_queue=config_data.get('JOB_QUEUE_SIZE', 100), ttl=config_data.get('JOB_TTL', 3600))
+
+# Download images given by URL; off unless URL_FETCH_WORKERS is set
+url_fetcher = None
+if config_data.get('URL_FETCH_WORKERS', 0):
+    url_fetcher = UrlFetcher(logger=app.logger, workers=config_data.get('URL_FETCH_WORKERS'),
+                             per_host=config_data.get('URL_FETCH_PER_HOST', 4),
+                             timeout=config_data.get('URL_FETCH_TIMEOUT', 10),
+                             max_bytes=app.config['MAX_IMAGE_BYTES'], max_pixels=app.config['MAX_IMAGE_PIXELS'],
+                             allow_private=config_data.get('URL_FETCH_ALLOW_PRIVATE', False))
+
+# Load models on startup; others are only imported and loaded when first requested
+app.config['PRELOAD_MODELS'] = config_data.get('PRELOAD_MODELS') or [app.config['DEFAULT_MODEL']]
+app.config['PRELOAD_BEFORE_FORK'] = config_data.get('PRELOAD_BEFORE_FORK', False)
+if app.config['PRELOAD_BEFORE_FORK']:
+    # With gunicorn --preload this runs once in the master process, so forked workers share the weights
+    # copy-on-write; inference only starts after the fork, see post_fork in gunicorn.conf.py
+    detector.preload(app.config['PRELOAD_MODELS'], background=False, warm_up=False)
+else:
+    detector.preload(app.config['PRELOAD_MODELS'], background=config_data.get('PRELOAD_IN_BACKGROUND', True))
 
 # Import flask API endpoints
 import server.api
@@ -1,10 +1,14 @@
-import json
+import time
+
 from flask import request, jsonify
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
-from server import app, detector
-from server.functions import allowed_file
-from common.exceptions import TextDetectionException, OCRModelTypeNotAvailableException
+from server import app, detector, job_queue, url_fetcher
+from server.functions import allowed_file, detection_options, output_level, prepare_result, read_raw_upload, \
+    serialized_response, validate_upload
+from common.exceptions import TextDetectionException, OCRModelTypeNotAvailableException, JobQueueFullException, \
+    InvalidImageException, ImageDownloadException, ModelBusyException
 
 
 @app.route('/api/detect_text', methods=['POST'])
@@ -13,45 +17,307 @@ def upload_photo_api():
     Upload a single photo and receive a json with detected text.
 
     files = {'image': open('image_1.jpg', 'rb')}
+    data = {'model_type': 'paddle_ocr', 'lang': 'german', 'use_cache': 'false', 'output': 'text', 'max_side': 1600}  # optional
+
+    The image can also be sent as the raw request body with the
+    `application/octet-stream` content type; options are then passed in the
+    query string (e.g. `/api/detect_text?model_type=keras_ocr&filename=image_1.jpg`).
+
+    Instead of uploading it, the image can be given by URL for the server to download:
+    data = {'url': 'https://example.com/image_1.jpg'}
+
+    Only text boxes are returned with 'mode': 'detect', and only the text in
+    given boxes is recognized with 'mode': 'recognize':
+    data = {'mode': 'recognize', 'regions': json.dumps([[x1, y1, x2, y2], [x1, y1, x2, y2, x3, y3, x4, y4]])}
     """
+    start = time.perf_counter()
+    raw_upload = request.mimetype == 'application/octet-stream'
     # Select for model_type for detector
-    request_data = request.form.to_dict()
+    request_data = request.args.to_dict() if raw_upload else request.form.to_dict()
     if request_data is None or 'model_type' not in request_data:
         # Default model_type
         model_type = app.config['DEFAULT_MODEL']
     else:
         model_type = request_data['model_type']
 
-    image = request.files.get('image', None)
-    if image and allowed_file(image.filename):
-        filename = secure_filename(image.filename)
-        app.logger.info(f'Processing {filename}')
+    try:
+        level = output_level()
+        options = detection_options(request_data)
+    except ValueError as e:
+        return jsonify({'reason': str(e)}), 400
 
+    # Uploads take precedence over a URL
+    url = request_data.get('url') if not raw_upload and 'image' not in request.files else None
+    if raw_upload:
         try:
-            annotations = detector.process_image(image, model_type)
-        except TextDetectionException as e:
+            image = read_raw_upload()
+        except RequestEntityTooLarge as e:
+            return jsonify({'reason': e.description}), 413
+        except InvalidImageException as e:
             return jsonify({'reason': str(e)}), 400
-        except OCRModelTypeNotAvailableException as e:
+    elif url:
+        if url_fetcher is None:
+            return jsonify({'reason': 'Images given by URL are not accepted'}), 400
+        try:
+            image = url_fetcher.fetch(url)
+        except (ImageDownloadException, InvalidImageException) as e:
             return jsonify({'reason': str(e)}), 400
-        except Exception as e:
-            app.logger.error(str(e))
-            return jsonify({'reason': 'Unable to process request'}), 500
+    else:
+        image = request.files.get('image', None)
+        if not image or not allowed_file(image.filename):
+            app.logger.warning('No image received')
+            return jsonify({'reason': 'No image received'}), 400
+        try:
+            validate_upload(image)
+        except RequestEntityTooLarge as e:
+            return jsonify({'reason': e.description}), 413
+        except InvalidImageException as e:
+            return jsonify({'reason': str(e)}), 400
+
+    filename = secure_filename(image.filename)
+    app.logger.info(f'Processing {filename}')
+    parsed = time.perf_counter()
 
-        # Check that raw_output is a jsonifable object
+    try:
+        annotations = detector.process_image(image, model_type, **options)
+        if url:
+            annotations['url'] = url
+    except (TextDetectionException, ValueError) as e:
+        return jsonify({'reason': str(e)}), 400
+    except OCRModelTypeNotAvailableException as e:
+        return jsonify({'reason': str(e)}), 400
+    except ModelBusyException as e:
+        return jsonify({'reason': str(e)}), 503
+    except Exception as e:
+        app.logger.error(str(e))
+        return jsonify({'reason': 'Unable to process request'}), 500
+
+    # Return the text annotations
+    with detector.metrics.timer('serialization', model_type):
+        response = serialized_response(prepare_result(annotations, level), 200)
+    detector.metrics.observe('request_parsing', model_type, parsed - start)
+    detector.metrics.observe('request_total', model_type, time.perf_counter() - start)
+    return response
+
+
+@app.route('/api/detect_text_batch', methods=['POST'])
+def upload_photos_api():
+    """
+    Upload multiple photos and receive a json with detected text for each.
+
+    Results are returned in the same order as the uploaded images, followed
+    by those of images given by URL, which are downloaded while earlier
+    images are being processed.
+
+    files = [('images', open('image_1.jpg', 'rb')), ('images', open('image_2.jpg', 'rb'))]
+    data = {'urls': ['https://example.com/image_3.jpg', 'https://example.com/image_4.jpg']}  # optional
+    """
+    start = time.perf_counter()
+    # Select for model_type for detector
+    request_data = request.form.to_dict()
+    if request_data is None or 'model_type' not in request_data:
+        # Default model_type
+        model_type = app.config['DEFAULT_MODEL']
+    else:
+        model_type = request_data['model_type']
+
+    try:
+        level = output_level()
+        options = detection_options(request_data)
+    except ValueError as e:
+        return jsonify({'reason': str(e)}), 400
+
+    images = request.files.getlist('images')
+    urls = request.form.getlist('urls')
+    if not images and not urls:
+        app.logger.warning('No images received')
+        return jsonify({'reason': 'No images received'}), 400
+    if urls and url_fetcher is None:
+        return jsonify({'reason': 'Images given by URL are not accepted'}), 400
+    if len(images) + len(urls) > app.config['MAX_BATCH_IMAGES']:
+        return jsonify({'reason': 'Too many images; maximum is %i' % app.config['MAX_BATCH_IMAGES']}), 400
+
+    # Only send allowed files to the detector, but keep a result for each upload
+    results = [None] * len(images)
+    accepted = []
+    for index, image in enumerate(images):
+        if not image or not allowed_file(image.filename):
+            results[index] = {'filename': image.filename, 'model_type': model_type,
+                              'success': False, 'error': 'File type not allowed'}
+            continue
         try:
-            annotations['raw_output'] = json.dumps(annotations['raw_output'])
-        except TypeError as e:
-            if 'is not JSON serializable' in str(e):
-                app.logger.warning('Model %s returning non JSON serializable objects: %s' % (model_type, str(e)))
-            else:
-                app.logger.error(e)
-            del annotations['raw_output']
-
-        # Return the text annotations
-        return annotations, 200
+            validate_upload(image)
+        except (InvalidImageException, RequestEntityTooLarge) as e:
+            results[index] = {'filename': image.filename, 'model_type': model_type,
+                              'success': False, 'error': getattr(e, 'description', None) or str(e)}
+            continue
+        accepted.append(index)
+
+    if options['mode'] == detector.RECOGNIZE:
+        # One list of regions per uploaded image
+        if urls:
+            return jsonify({'reason': 'Recognize mode only supports uploaded images'}), 400
+        if not isinstance(options['regions'], list) or len(options['regions']) != len(images):
+            return jsonify({'reason': 'regions must contain a list of boxes for each image'}), 400
+        options['regions'] = [options['regions'][index] for index in accepted]
+    app.logger.info(f'Processing batch of {len(accepted)} images and {len(urls)} URLs')
+    parsed = time.perf_counter()
+
+    try:
+        annotations = detector.process_images([images[index] for index in accepted], model_type, **options) if accepted else []
+        url_annotations = [result for batch in url_fetcher.process_urls(detector, urls, model_type, **options)
+                           for result in batch] if urls else []
+    except (TextDetectionException, ValueError) as e:
+        return jsonify({'reason': str(e)}), 400
+    except OCRModelTypeNotAvailableException as e:
+        return jsonify({'reason': str(e)}), 400
+    except ModelBusyException as e:
+        return jsonify({'reason': str(e)}), 503
+    except Exception as e:
+        app.logger.error(str(e))
+        return jsonify({'reason': 'Unable to process request'}), 500
+
+    with detector.metrics.timer('serialization', model_type):
+        for index, annotation in zip(accepted, annotations):
+            results[index] = prepare_result(annotation, level)
+        results.extend(prepare_result(annotation, level) for annotation in url_annotations)
+        response = serialized_response({'results': results}, 200)
+    detector.metrics.observe('request_parsing', model_type, parsed - start)
+    detector.metrics.observe('request_total', model_type, time.perf_counter() - start)
+    return response
+
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job_api():
+    """
+    Submit one or more photos for processing in the background and receive a
+    job ID to poll for the results.
+
+    files = [('images', open('image_1.jpg', 'rb')), ('images', open('image_2.jpg', 'rb'))]
+    """
+    # Select for model_type for detector
+    request_data = request.form.to_dict()
+    if request_data is None or 'model_type' not in request_data:
+        # Default model_type
+        model_type = app.config['DEFAULT_MODEL']
     else:
-        app.logger.warning('No image received')
-        return jsonify({'reason': 'No image received'}), 400
+        model_type = request_data['model_type']
+
+    try:
+        options = detection_options(request_data)
+    except ValueError as e:
+        return jsonify({'reason': str(e)}), 400
+
+    images = request.files.getlist('images') or request.files.getlist('image')
+    images = [image for image in images if image and allowed_file(image.filename)]
+    if not images:
+        app.logger.warning('No images received')
+        return jsonify({'reason': 'No images received'}), 400
+    if len(images) > app.config['MAX_BATCH_IMAGES']:
+        return jsonify({'reason': 'Too many images; maximum is %i' % app.config['MAX_BATCH_IMAGES']}), 400
+
+    try:
+        for image in images:
+            validate_upload(image)
+    except RequestEntityTooLarge as e:
+        return jsonify({'reason': e.description}), 413
+    except InvalidImageException as e:
+        return jsonify({'reason': '%s: %s' % (image.filename, str(e))}), 400
+
+    if options['mode'] == detector.RECOGNIZE and (not isinstance(options['regions'], list)
+                                                  or len(options['regions']) != len(images)):
+        return jsonify({'reason': 'regions must contain a list of boxes for each image'}), 400
+
+    # Uploads are gone once the request ends, so read them now
+    images = [(image.filename, image.read()) for image in images]
+    try:
+        job_id = job_queue.submit(images, model_type, **options)
+    except JobQueueFullException as e:
+        return jsonify({'reason': str(e)}), 503
+
+    return jsonify({'job_id': job_id, 'status': job_queue.QUEUED}), 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status_api(job_id):
+    """
+    Get the status of a submitted job. Once finished, the results are included
+    and the job is removed from the server.
+    """
+    try:
+        level = output_level()
+    except ValueError as e:
+        return jsonify({'reason': str(e)}), 400
+
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'reason': 'Unknown or expired job'}), 404
+
+    if job['results'] is not None:
+        job['results'] = [prepare_result(result, level) for result in job['results']]
+    return serialized_response(job, 200)
+
+
+@app.route('/api/models', methods=['GET'])
+def models_api():
+    """
+    Model types that can be requested, with their languages and supported modes
+    """
+    return jsonify({'default': app.config['DEFAULT_MODEL'],
+                    'models': detector.backends(),
+                    'loaded': detector.status()['loaded']}), 200
+
+
+@app.route('/api/stats', methods=['GET'])
+def stats_api():
+    """
+    Counters for the result cache, near-duplicate index, text pre-filter, request coalescing, job queue,
+    batching of concurrent requests and model replicas
+    """
+    return jsonify({'cache': detector.cache.stats() if detector.cache is not None else None,
+                    'near_duplicates': detector.duplicate_index.stats() if detector.duplicate_index is not None else None,
+                    'text_prefilter': detector.text_prefilter.stats() if detector.text_prefilter is not None else None,
+                    'coalescing': detector.in_flight.stats() if detector.in_flight is not None else None,
+                    'jobs': job_queue.stats(),
+                    'batching': detector.batch_stats(),
+                    'models': detector.pool_stats()}), 200
+
+
+@app.route('/health/live', methods=['GET'])
+def liveness_api():
+    """
+    The server is running
+    """
+    return jsonify({'status': 'alive'}), 200
+
+
+@app.route('/health/ready', methods=['GET'])
+def readiness_api():
+    """
+    All preloaded models are loaded and warmed up
+    """
+    status = detector.status()
+    ready = all(model_type in status['warm'] for model_type in app.config['PRELOAD_MODELS'])
+    status['status'] = 'ready' if ready else 'loading'
+    return jsonify(status), 200 if ready else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_prometheus():
+    """
+    Stage latencies, outcome counters, in-flight requests and model load times
+    in the Prometheus text format
+    """
+    return app.response_class(detector.metrics.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_api():
+    """
+    Stage latencies, outcome counters, in-flight requests and model load times
+    as JSON
+    """
+    return jsonify(detector.metrics.to_dict()), 200
 
 
 @app.errorhandler(Exception)
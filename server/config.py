@@ -0,0 +1,74 @@
+"""
+Configuration loaded from config.yml, reloaded when the file changes
+"""
+import logging
+import os
+import threading
+import time
+
+import yaml
+
+from common.address_set import AddressSet
+
+
+def update_config(config_filepath='config.yml'):
+    # Import config options
+    with open(config_filepath) as file:
+        config_data = yaml.load(file, Loader=yaml.FullLoader)
+    return config_data
+
+
+class WatchedConfig:
+    """
+    Config file that is only parsed again once its modification time changes
+
+    The file is checked at most once per `check_interval` seconds, and the IP
+    whitelist and trusted proxies are compiled into AddressSets on each load.
+    """
+    def __init__(self, config_filepath='config.yml', check_interval=1.0, logger=None):
+        self.config_filepath = config_filepath
+        self.check_interval = check_interval
+        self.log = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = 0
+        self._load(os.stat(config_filepath).st_mtime)
+
+    def _load(self, mtime):
+        data = update_config(self.config_filepath) or {}
+        # Swap in all at once so readers never see a half updated config
+        self._state = (data,
+                       AddressSet(data.get('IP_WHITELIST'), self.log, name='IP_WHITELIST'),
+                       AddressSet(data.get('TRUSTED_PROXIES'), self.log, name='TRUSTED_PROXIES'))
+        self._mtime = mtime
+
+    def _current(self):
+        now = time.monotonic()
+        if now - self._checked >= self.check_interval:
+            with self._lock:
+                if now - self._checked >= self.check_interval:
+                    self._checked = now
+                    try:
+                        mtime = os.stat(self.config_filepath).st_mtime
+                        if mtime != self._mtime:
+                            self.log.info('Reloading %s' % self.config_filepath)
+                            self._load(mtime)
+                    except (OSError, yaml.YAMLError) as e:
+                        # Keep using the last good config
+                        self.log.error('Unable to reload %s: %s' % (self.config_filepath, str(e)))
+        return self._state
+
+    @property
+    def data(self):
+        return self._current()[0]
+
+    @property
+    def ip_whitelist(self):
+        return self._current()[1]
+
+    @property
+    def trusted_proxies(self):
+        return self._current()[2]
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
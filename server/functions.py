@@ -1,17 +1,171 @@
+from io import BytesIO
+import gzip
+import json
 import os
 import uuid
 
-from flask import jsonify, abort, send_file, render_template
+from flask import jsonify, abort, send_file, render_template, request
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
+from common import serialization
+from common.image_validation import check_header, sniff_image, validate_image
+from ocr_detection.image_handler import ImageTextDetector
 from server import app, ALLOWED_EXTENSIONS
 
+# Only compress responses larger than this many bytes
+GZIP_MIN_SIZE = 1024
+# Bytes read at a time from raw uploads, and read to check the header of uploaded files
+CHUNK_SIZE = 64 * 1024
+
 def allowed_file(filename, extensions=ALLOWED_EXTENSIONS):
     """
     Check filenames to ensure they are an allowed extension
     """
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in extensions
 
+def read_raw_upload():
+    """
+    Stream an `application/octet-stream` request body into memory
+
+    The body is refused as soon as it exceeds MAX_IMAGE_BYTES, or once its
+    first bytes show it is not a supported image or exceeds MAX_IMAGE_PIXELS;
+    the dimensions must be in its first `image_validation.HEADER_BYTES`.
+
+    :return FileStorage:  The uploaded image
+    :raises RequestEntityTooLarge:  If the body is too large
+    :raises InvalidImageException:  If the body is not an acceptable image
+    """
+    max_bytes = app.config['MAX_IMAGE_BYTES']
+    if request.content_length is not None and request.content_length > max_bytes:
+        raise RequestEntityTooLarge('Image exceeds %i bytes' % max_bytes)
+
+    buffer = BytesIO()
+    header_checked = False
+    while True:
+        chunk = request.stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer.write(chunk)
+        if buffer.tell() > max_bytes:
+            raise RequestEntityTooLarge('Image exceeds %i bytes' % max_bytes)
+        if not header_checked:
+            header_checked = check_header(buffer, app.config['MAX_IMAGE_PIXELS'])
+
+    image_format, _, _ = validate_image(buffer.getvalue(), app.config['MAX_IMAGE_PIXELS'])
+    filename = secure_filename(request.args.get('filename', '')) or 'upload.%s' % image_format
+    buffer.seek(0)
+    return FileStorage(stream=buffer, filename=filename, content_type='image/%s' % image_format)
+
+def validate_upload(image):
+    """
+    Check the size and header of an uploaded file without decoding it
+
+    :raises RequestEntityTooLarge:  If the file is too large
+    :raises InvalidImageException:  If the file is not an acceptable image
+    """
+    stream = image.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    if size > app.config['MAX_IMAGE_BYTES']:
+        stream.seek(0)
+        raise RequestEntityTooLarge('Image exceeds %i bytes' % app.config['MAX_IMAGE_BYTES'])
+
+    stream.seek(0)
+    header = stream.read(CHUNK_SIZE)
+    if sniff_image(header)[1] is None and size > len(header):
+        # e.g. a JPEG with large metadata before the frame header
+        header += stream.read()
+    stream.seek(0)
+    validate_image(header, app.config['MAX_IMAGE_PIXELS'])
+
+def form_flag(request_data, name, default=True):
+    """
+    Read a boolean option from submitted form data
+    """
+    value = request_data.get(name) if request_data else None
+    if value is None or value == '':
+        return default
+    return str(value).lower() not in ('0', 'false', 'no', 'off')
+
+def form_int(request_data, name, default=None):
+    """
+    Read a positive integer option from submitted form data; raises
+    ValueError if it is not one
+    """
+    value = request_data.get(name) if request_data else None
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value <= 0:
+        raise ValueError('%s must be a positive integer' % name)
+    return value
+
+def detection_options(request_data):
+    """
+    Options for ImageTextDetector.process_images from submitted form data;
+    raises ValueError if any is invalid
+    """
+    options = {'use_cache': form_flag(request_data, 'use_cache'),
+               'prefilter': form_flag(request_data, 'prefilter'),
+               'max_side': form_int(request_data, 'max_side'),
+               'max_frames': form_int(request_data, 'max_frames'),
+               'tile_size': form_int(request_data, 'tile_size')}
+    if request_data and request_data.get('lang'):
+        options['lang'] = request_data['lang']
+
+    options['mode'] = (request_data.get('mode') if request_data else None) or ImageTextDetector.FULL
+    if options['mode'] not in ImageTextDetector.MODES:
+        raise ValueError('mode must be one of %s' % ', '.join(ImageTextDetector.MODES))
+    if options['mode'] == ImageTextDetector.RECOGNIZE:
+        try:
+            options['regions'] = json.loads(request_data.get('regions') or '')
+        except ValueError:
+            raise ValueError('regions must be a JSON list of boxes')
+    return options
+
+def output_level():
+    """
+    Requested level of detail of results; raises ValueError if unknown
+    """
+    level = request.values.get('output', serialization.LEGACY)
+    if level not in serialization.OUTPUT_LEVELS:
+        raise ValueError('Output must be one of %s' % ', '.join(serialization.OUTPUT_LEVELS))
+    return level
+
+def prepare_result(result, level):
+    """
+    Reduce a result to the requested level of detail
+    """
+    return serialization.prepare_result(result, level, logger=app.logger)
+
+def serialized_response(data, status=200):
+    """
+    Encode a response in a single pass, as msgpack if requested and gzipped if
+    the client accepts it
+    """
+    encoding = request.values.get('encoding', serialization.JSON)
+    if encoding == serialization.JSON and request.accept_mimetypes.best == 'application/msgpack':
+        encoding = serialization.MSGPACK
+
+    try:
+        body, mimetype = serialization.encode(data, encoding)
+    except ValueError as e:
+        return jsonify({'reason': str(e)}), 400
+    compress = len(body) >= GZIP_MIN_SIZE and 'gzip' in request.accept_encodings
+    if compress:
+        body = gzip.compress(body, compresslevel=5)
+
+    response = app.response_class(body, status=status, mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
 def dir_listing(base_dir, req_path, template):
     # Joining the upload folder and the requested path
     abs_path = os.path.join(base_dir, req_path)
@@ -14,8 +14,9 @@ setup(
         'gunicorn',
         'pyyaml',
         'flask',
+        'requests',
         'tensorflow',
         'paddlepaddle',
-        'paddleocr',
+        'paddleocr==2.7.3',
     ]
 )
@@ -0,0 +1,49 @@
+"""
+Tests of IP address and CIDR range matching
+"""
+import logging
+
+from common.address_set import AddressSet
+
+
+def test_single_addresses():
+    addresses = AddressSet(['127.0.0.1', '::1'])
+    assert '127.0.0.1' in addresses
+    assert '::1' in addresses
+    assert '127.0.0.2' not in addresses
+
+
+def test_cidr_ranges():
+    addresses = AddressSet(['172.17.0.0/16', '10.1.2.0/24', '2001:db8::/32'])
+    assert '172.17.0.1' in addresses
+    assert '172.17.255.254' in addresses
+    assert '172.18.0.1' not in addresses
+    assert '10.1.2.99' in addresses
+    assert '10.1.3.1' not in addresses
+    assert '2001:db8:1::5' in addresses
+    assert '2001:db9::5' not in addresses
+
+
+def test_host_bits_in_range_are_ignored():
+    assert '192.168.1.200' in AddressSet(['192.168.1.77/24'])
+
+
+def test_ipv4_mapped_clients():
+    assert '::ffff:172.17.0.5' in AddressSet(['172.17.0.0/16'])
+
+
+def test_invalid_client_address():
+    assert 'not an address' not in AddressSet(['0.0.0.0/0'])
+
+
+def test_unconfigured_set_is_false():
+    assert not AddressSet(None)
+    assert not AddressSet([])
+
+
+def test_only_invalid_entries_match_no_one(caplog):
+    with caplog.at_level(logging.ERROR):
+        addresses = AddressSet(['localhost', '300.1.1.1'], name='IP_WHITELIST')
+    assert addresses
+    assert '127.0.0.1' not in addresses
+    assert 'IP_WHITELIST' in caplog.text
@@ -0,0 +1,92 @@
+"""
+Tests of batching images of concurrent callers
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+import pytest
+
+from common.exceptions import ModelBusyException
+from ocr_detection.batch_scheduler import BatchScheduler
+
+
+class FakeModel:
+    """
+    Predicts the double of each image, and fails on batches with a negative image
+    """
+    def __init__(self):
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def predict(self, images):
+        with self._lock:
+            self.batches.append(list(images))
+        if any(image < 0 for image in images):
+            raise ValueError('Cannot read image %s' % min(images))
+        return [image * 2 for image in images]
+
+
+class BusyModel:
+    def __init__(self):
+        self.calls = 0
+
+    def predict(self, images):
+        self.calls += 1
+        raise ModelBusyException('No model available')
+
+
+def predict_concurrently(scheduler, images):
+    """
+    Submit each image from its own thread; returns predictions or exceptions
+    """
+    def predict(image):
+        try:
+            return scheduler.predict([image])[0]
+        except Exception as e:
+            return e
+    with ThreadPoolExecutor(len(images)) as executor:
+        return list(executor.map(predict, images))
+
+
+def test_predictions_go_to_their_callers():
+    model = FakeModel()
+    scheduler = BatchScheduler(model, logging.getLogger('test'), max_batch_size=8, max_wait_ms=100)
+    try:
+        assert predict_concurrently(scheduler, [1, 2, 3, 4]) == [2, 4, 6, 8]
+    finally:
+        scheduler.stop()
+    assert max(len(batch) for batch in model.batches) > 1
+
+
+def test_failing_image_only_fails_its_caller():
+    model = FakeModel()
+    scheduler = BatchScheduler(model, logging.getLogger('test'), max_batch_size=8, max_wait_ms=100)
+    try:
+        results = predict_concurrently(scheduler, [1, -1, 3])
+    finally:
+        scheduler.stop()
+    assert results[0] == 2
+    assert isinstance(results[1], ValueError)
+    assert results[2] == 6
+
+
+def test_busy_model_fails_batch_without_retries():
+    model = BusyModel()
+    scheduler = BatchScheduler(model, logging.getLogger('test'), max_batch_size=8, max_wait_ms=100)
+    try:
+        results = predict_concurrently(scheduler, [1, 2, 3, 4])
+    finally:
+        scheduler.stop()
+    assert all(isinstance(result, ModelBusyException) for result in results)
+    # One call per batch, none per image
+    assert model.calls < len(results)
+
+
+def test_stopped_scheduler_runs_model_directly():
+    model = FakeModel()
+    scheduler = BatchScheduler(model, logging.getLogger('test'))
+    scheduler.stop()
+    assert scheduler.predict([5]) == [10]
+    with pytest.raises(ValueError):
+        scheduler.predict([-5])
@@ -0,0 +1,56 @@
+"""
+Tests of coalescing identical images processed at the same time
+"""
+import threading
+
+from ocr_detection.single_flight import SingleFlight
+
+
+def test_first_caller_leads_and_others_follow():
+    flights = SingleFlight()
+    flight, leader = flights.claim('image')
+    assert leader
+    follower_flight, follower_leader = flights.claim('image')
+    assert not follower_leader
+    assert follower_flight is flight
+    assert flights.stats() == {'in_flight': 1, 'leaders': 1, 'coalesced': 1}
+
+
+def test_followers_get_published_result():
+    flights = SingleFlight()
+    flight, _ = flights.claim('image')
+    results = []
+    waiting = []
+    for _ in range(3):
+        follower, leader = flights.claim('image')
+        assert not leader
+        waiting.append(threading.Thread(target=lambda follower=follower: results.append(follower.wait(5))))
+    for thread in waiting:
+        thread.start()
+    flights.publish('image', {'success': True})
+    for thread in waiting:
+        thread.join()
+    assert results == [{'success': True}] * 3
+
+
+def test_published_key_is_forgotten():
+    flights = SingleFlight()
+    flights.claim('image')
+    flights.publish('image', {'success': True})
+    _, leader = flights.claim('image')
+    assert leader
+    assert flights.stats()['in_flight'] == 1
+
+
+def test_failure_releases_followers_with_none():
+    flights = SingleFlight()
+    flights.claim('image')
+    follower, _ = flights.claim('image')
+    flights.publish('image', None)
+    assert follower.wait(1) is None
+
+
+def test_different_keys_do_not_coalesce():
+    flights = SingleFlight()
+    assert flights.claim('first')[1]
+    assert flights.claim('second')[1]
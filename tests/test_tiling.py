@@ -0,0 +1,50 @@
+"""
+Tests of splitting images into tiles and merging their boxes
+"""
+import numpy as np
+
+from ocr_detection.tiling import deduplicate_boxes, split_tiles, tile_starts
+
+
+def rectangle(left, top, right, bottom):
+    return [[left, top], [right, top], [right, bottom], [left, bottom]]
+
+
+def test_tiles_cover_the_image_with_overlap():
+    starts = tile_starts(1000, 400, 100)
+    assert starts[0] == 0
+    assert starts[-1] == 600
+    assert all(later - earlier <= 300 for earlier, later in zip(starts, starts[1:]))
+
+
+def test_side_that_fits_is_not_split():
+    image = np.zeros((3000, 500, 3), dtype=np.uint8)
+    tiles = split_tiles(image, 1000, overlap=100)
+    assert all(offset[0] == 0 for _, offset in tiles)
+    assert all(tile.shape[1] == 500 for tile, _ in tiles)
+
+
+def test_box_found_in_two_tiles_is_kept_once():
+    # The same line found in full in one tile and cut off in the next
+    boxes = np.array([rectangle(10, 950, 400, 990), rectangle(10, 950, 300, 990)], dtype=float)
+    assert deduplicate_boxes(boxes, [0, 1]).tolist() == [0]
+
+
+def test_overlapping_boxes_of_the_same_tile_are_kept():
+    boxes = np.array([rectangle(10, 10, 400, 50), rectangle(10, 10, 300, 50)], dtype=float)
+    assert deduplicate_boxes(boxes, [0, 0]).tolist() == [0, 1]
+
+
+def test_separate_boxes_are_kept_in_order():
+    boxes = np.array([rectangle(10, 10, 100, 40), rectangle(10, 900, 300, 940), rectangle(200, 10, 260, 40)],
+                     dtype=float)
+    assert deduplicate_boxes(boxes, [0, 1, 1]).tolist() == [0, 1, 2]
+
+
+def test_slightly_overlapping_boxes_are_kept():
+    boxes = np.array([rectangle(0, 0, 100, 40), rectangle(0, 30, 100, 70)], dtype=float)
+    assert deduplicate_boxes(boxes, [0, 1]).tolist() == [0, 1]
+
+
+def test_no_boxes():
+    assert deduplicate_boxes(np.zeros((0, 4, 2)), []).tolist() == []
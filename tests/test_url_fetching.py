@@ -0,0 +1,64 @@
+"""
+Tests of the host checks of image downloads
+"""
+import logging
+import socket
+
+import pytest
+
+from common.exceptions import ImageDownloadException
+from common.url_fetching import UrlFetcher
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = UrlFetcher(logger=logging.getLogger('test'), workers=1)
+    yield fetcher
+    fetcher.close()
+
+
+@pytest.mark.parametrize('url', [
+    'http://127.0.0.1/image.png',
+    'http://10.0.0.8/image.png',
+    'http://172.17.0.1:8080/image.png',
+    'http://192.168.1.1/image.png',
+    'http://169.254.169.254/latest/meta-data',
+    'http://0.0.0.0/image.png',
+    'http://[::1]/image.png',
+    'http://[fe80::1]/image.png',
+    'http://[fd00::1]/image.png',
+    'http://[::ffff:127.0.0.1]/image.png',
+    'http://224.0.0.1/image.png',
+])
+def test_private_addresses_are_refused(fetcher, url):
+    with pytest.raises(ImageDownloadException, match='host not allowed'):
+        fetcher.check_host(url)
+
+
+def test_public_address_is_allowed(fetcher):
+    fetcher.check_host('http://93.184.216.34/image.png')
+
+
+def test_host_resolving_to_any_private_address_is_refused(fetcher, monkeypatch):
+    def getaddrinfo(host, port, *args, **kwargs):
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', ('93.184.216.34', 80)),
+                (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', ('10.0.0.1', 80))]
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    with pytest.raises(ImageDownloadException, match='host not allowed'):
+        fetcher.check_host('http://images.example.com/image.png')
+
+
+def test_unresolvable_host_is_refused(fetcher, monkeypatch):
+    def getaddrinfo(*args, **kwargs):
+        raise socket.gaierror('Name or service not known')
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    with pytest.raises(ImageDownloadException):
+        fetcher.check_host('http://missing.example.com/image.png')
+
+
+def test_private_addresses_can_be_allowed():
+    fetcher = UrlFetcher(logger=logging.getLogger('test'), workers=1, allow_private=True)
+    try:
+        fetcher.check_host('http://127.0.0.1/image.png')
+    finally:
+        fetcher.close()